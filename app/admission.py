@@ -0,0 +1,221 @@
+# app/admission.py
+# Контроль допуска при всплесках нагрузки: ограничение частоты сообщений одного пользователя,
+# общий для всех машин лимит одновременных LLM-ходов и режим деградации — ответ шаблоном
+# фазы (или запасной моделью) вместо бесконечного ожидания gpt-4o.
+import os
+import time
+import asyncio
+import uuid
+import logging
+from typing import Any, Dict, Optional
+
+import redis.asyncio as redis
+
+from .cache import TTLCache
+from .dialog_state import REDIS_URL, STATE_BACKEND
+from . import llm
+from .llm import LLM_SECONDARY_MODEL, limiter
+from .metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_BACKEND = os.getenv("ADMISSION_BACKEND", STATE_BACKEND)  # redis | memory
+# Token bucket на пользователя: USER_BURST сообщений подряд, дальше USER_RATE в секунду
+USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "0.5"))
+USER_BURST = int(os.getenv("ADMISSION_USER_BURST", "5"))
+# Сообщение сверх лимита получает просьбу подождать не чаще раза за интервал, остальные пропускаются
+FLOOD_NOTICE_INTERVAL = int(os.getenv("ADMISSION_FLOOD_NOTICE_INTERVAL", "30"))
+FLOOD_REPLY = "Вы пишете очень быстро — подождите немного, и я отвечу на следующее сообщение."
+# Одновременных LLM-ходов на все машины; аренда слота истекает сама, если процесс упал.
+# Пока ход идёт, аренда продлевается каждые SLOT_TTL/3 с: ход дольше SLOT_TTL (очередь
+# лимитера, ретраи OpenAI) не выпадает из лимита
+GLOBAL_INFLIGHT = int(os.getenv("ADMISSION_GLOBAL_INFLIGHT", "40"))
+SLOT_TTL = int(os.getenv("ADMISSION_SLOT_TTL", "60"))
+# Дедлайн ожидания: сообщение, пролежавшее в очереди дольше, получает быстрый ответ
+QUEUE_DEADLINE = float(os.getenv("ADMISSION_QUEUE_DEADLINE", "15"))
+# Пороги деградации: глубина очереди лимитера LLM и сглаженная задержка модели, секунды
+DEGRADE_QUEUE_DEPTH = int(os.getenv("DEGRADE_QUEUE_DEPTH", "20"))
+DEGRADE_LATENCY = float(os.getenv("DEGRADE_LATENCY", "8"))
+
+REASONS = {"deadline", "queue", "latency", "inflight", "overloaded"}
+shed = Counter("admission_shed_total", "Сообщения вне обычного пути LLM", ["reason", "mode"],
+               {"reason": REASONS | {"flood"}, "mode": {"secondary", "canned", "notified", "dropped"}})
+
+_USER_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or burst
+local ts = tonumber(data[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+# Слоты — ZSET аренд с временем выдачи; просроченные аренды вычищаются при каждом захвате
+_SLOT_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+  redis.call('ZADD', KEYS[1], now, ARGV[3])
+  redis.call('EXPIRE', KEYS[1], ARGV[2])
+  return 1
+end
+return 0
+"""
+
+# Продление аренды: только если слот ещё не освобождён и не вычищен как просроченный
+_RENEW_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local renewed = redis.call('ZADD', KEYS[1], 'XX', 'CH', now, ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return renewed
+"""
+
+
+class MemoryAdmission:
+    # Для одного процесса (STATE_BACKEND=memory)
+    name = "memory"
+
+    def __init__(self):
+        self._buckets = TTLCache(maxsize=100000, ttl=USER_BURST / USER_RATE + 1)
+        self._notified = TTLCache(maxsize=100000, ttl=FLOOD_NOTICE_INTERVAL)
+        self.in_flight = 0
+
+    async def allow_user(self, user_id: str) -> bool:
+        now = time.monotonic()
+        tokens, ts = self._buckets.get(user_id) or (USER_BURST, now)
+        tokens = min(USER_BURST, tokens + (now - ts) * USER_RATE)
+        allowed = tokens >= 1
+        self._buckets.set(user_id, (tokens - 1 if allowed else tokens, now))
+        return allowed
+
+    async def flood_notice(self, user_id: str) -> bool:
+        # True — пора ответить просьбой подождать
+        if self._notified.get(user_id) is not None:
+            return False
+        self._notified.set(user_id, True)
+        return True
+
+    async def acquire_slot(self) -> Optional[str]:
+        if self.in_flight >= GLOBAL_INFLIGHT:
+            return None
+        self.in_flight += 1
+        return "local"
+
+    async def release_slot(self, slot: str):
+        self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "in_flight": self.in_flight, "limit": GLOBAL_INFLIGHT}
+
+
+class RedisAdmission:
+    name = "redis"
+    SLOTS = "admission:inflight"
+
+    def __init__(self, client):
+        self.client = client
+        self._user_bucket = client.register_script(_USER_BUCKET_SCRIPT)
+        self._slot = client.register_script(_SLOT_SCRIPT)
+        self._renew = client.register_script(_RENEW_SCRIPT)
+        self._renewers: Dict[str, asyncio.Task] = {}
+        self.errors = 0
+
+    async def allow_user(self, user_id: str) -> bool:
+        try:
+            return bool(await self._user_bucket(keys=[f"admission:user:{user_id}"], args=[USER_RATE, USER_BURST]))
+        except Exception as e:
+            # Redis недоступен — не ограничиваем, чем отвечать отказом всем
+            self.errors += 1
+            logger.warning(f"Лимит пользователя недоступен: {e}")
+            return True
+
+    async def flood_notice(self, user_id: str) -> bool:
+        try:
+            return bool(await self.client.set(f"admission:notice:{user_id}", 1, nx=True, ex=FLOOD_NOTICE_INTERVAL))
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Отметка о флуде недоступна: {e}")
+            return False
+
+    async def acquire_slot(self) -> Optional[str]:
+        slot = uuid.uuid4().hex
+        try:
+            acquired = await self._slot(keys=[self.SLOTS], args=[GLOBAL_INFLIGHT, SLOT_TTL, slot])
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Общий лимит LLM-ходов недоступен: {e}")
+            return ""
+        if not acquired:
+            return None
+        self._renewers[slot] = asyncio.create_task(self._keep_slot(slot))
+        return slot
+
+    async def _keep_slot(self, slot: str):
+        while True:
+            await asyncio.sleep(SLOT_TTL / 3)
+            try:
+                if not await self._renew(keys=[self.SLOTS], args=[slot, SLOT_TTL]):
+                    logger.warning(f"Аренда слота LLM {slot} истекла до конца хода")
+                    return
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Ошибка продления слота LLM: {e}")
+
+    async def release_slot(self, slot: str):
+        if not slot:
+            return
+        renewer = self._renewers.pop(slot, None)
+        if renewer is not None:
+            renewer.cancel()
+        try:
+            await self.client.zrem(self.SLOTS, slot)
+        except Exception as e:
+            logger.warning(f"Ошибка освобождения слота LLM: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "limit": GLOBAL_INFLIGHT, "held": len(self._renewers), "errors": self.errors}
+
+
+def create_admission():
+    if ADMISSION_BACKEND == "memory":
+        return MemoryAdmission()
+    return RedisAdmission(redis.from_url(REDIS_URL, decode_responses=True))
+
+
+admission = create_admission()
+
+
+def overload_reason(waited: float) -> Optional[str]:
+    # Причина не ждать основную модель, None — работаем как обычно
+    if waited >= QUEUE_DEADLINE:
+        return "deadline"
+    if limiter.queued >= DEGRADE_QUEUE_DEPTH:
+        return "queue"
+    if llm.current_latency() >= DEGRADE_LATENCY:
+        return "latency"
+    return None
+
+
+def degraded_mode() -> str:
+    # secondary — запасная модель, canned — готовый ответ фазы
+    return "secondary" if LLM_SECONDARY_MODEL else "canned"
+
+
+def canned_turn(phase, message: str, vars: Dict[str, Any], reason: str) -> Dict[str, Any]:
+    # Готовый ответ фазы; слоты и переход — по эвристикам фазы, как при обычном ходе
+    shed.inc(reason=reason, mode="canned")
+    next_phase, updated_vars = phase.route(message, vars)
+    return {"reply": phase.canned, "next_phase": next_phase, "vars": updated_vars}
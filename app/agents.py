@@ -1,14 +1,25 @@
 # app/agents.py
-import logging
+import os
 import re
-from typing import List
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain.output_parsers import PydanticOutputParser
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+from langchain_core.output_parsers import PydanticOutputParser
 from pydantic import BaseModel, Field
 
+from .llm import register_chain, abatch
+from .metrics import fallbacks, stage_seconds
+from .tracing import detached_task
+
 logger = logging.getLogger(__name__)
 
+# Микробатчи квалификации: ждём не дольше QUALIFY_MAX_WAIT, берём до QUALIFY_BATCH_SIZE сообщений
+QUALIFY_BATCH_SIZE = int(os.getenv("QUALIFY_BATCH_SIZE", "8"))
+QUALIFY_MAX_WAIT = float(os.getenv("QUALIFY_MAX_WAIT", "0.05"))
+# Бюджет задержки: дольше не ждём и отдаём запасной LeadInfo
+QUALIFY_BUDGET = float(os.getenv("QUALIFY_BUDGET", "3.0"))
+HOT_INTENTS = ["заказать_услугу", "узнать_цену", "связаться_с_менеджером"]
+
 class LeadInfo(BaseModel):
     intent: str = Field(default="задать_вопрос", description="намерение")
     name: str = Field(default="", description="имя клиента")
@@ -32,8 +43,7 @@ def extract_contact(text: str) -> str:
 
 parser = PydanticOutputParser(pydantic_object=LeadInfo)
 
-prompt = ChatPromptTemplate.from_template(
-    """Вы — эксперт по лидам в NeuroPragmat.
+PROMPT_TEXT = """Вы — эксперт по лидам в NeuroPragmat.
 Анализируйте сообщение и определите:
 1. Намерение: "заказать_услугу", "узнать_цену", "связаться_с_менеджером", "задать_вопрос"
 2. Если клиент проявил интерес — установите is_hot = True
@@ -43,25 +53,79 @@ prompt = ChatPromptTemplate.from_template(
 "{input}"
 {format_instructions}
 """
+
+# Инструкции формата вычисляются один раз и вшиваются в шаблон
+register_chain(
+    "qualify", PROMPT_TEXT, parser=parser, format_instructions=parser.get_format_instructions()
 )
 
-llm = ChatOpenAI(model="gpt-4o", temperature=0)
+def _finalize(result: LeadInfo, contact: str) -> LeadInfo:
+    result.contact = contact
+    if result.intent in HOT_INTENTS:
+        result.is_hot = True
+    return result
+
+def _fallback(user_message: str, contact: str) -> LeadInfo:
+    return LeadInfo(summary=user_message[:100], contact=contact)
+
+class QualificationBatcher:
+    # Собирает одновременные запросы квалификации в один abatch
+    def __init__(self, batch_size: int = QUALIFY_BATCH_SIZE, max_wait: float = QUALIFY_MAX_WAIT):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def qualify(self, user_message: str) -> LeadInfo:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_message, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            # Пачка общая для нескольких ходов — вне трассы того, кто её запустил
+            detached_task(self._run(batch))
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]):
+        self.batches += 1
+        try:
+            results = await abatch("qualify", [{"input": message} for message, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+qualification_batcher = QualificationBatcher()
 
-def classify_and_qualify(user_message: str, context: str = "") -> LeadInfo:
+async def aclassify_and_qualify(user_message: str, context: str = "") -> LeadInfo:
+    # Регулярки по контактам — до LLM; сам вызов ограничен бюджетом QUALIFY_BUDGET
+    contact = extract_contact(user_message)
     try:
-        contact = extract_contact(user_message)
-        chain = prompt | llm | parser
-        result = chain.invoke({
-            "input": user_message,
-            "format_instructions": parser.get_format_instructions()
-        })
-        result.contact = contact
-        if result.intent in ["заказать_услугу", "узнать_цену", "связаться_с_менеджером"]:
-            result.is_hot = True
-        return result
+        with stage_seconds.time(stage="qualify"):
+            result = await asyncio.wait_for(
+                asyncio.shield(qualification_batcher.qualify(user_message)), QUALIFY_BUDGET
+            )
+        return _finalize(result, contact)
+    except asyncio.TimeoutError:
+        fallbacks.inc(kind="qualify_timeout")
+        logger.warning(f"Квалификация не уложилась в {QUALIFY_BUDGET} с, fallback")
     except Exception as e:
+        fallbacks.inc(kind="qualify")
         logger.error(f"Агент fallback: {e}")
-        return LeadInfo(
-            summary=user_message[:100],
-            contact=extract_contact(user_message)
-        )
\ No newline at end of file
+    return _fallback(user_message, contact)
\ No newline at end of file
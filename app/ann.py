@@ -0,0 +1,93 @@
+# app/ann.py
+# Приближённые индексы FAISS для больших баз знаний (каталоги, прайсы). Точный flat-индекс
+# остаётся источником правды для инкрементальной сборки (add/remove по ID), а поисковый
+# индекс выбранного типа собирается из его векторов при публикации версии:
+#   flat — точный перебор, память 4·d байт на чанк
+#   ivf  — IVF-Flat: перебор только FAISS_NPROBE ближайших кластеров из nlist
+#   hnsw — граф HNSW: быстрый и точный, но +8·M байт на чанк к полным векторам
+#   pq   — IVF-PQ: вектор сжат до FAISS_PQ_M байт, для миллионов чанков
+import os
+import math
+from typing import Any, Dict
+
+INDEX_TYPES = ("flat", "ivf", "hnsw", "pq")
+INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")
+# Число кластеров IVF/PQ; 0 — 4·sqrt(N)
+INDEX_NLIST = int(os.getenv("FAISS_NLIST", "0"))
+INDEX_NPROBE = int(os.getenv("FAISS_NPROBE", "8"))
+HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_EF_CONSTRUCTION", "80"))
+HNSW_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+PQ_M = int(os.getenv("FAISS_PQ_M", "16"))
+PQ_BITS = int(os.getenv("FAISS_PQ_BITS", "8"))
+# На корпусе меньше этого точный перебор и так занимает доли миллисекунды
+ANN_MIN_CHUNKS = int(os.getenv("FAISS_ANN_MIN_CHUNKS", "1000"))
+# k-means FAISS просит не меньше ~39 обучающих векторов на центроид
+MIN_POINTS_PER_CENTROID = 39
+
+if INDEX_TYPE not in INDEX_TYPES:
+    raise ValueError(f"FAISS_INDEX_TYPE должен быть одним из {', '.join(INDEX_TYPES)}")
+
+
+def index_spec(count: int, dim: int, index_type: str = INDEX_TYPE) -> Dict[str, Any]:
+    # Параметры индекса под размер корпуса; на маленьком корпусе ANN не обучить — остаётся flat
+    spec: Dict[str, Any] = {"type": index_type, "requested": index_type}
+    if count < ANN_MIN_CHUNKS:
+        return {"type": "flat", "requested": index_type}
+    if index_type in ("ivf", "pq"):
+        nlist = INDEX_NLIST or int(4 * math.sqrt(count))
+        nlist = min(nlist, count // MIN_POINTS_PER_CENTROID)
+        if index_type == "pq":
+            # Подвекторов должно быть целое число: берём ближайший делитель d не больше PQ_M
+            spec["m"] = max(m for m in range(1, min(PQ_M, dim) + 1) if dim % m == 0)
+            spec["bits"] = PQ_BITS
+            if count < MIN_POINTS_PER_CENTROID * 2 ** PQ_BITS:
+                nlist = 0
+        if nlist < 1:
+            return {"type": "flat", "requested": index_type}
+        spec["nlist"] = nlist
+    elif index_type == "hnsw":
+        spec["m"] = HNSW_M
+        spec["ef_construction"] = HNSW_EF_CONSTRUCTION
+    return spec
+
+
+def build_ann(vectors, spec: Dict[str, Any]):
+    # vectors — float32 numpy-массив (N, d) в порядке позиций flat-индекса:
+    # позиция i в ANN-индексе — тот же чанк, что и в index_to_docstore_id
+    import faiss
+
+    dim = vectors.shape[1]
+    if spec["type"] == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, spec["m"])
+        index.hnsw.efConstruction = spec["ef_construction"]
+    elif spec["type"] in ("ivf", "pq"):
+        quantizer = faiss.IndexFlatL2(dim)
+        if spec["type"] == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, dim, spec["nlist"])
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, spec["nlist"], spec["m"], spec["bits"])
+        index.train(vectors)
+    else:
+        index = faiss.IndexFlatL2(dim)
+    index.add(vectors)
+    return tune(index)
+
+
+def flat_vectors(index):
+    # Все векторы точного индекса (IndexFlat хранит их как есть)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def tune(index):
+    # Параметры поиска задаются при загрузке: их можно менять без пересборки
+    import faiss
+
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    else:
+        try:
+            faiss.extract_index_ivf(index).nprobe = INDEX_NPROBE
+        except RuntimeError:
+            pass  # flat: настраивать нечего
+    return index
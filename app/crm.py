@@ -1,45 +1,390 @@
 # app/crm.py
 import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
 import logging
+from typing import Any, Dict, List, Optional
+
 import httpx
+import redis.asyncio as redis
+
 from .agents import LeadInfo
+from .dialog_state import REDIS_URL, STATE_BACKEND
+from .metrics import stage_seconds
+from .tracing import span
 
 logger = logging.getLogger(__name__)
 ALBATO_WEBHOOK_URL = os.getenv("ALBATO_WEBHOOK_URL")
 
-async def send_lead_to_crm(lead: LeadInfo, user_id: str, full_name: str, channel: str, original_message: str):
-    if not ALBATO_WEBHOOK_URL:
-        logger.warning("ALBATO_WEBHOOK_URL не задан")
-        return
+# Лиды не отправляются в ходе диалога: они кладутся в outbox и доставляются фоновым воркером
+CRM_OUTBOX = os.getenv("CRM_OUTBOX", STATE_BACKEND)  # redis | memory
+CRM_MAX_ATTEMPTS = int(os.getenv("CRM_MAX_ATTEMPTS", "8"))
+CRM_BACKOFF_BASE = float(os.getenv("CRM_BACKOFF_BASE", "2.0"))
+CRM_BACKOFF_MAX = float(os.getenv("CRM_BACKOFF_MAX", "600"))
+# >1 — отправлять лиды пачкой (JSON-массив) одним запросом
+CRM_BATCH_SIZE = int(os.getenv("CRM_BATCH_SIZE", "1"))
+CRM_TIMEOUT = float(os.getenv("CRM_TIMEOUT", "10.0"))
+# Сколько помним доставленные ключи идемпотентности
+CRM_SENT_TTL = int(os.getenv("CRM_SENT_TTL", "86400"))
+# Аренда лида воркером, секунды: дольше любой доставки (CRM_TIMEOUT на запрос). Лид,
+# аренда которого истекла (процесс упал посреди отправки), возвращается в очередь
+CRM_LEASE_SECONDS = int(os.getenv("CRM_LEASE_SECONDS", "120"))
+# Как часто воркер ищет просроченные аренды, секунды
+CRM_RECOVER_INTERVAL = int(os.getenv("CRM_RECOVER_INTERVAL", "30"))
+
+# Аренда только что забранного лида; время — по часам Redis, общим для всех машин
+_LEASE_SCRIPT = """
+local now = redis.call('TIME')
+redis.call('ZADD', KEYS[1], tonumber(now[1]) + tonumber(ARGV[2]), ARGV[1])
+"""
+
+# Возврат в очередь лидов с истёкшей арендой. Лид без аренды (воркер упал между BLMOVE и
+# выдачей аренды, или он остался от версии без аренд) сначала получает аренду: если его
+# всё-таки отправляют, воркер её перезапишет, иначе он вернётся после её истечения
+_RECLAIM_SCRIPT = """
+local now = tonumber(redis.call('TIME')[1])
+local moved = 0
+for _, raw in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+  local deadline = redis.call('ZSCORE', KEYS[2], raw)
+  if not deadline then
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[1]), raw)
+  elseif tonumber(deadline) < now then
+    redis.call('LREM', KEYS[1], 1, raw)
+    redis.call('ZREM', KEYS[2], raw)
+    redis.call('RPUSH', KEYS[3], raw)
+    moved = moved + 1
+  end
+end
+return moved
+"""
+
 
-    # Имя: сначала из агента, потом из Telegram, потом "Клиент"
-    name_for_crm = lead.name if lead and lead.name else (full_name or "Клиент")
+def build_payload(lead: Optional[LeadInfo], user_id: str, full_name: str, channel: str,
+                  original_message: str, override_data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    override_data = override_data or {}
+    # Имя: сначала из агента или триггера, потом из Telegram, потом "Клиент"
+    name_for_crm = (lead.name if lead and lead.name else override_data.get("name")) or full_name or "Клиент"
+    intent = lead.intent if lead else "задать_вопрос"
 
     payload = {
         "name": f"Запрос от {name_for_crm}",
-        "query": original_message,
+        "query": override_data.get("quest") or original_message,
         "tags": [
             "firstcontact_ai",
-            lead.intent.replace("_", " ") if lead else "задать вопрос",
+            intent.replace("_", " "),
             "hot_lead" if (lead and lead.is_hot) else "regular"
         ],
         "contact": {
             "name": name_for_crm,
-            "phone": lead.contact if lead else ""
+            "phone": (lead.contact if lead else "") or override_data.get("phone", "")
         },
         "custom_fields": {
-            "ai_summary": lead.summary if lead else original_message[:100],
-            "intent": lead.intent if lead else "задать_вопрос",
+            "ai_summary": override_data.get("summarize") or (lead.summary if lead else original_message[:100]),
+            "intent": intent,
             "source": f"{channel} ({user_id})"
         }
     }
+    for field in ("goal", "business_type", "crm"):
+        if override_data.get(field):
+            payload["custom_fields"][field] = override_data[field]
+    return payload
+
+
+def idempotency_key(*parts: str) -> str:
+    # По источнику лида, а не по содержимому: повторная заявка с теми же данными — новый лид,
+    # а повторная обработка того же сообщения — тот же
+    return hashlib.sha256(":".join(parts).encode("utf-8")).hexdigest()[:32]
+
+
+class RedisOutbox:
+    # Надёжная очередь: BLMOVE в processing-список с арендой в ZSET (лид -> срок),
+    # ретраи — в ZSET по времени, мёртвые — в отдельный список
+    QUEUE = "crm:outbox"
+    PROCESSING = "crm:outbox:processing"
+    LEASES = "crm:outbox:leases"
+    RETRY = "crm:outbox:retry"
+    DEAD = "crm:outbox:dead"
+
+    def __init__(self, client):
+        self.client = client
+        self._lease = client.register_script(_LEASE_SCRIPT)
+        self._reclaim = client.register_script(_RECLAIM_SCRIPT)
+
+    async def push(self, item: Dict[str, Any]):
+        await self.client.lpush(self.QUEUE, json.dumps(item, ensure_ascii=False))
+
+    async def _claimed(self, raw: Optional[str]) -> Optional[Dict[str, Any]]:
+        if raw is None:
+            return None
+        await self._lease(keys=[self.LEASES], args=[raw, CRM_LEASE_SECONDS])
+        item = json.loads(raw)
+        item["_raw"] = raw
+        return item
+
+    async def pop(self, timeout: float) -> Optional[Dict[str, Any]]:
+        return await self._claimed(await self.client.blmove(self.QUEUE, self.PROCESSING, timeout, "RIGHT", "LEFT"))
+
+    async def pop_nowait(self) -> Optional[Dict[str, Any]]:
+        return await self._claimed(await self.client.lmove(self.QUEUE, self.PROCESSING, "RIGHT", "LEFT"))
+
+    async def ack(self, item: Dict[str, Any]):
+        raw = item.pop("_raw")
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.lrem(self.PROCESSING, 1, raw)
+            pipe.zrem(self.LEASES, raw)
+            await pipe.execute()
+
+    async def retry(self, item: Dict[str, Any], at: float):
+        raw = item.pop("_raw")
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.RETRY, {json.dumps(item, ensure_ascii=False): at})
+            pipe.lrem(self.PROCESSING, 1, raw)
+            pipe.zrem(self.LEASES, raw)
+            await pipe.execute()
+
+    async def dead(self, item: Dict[str, Any]):
+        raw = item.pop("_raw")
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.lpush(self.DEAD, json.dumps(item, ensure_ascii=False))
+            pipe.lrem(self.PROCESSING, 1, raw)
+            pipe.zrem(self.LEASES, raw)
+            await pipe.execute()
+
+    async def release_due(self):
+        # Возвращаем в очередь лиды, у которых подошло время повтора
+        due = await self.client.zrangebyscore(self.RETRY, 0, time.time(), start=0, num=100)
+        for raw in due:
+            if await self.client.zrem(self.RETRY, raw):
+                await self.client.lpush(self.QUEUE, raw)
+
+    async def recover(self) -> int:
+        # Лиды упавших процессов (аренда истекла) возвращаем в очередь; лиды, которые
+        # сейчас отправляет живой воркер, не трогаем. Безопасно на любом числе машин
+        return await self._reclaim(keys=[self.PROCESSING, self.LEASES, self.QUEUE], args=[CRM_LEASE_SECONDS])
+
+    async def was_sent(self, key: str) -> bool:
+        return bool(await self.client.exists(f"crm:sent:{key}"))
+
+    async def mark_sent(self, key: str):
+        await self.client.set(f"crm:sent:{key}", 1, ex=CRM_SENT_TTL)
+
+    async def depth(self) -> Dict[str, int]:
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.llen(self.QUEUE)
+            pipe.llen(self.PROCESSING)
+            pipe.zcard(self.RETRY)
+            pipe.llen(self.DEAD)
+            queued, processing, retry, dead = await pipe.execute()
+        return {"queued": queued, "processing": processing, "retry": retry, "dead": dead}
+
+
+class MemoryOutbox:
+    # Недолговечный вариант без Redis — для локальной разработки и бенчмарков
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.retrying: List[tuple] = []
+        self.dead_letters: List[Dict[str, Any]] = []
+        self.sent: Dict[str, float] = {}
+        self.processing = 0
+
+    async def push(self, item):
+        self.queue.put_nowait(item)
+
+    async def pop(self, timeout: float):
+        try:
+            item = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self.processing += 1
+        return item
 
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.post(ALBATO_WEBHOOK_URL, json=payload)
-            if resp.status_code in (200, 201, 202):
-                logger.info("✅ Лид отправлен в CRM")
+    async def pop_nowait(self):
+        try:
+            item = self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+        self.processing += 1
+        return item
+
+    async def ack(self, item):
+        self.processing -= 1
+
+    async def retry(self, item, at: float):
+        self.processing -= 1
+        self.retrying.append((at, item))
+
+    async def dead(self, item):
+        self.processing -= 1
+        self.dead_letters.append(item)
+
+    async def release_due(self):
+        now = time.time()
+        due = [item for at, item in self.retrying if at <= now]
+        self.retrying = [(at, item) for at, item in self.retrying if at > now]
+        for item in due:
+            self.queue.put_nowait(item)
+
+    async def recover(self) -> int:
+        return 0
+
+    async def was_sent(self, key: str) -> bool:
+        return self.sent.get(key, 0) > time.time()
+
+    async def mark_sent(self, key: str):
+        self.sent[key] = time.time() + CRM_SENT_TTL
+
+    async def depth(self):
+        return {"queued": self.queue.qsize(), "processing": self.processing,
+                "retry": len(self.retrying), "dead": len(self.dead_letters)}
+
+
+class PermanentDeliveryError(Exception):
+    pass
+
+
+class CrmDeliveryWorker:
+    def __init__(self, outbox, url: Optional[str]):
+        self.outbox = outbox
+        self.url = url
+        self.delivered = 0
+        self.failed_attempts = 0
+        self.dead_lettered = 0
+        self.recovered = 0
+        self._recovered_at: Optional[float] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        # Один долгоживущий клиент: соединение и TLS-сессия к Albato переиспользуются
+        self._client = httpx.AsyncClient(
+            timeout=CRM_TIMEOUT,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._client:
+            await self._client.aclose()
+
+    async def _recover(self):
+        # Раз в CRM_RECOVER_INTERVAL: при старте и дальше по таймеру внутри цикла воркера
+        if self._recovered_at is not None and time.monotonic() - self._recovered_at < CRM_RECOVER_INTERVAL:
+            return
+        self._recovered_at = time.monotonic()
+        try:
+            moved = await self.outbox.recover()
+        except Exception as e:
+            logger.error(f"Ошибка восстановления outbox CRM: {e}")
+            return
+        if moved:
+            self.recovered += moved
+            logger.warning(f"Возвращено в очередь CRM лидов с истёкшей арендой: {moved}")
+
+    async def _run(self):
+        while True:
+            try:
+                await self._recover()
+                await self.outbox.release_due()
+                item = await self.outbox.pop(timeout=1.0)
+                if item is None:
+                    continue
+                batch = [item]
+                while len(batch) < CRM_BATCH_SIZE:
+                    more = await self.outbox.pop_nowait()
+                    if more is None:
+                        break
+                    batch.append(more)
+                await self._deliver(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка воркера CRM: {e}")
+                await asyncio.sleep(1.0)
+
+    async def _post(self, batch: List[Dict[str, Any]]):
+        if not self.url:
+            raise PermanentDeliveryError("ALBATO_WEBHOOK_URL не задан")
+        body = batch[0]["payload"] if len(batch) == 1 else [item["payload"] for item in batch]
+        key = batch[0]["id"] if len(batch) == 1 else idempotency_key(*(item["id"] for item in batch))
+        headers = {"Idempotency-Key": key}
+        resp = await self._client.post(self.url, json=body, headers=headers)
+        if resp.status_code in (200, 201, 202):
+            return
+        message = f"Albato error: {resp.status_code} – {resp.text}"
+        if 400 <= resp.status_code < 500 and resp.status_code not in (408, 429):
+            raise PermanentDeliveryError(message)
+        raise RuntimeError(message)
+
+    async def _deliver(self, batch: List[Dict[str, Any]]):
+        pending = []
+        for item in batch:
+            if await self.outbox.was_sent(item["id"]):
+                await self.outbox.ack(item)
             else:
-                logger.error(f"❌ Albato error: {resp.status_code} – {resp.text}")
-    except Exception as e:
-        logger.error(f"Исключение при отправке в CRM: {e}")
\ No newline at end of file
+                pending.append(item)
+        if not pending:
+            return
+
+        try:
+            with stage_seconds.time(stage="crm_delivery"):
+                await self._post(pending)
+        except Exception as e:
+            for item in pending:
+                item["attempts"] = item.get("attempts", 0) + 1
+                item["last_error"] = str(e)[:500]
+                if isinstance(e, PermanentDeliveryError) or item["attempts"] >= CRM_MAX_ATTEMPTS:
+                    self.dead_lettered += 1
+                    logger.error(f"❌ Лид {item['id']} в dead-letter: {e}")
+                    await self.outbox.dead(item)
+                else:
+                    self.failed_attempts += 1
+                    delay = min(CRM_BACKOFF_MAX, CRM_BACKOFF_BASE * 2 ** (item["attempts"] - 1))
+                    delay *= 0.5 + random.random()
+                    logger.warning(f"Повтор отправки лида {item['id']} через {delay:.0f} с: {e}")
+                    await self.outbox.retry(item, time.time() + delay)
+            return
+
+        for item in pending:
+            await self.outbox.mark_sent(item["id"])
+            await self.outbox.ack(item)
+        self.delivered += len(pending)
+        logger.info(f"✅ Лидов отправлено в CRM: {len(pending)}")
+
+    async def stats(self) -> Dict[str, Any]:
+        try:
+            depth = await self.outbox.depth()
+        except Exception as e:
+            depth = {"error": str(e)}
+        return {"delivered": self.delivered, "failed_attempts": self.failed_attempts,
+                "dead_lettered": self.dead_lettered, "recovered": self.recovered, **depth}
+
+
+if CRM_OUTBOX == "memory":
+    outbox = MemoryOutbox()
+else:
+    outbox = RedisOutbox(redis.from_url(REDIS_URL, decode_responses=True))
+crm_worker = CrmDeliveryWorker(outbox, ALBATO_WEBHOOK_URL)
+
+
+async def send_lead_to_crm(lead: Optional[LeadInfo], user_id: str, full_name: str, channel: str,
+                           original_message: str, override_data: Optional[Dict[str, Any]] = None,
+                           message_id: str = ""):
+    # Ход диалога не ждёт CRM: лид только кладётся в outbox.
+    # message_id — сообщение, из которого лид; без него каждый вызов — отдельный лид
+    if not ALBATO_WEBHOOK_URL:
+        logger.warning("ALBATO_WEBHOOK_URL не задан")
+        return
+
+    payload = build_payload(lead, user_id, full_name, channel, original_message, override_data)
+    lead_id = idempotency_key(channel, user_id, message_id) if message_id else uuid.uuid4().hex
+    item = {"id": lead_id, "payload": payload, "attempts": 0, "created_at": time.time()}
+    with span("crm_enqueue", lead_id=item["id"]):
+        await outbox.push(item)
+    logger.info(f"Лид {item['id']} поставлен в очередь CRM")
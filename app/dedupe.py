@@ -0,0 +1,76 @@
+# app/dedupe.py
+# Telegram повторяет доставку обновления, если webhook ответил медленно или с ошибкой.
+# При нескольких воркерах uvicorn или машинах Fly повтор может попасть в другой процесс,
+# поэтому update_id "застолбляется" в Redis (SET NX EX) — обрабатывает тот, кто успел первым.
+import os
+import logging
+from typing import Any, Dict
+
+import redis.asyncio as redis
+
+from .cache import TTLCache
+from .dialog_state import REDIS_URL, STATE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+UPDATE_DEDUP_BACKEND = os.getenv("UPDATE_DEDUP_BACKEND", STATE_BACKEND)  # redis | memory
+# Telegram повторяет доставку в течение нескольких минут, дольше помнить не нужно
+UPDATE_DEDUP_TTL = int(os.getenv("UPDATE_DEDUP_TTL", "600"))
+
+
+class UpdateDeduplicator:
+    def __init__(self, client=None, ttl: int = UPDATE_DEDUP_TTL):
+        self.client = client
+        self.ttl = ttl
+        # Локальный слой: повтор в тот же процесс отсекается без похода в Redis
+        self.local = TTLCache(maxsize=100000, ttl=ttl)
+        self.duplicates = 0
+        self.errors = 0
+
+    @staticmethod
+    def _key(update_id: int) -> str:
+        return f"tg_update:{update_id}"
+
+    async def claim(self, update_id: int) -> bool:
+        # True — обновление новое и обрабатывается этим процессом
+        if self.local.get(update_id) is not None:
+            self.duplicates += 1
+            return False
+        if self.client is not None:
+            try:
+                claimed = await self.client.set(self._key(update_id), 1, nx=True, ex=self.ttl)
+            except Exception as e:
+                # Redis недоступен: лучше возможный дубль, чем потерянное сообщение
+                self.errors += 1
+                logger.warning(f"Дедупликация обновлений недоступна: {e}")
+                claimed = True
+            if not claimed:
+                self.duplicates += 1
+                return False
+        self.local.set(update_id, True)
+        return True
+
+    async def release(self, update_id: int):
+        # Обновление не принято в обработку (очередь переполнена) — повтор Telegram должен пройти
+        self.local.pop(update_id)
+        if self.client is not None:
+            try:
+                await self.client.delete(self._key(update_id))
+            except Exception as e:
+                logger.warning(f"Ошибка снятия отметки обновления {update_id}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "redis" if self.client is not None else "memory",
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+        }
+
+
+def create_deduplicator() -> UpdateDeduplicator:
+    if UPDATE_DEDUP_BACKEND == "memory":
+        return UpdateDeduplicator()
+    return UpdateDeduplicator(redis.from_url(REDIS_URL, decode_responses=True))
+
+
+update_dedup = create_deduplicator()
@@ -1,15 +1,520 @@
 # app/dialog_state.py
+# Состояние диалога хранится компактно: msgpack-массив [схема, фаза, version, vars], где фаза и
+# перечислимые слоты — номера, а имена vars — однобуквенные ключи. Читаются оба формата,
+# пишется STATE_WRITE_FORMAT; состояние в другом формате переписывается при первом обновлении.
+# Версии до компактного формата читают только JSON, поэтому выкатка в два шага: сначала
+# код, читающий оба формата, с STATE_WRITE_FORMAT=json, затем STATE_WRITE_FORMAT=compact.
+# В компактном формате переменная со значением None не хранится (читается как отсутствующая).
+#
+# Память Redis под состояния (для оценки на N диалогов):
+#   python -m app.dialog_state --sample 2000 --dialogs 300000
 import os
+import sys
+import copy
 import json
+import time
+import asyncio
+import logging
+import argparse
+import msgpack
 import redis.asyncio as redis
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
+
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+# redis — общий Redis; memory — в памяти процесса (тесты, локальная разработка)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "redis")
+STATE_TTL = int(os.getenv("STATE_TTL", "7200"))  # 2 часа, продлевается при каждом чтении
+# Локальный кэш чтения (секунды, 0 — выключен); запись всегда сквозная
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "2"))
+# Чтение из локального кэша продлевает TTL в хранилище не чаще раза за столько секунд
+STATE_TOUCH_INTERVAL = float(os.getenv("STATE_TOUCH_INTERVAL", "60"))
+
+# json — формат, понятный всем версиям; compact — msgpack
+STATE_WRITE_FORMAT = os.getenv("STATE_WRITE_FORMAT", "json")
+STATE_SCHEMA = 1
+# Коды — индексы в списках, они лежат в Redis: только дописывать в конец, не переставлять
+PHASE_CODES = ["phase1", "phase2A", "phase3A", "phase4A", "phase5A", "phase6A", "phase7", "completed"]
+VAR_CODES = {
+    "goal": "g", "business_type": "b", "crm": "c", "name": "n", "phone": "p",
+    "intent": "i", "summary": "s", "is_hot": "h",
+}
+SLOT_CODES = {
+    "goal": ["лидогенерация", "поддержка клиентов", "обработка заказов", "уточнить позже"],
+    "business_type": ["B2B", "B2C", "фриланс", "ИП", "уточнить позже"],
+    "crm": ["AmoCRM", "Bitrix24", "другая", "нет", "уточнить позже"],
+    "intent": ["задать_вопрос", "заказать_услугу", "узнать_цену", "связаться_с_менеджером"],
+}
+_PHASE_INDEX = {phase: i for i, phase in enumerate(PHASE_CODES)}
+_VAR_NAMES = {code: name for name, code in VAR_CODES.items()}
+_SLOT_INDEX = {slot: {value: i for i, value in enumerate(values)} for slot, values in SLOT_CODES.items()}
+
+if STATE_WRITE_FORMAT not in ("json", "compact"):
+    raise ValueError("STATE_WRITE_FORMAT должен быть json или compact")
+
+
+def new_state() -> Dict[str, Any]:
+    return {"phase": "phase1", "vars": {}}
+
+
+def apply_update(
+    current: Optional[Dict[str, Any]],
+    expected_version: Optional[int],
+    phase: str,
+    vars_update: Dict[str, Any],
+    reset_vars: bool = False,
+) -> Tuple[Dict[str, Any], bool]:
+    # Если с момента чтения состояние успел изменить другой ход (version другая),
+    # переменные всё равно сливаются — собранные ранее goal/phone не теряются, —
+    # а фаза остаётся той, что записал более ранний ход.
+    # expected_version=None — безусловная запись; reset_vars — начать vars заново.
+    current = current or new_state()
+    version = current.get("version", 0)
+    conflict = expected_version is not None and version != expected_version
+    base_vars = {} if reset_vars and not conflict else current.get("vars", {})
+    state = {
+        "phase": current.get("phase", "phase1") if conflict else phase,
+        "vars": {**base_vars, **vars_update},
+        "version": version + 1,
+    }
+    return state, conflict
+
+
+def encode_phase(phase: str):
+    # Неизвестная фаза хранится строкой
+    return _PHASE_INDEX.get(phase, phase)
+
+
+def decode_phase(code) -> str:
+    return PHASE_CODES[code] if isinstance(code, int) and 0 <= code < len(PHASE_CODES) else str(code)
+
+
+def encode_vars(vars: Dict[str, Any]) -> Dict[str, Any]:
+    encoded = {}
+    for name, value in vars.items():
+        if value is None:
+            continue
+        index = _SLOT_INDEX.get(name)
+        if index is not None and isinstance(value, str) and value in index:
+            value = index[value]
+        encoded[VAR_CODES.get(name, name)] = value
+    return encoded
+
+
+def decode_vars(encoded) -> Dict[str, Any]:
+    # Пустой vars из Lua (cmsgpack) приходит пустым массивом
+    if not isinstance(encoded, dict):
+        return {}
+    vars = {}
+    for code, value in encoded.items():
+        name = _VAR_NAMES.get(code, code)
+        values = SLOT_CODES.get(name)
+        if values is not None and type(value) is int and 0 <= value < len(values):
+            value = values[value]
+        vars[name] = value
+    return vars
+
+
+def encode_state(state: Dict[str, Any]) -> bytes:
+    if STATE_WRITE_FORMAT == "json":
+        return json.dumps(state).encode("utf-8")
+    return msgpack.packb([
+        STATE_SCHEMA,
+        encode_phase(state.get("phase", "phase1")),
+        state.get("version", 0),
+        encode_vars(state.get("vars", {})),
+    ])
+
+
+def is_compact(data: bytes) -> bool:
+    # Устаревший формат — JSON-объект
+    return not data.startswith(b"{")
+
+
+def is_current(data: bytes) -> bool:
+    # Состояние уже в формате (и схеме) записи
+    if STATE_WRITE_FORMAT == "json":
+        return not is_compact(data)
+    return is_compact(data) and msgpack.unpackb(data, raw=False)[0] == STATE_SCHEMA
+
+
+def decode_state(data: bytes) -> Dict[str, Any]:
+    if not is_compact(data):
+        return json.loads(data)
+    schema, phase, version, vars = msgpack.unpackb(data, raw=False)[:4]
+    return {"phase": decode_phase(phase), "vars": decode_vars(vars), "version": version}
+
+
+class StateBackend:
+    # Общий интерфейс хранилищ состояния; считает задержку каждой операции
+    name = "base"
+
+    def __init__(self):
+        self.latency: Dict[str, list] = {}  # op -> [count, total_s, max_s]
+
+    def _record(self, op: str, started: float):
+        elapsed = time.perf_counter() - started
+        entry = self.latency.setdefault(op, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+
+    async def load(self, user_id: str) -> Optional[Dict[str, Any]]:
+        started = time.perf_counter()
+        try:
+            return await self._load(user_id)
+        finally:
+            self._record("load", started)
+
+    async def save(self, user_id: str, state: Dict[str, Any]):
+        started = time.perf_counter()
+        try:
+            await self._save(user_id, state)
+        finally:
+            self._record("save", started)
+
+    async def update(self, user_id: str, expected_version: Optional[int], phase: str,
+                     vars_update: Dict[str, Any], reset_vars: bool = False) -> Tuple[Dict[str, Any], bool]:
+        started = time.perf_counter()
+        try:
+            return await self._update(user_id, expected_version, phase, vars_update, reset_vars)
+        finally:
+            self._record("update", started)
+
+    async def touch(self, user_id: str):
+        # Продлить TTL состояния без чтения
+        return None
+
+    async def ping(self):
+        # Проверка доступности хранилища для /ready; бросает исключение, если оно недоступно
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "ops": {
+                op: {"count": n, "avg_ms": round(total / n * 1000, 3), "max_ms": round(worst * 1000, 3)}
+                for op, (n, total, worst) in self.latency.items()
+            },
+        }
+
+
+# Атомарный read-modify-write за один round trip; та же логика, что в apply_update.
+# Состояние не в формате записи не трогаем и возвращаем -1: клиент перепишет его и повторит.
+_JSON_UPDATE_SCRIPT = """
+local data = redis.call('GET', KEYS[1])
+if data and string.sub(data, 1, 1) ~= '{' then return {data, -1} end
+local state = data and cjson.decode(data) or {phase = 'phase1', vars = {}}
+local version = tonumber(state['version'] or 0)
+local expected = tonumber(ARGV[1])
+local conflict = expected >= 0 and version ~= expected
+local vars = state['vars'] or {}
+if ARGV[4] == '1' and not conflict then vars = {} end
+for k, v in pairs(cjson.decode(ARGV[3])) do vars[k] = v end
+if not conflict then state['phase'] = ARGV[2] end
+state['vars'] = vars
+state['version'] = version + 1
+local encoded = cjson.encode(state)
+redis.call('SETEX', KEYS[1], ARGV[5], encoded)
+return {encoded, conflict and 1 or 0}
+"""
+
+# Компактный вариант: фаза и vars приходят уже закодированными (encode_phase/encode_vars),
+# слияние — по кодам. nil в Lua-таблице не хранится, поэтому переменные со значением None
+# передаются отдельным списком (ARGV[7]) и удаляются
+_COMPACT_UPDATE_SCRIPT = """
+local schema = tonumber(ARGV[6])
+local data = redis.call('GET', KEYS[1])
+local state = {schema, 0, 0, {}}
+if data then
+  if string.sub(data, 1, 1) == '{' then return {data, -1} end
+  state = cmsgpack.unpack(data)
+  if state[1] ~= schema then return {data, -1} end
+end
+local version = tonumber(state[3] or 0)
+local expected = tonumber(ARGV[1])
+local conflict = expected >= 0 and version ~= expected
+local vars = state[4] or {}
+if ARGV[4] == '1' and not conflict then vars = {} end
+for k, v in pairs(cmsgpack.unpack(ARGV[3])) do vars[k] = v end
+for _, k in ipairs(cmsgpack.unpack(ARGV[7])) do vars[k] = nil end
+if not conflict then state[2] = cmsgpack.unpack(ARGV[2]) end
+state[4] = vars
+state[3] = version + 1
+local encoded = cmsgpack.pack(state)
+redis.call('SETEX', KEYS[1], ARGV[5], encoded)
+return {encoded, conflict and 1 or 0}
+"""
+
+# Перезапись в формат записи, только если состояние не изменилось с момента чтения
+_MIGRATE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  redis.call('SETEX', KEYS[1], ARGV[3], ARGV[2])
+  return 1
+end
+return 0
+"""
+
+
+class RedisStateBackend(StateBackend):
+    name = "redis"
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self._json_update = client.register_script(_JSON_UPDATE_SCRIPT)
+        self._compact_update = client.register_script(_COMPACT_UPDATE_SCRIPT)
+        self._migrate_script = client.register_script(_MIGRATE_SCRIPT)
+        self.migrated = 0
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"dialog_state:{user_id}"
+
+    async def ping(self):
+        await self.client.ping()
+
+    async def touch(self, user_id: str):
+        await self.client.expire(self._key(user_id), STATE_TTL)
+
+    async def _load(self, user_id: str) -> Optional[Dict[str, Any]]:
+        # GET и продление TTL одним пайплайном, без перезаписи всего состояния
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.get(self._key(user_id))
+            pipe.expire(self._key(user_id), STATE_TTL)
+            data, _ = await pipe.execute()
+        return decode_state(data) if data else None
+
+    async def _save(self, user_id: str, state: Dict[str, Any]):
+        await self.client.setex(self._key(user_id), STATE_TTL, encode_state(state))
+
+    async def migrate(self, user_id: str, data: bytes) -> bool:
+        # Состояние в другом формате (или прошлой схеме) -> формат записи; False — его успели изменить
+        migrated = await self._migrate_script(
+            keys=[self._key(user_id)], args=[data, encode_state(decode_state(data)), STATE_TTL]
+        )
+        self.migrated += migrated
+        return bool(migrated)
+
+    async def _update(self, user_id, expected_version, phase, vars_update, reset_vars):
+        expected = -1 if expected_version is None else expected_version
+        reset = "1" if reset_vars else "0"
+        if STATE_WRITE_FORMAT == "json":
+            script = self._json_update
+            args = [expected, phase, json.dumps(vars_update), reset, STATE_TTL]
+        else:
+            script = self._compact_update
+            removed = [VAR_CODES.get(name, name) for name, value in vars_update.items() if value is None]
+            args = [
+                expected,
+                msgpack.packb(encode_phase(phase)),
+                msgpack.packb(encode_vars(vars_update)),
+                reset,
+                STATE_TTL,
+                STATE_SCHEMA,
+                msgpack.packb(removed),
+            ]
+        # Второй проход — после перезаписи состояния в формат записи
+        for _ in range(3):
+            encoded, conflict = await script(keys=[self._key(user_id)], args=args)
+            if conflict != -1:
+                return decode_state(encoded), bool(conflict)
+            await self.migrate(user_id, encoded)
+        raise RuntimeError(f"Состояние {user_id} не удалось перевести в формат {STATE_WRITE_FORMAT}")
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["migrated"] = self.migrated
+        return stats
+
+
+class MemoryStateBackend(StateBackend):
+    # Хранилище без Redis; состояния хранятся сериализованными, как в Redis
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self._data: Dict[str, Tuple[float, bytes]] = {}
+
+    def _get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        item = self._data.get(user_id)
+        if not item or item[0] < time.monotonic():
+            self._data.pop(user_id, None)
+            return None
+        return decode_state(item[1])
+
+    def _put(self, user_id: str, state: Dict[str, Any]):
+        self._data[user_id] = (time.monotonic() + STATE_TTL, encode_state(state))
+
+    async def _load(self, user_id: str) -> Optional[Dict[str, Any]]:
+        state = self._get(user_id)
+        if state is not None:
+            self._put(user_id, state)
+        return state
+
+    async def _save(self, user_id: str, state: Dict[str, Any]):
+        self._put(user_id, state)
+
+    async def touch(self, user_id: str):
+        item = self._data.get(user_id)
+        if item and item[0] >= time.monotonic():
+            self._data[user_id] = (time.monotonic() + STATE_TTL, item[1])
+
+    async def _update(self, user_id, expected_version, phase, vars_update, reset_vars):
+        state, conflict = apply_update(self._get(user_id), expected_version, phase, vars_update, reset_vars)
+        self._put(user_id, state)
+        return state, conflict
+
+
+class CachedStateBackend(StateBackend):
+    # Короткоживущий кэш чтения поверх другого хранилища со сквозной записью.
+    # Устаревшее чтение безопасно: update сверяет version и сливает vars.
+    def __init__(self, inner: StateBackend, ttl: float, maxsize: int = 10000):
+        super().__init__()
+        self.inner = inner
+        self.name = f"cached+{inner.name}"
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Когда TTL в хранилище продлевался последний раз: активный диалог, читаемый
+        # из кэша, не должен истечь посреди разговора
+        self._touched = TTLCache(maxsize=maxsize, ttl=STATE_TOUCH_INTERVAL)
+
+    async def ping(self):
+        await self.inner.ping()
+
+    async def touch(self, user_id: str):
+        await self.inner.touch(user_id)
+
+    async def _load(self, user_id: str) -> Optional[Dict[str, Any]]:
+        state = self.cache.get(user_id)
+        if state is None:
+            # Чтение из хранилища само продлевает TTL
+            state = await self.inner.load(user_id)
+            if state is not None:
+                self.cache.set(user_id, state)
+                self._touched.set(user_id, True)
+        elif self._touched.get(user_id) is None:
+            self._touched.set(user_id, True)
+            try:
+                await self.inner.touch(user_id)
+            except Exception as e:
+                logger.warning(f"Не удалось продлить TTL состояния {user_id}: {e}")
+        return copy.deepcopy(state)
+
+    async def _save(self, user_id: str, state: Dict[str, Any]):
+        await self.inner.save(user_id, state)
+        self.cache.set(user_id, copy.deepcopy(state))
+        self._touched.set(user_id, True)
+
+    async def _update(self, user_id, expected_version, phase, vars_update, reset_vars):
+        state, conflict = await self.inner.update(user_id, expected_version, phase, vars_update, reset_vars)
+        self.cache.set(user_id, copy.deepcopy(state))
+        self._touched.set(user_id, True)
+        return state, conflict
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.inner.stats()
+        stats["backend"] = self.name
+        stats["cache"] = {"hits": self.cache.hits, "misses": self.cache.misses, "size": len(self.cache)}
+        return stats
+
+
+def create_backend() -> StateBackend:
+    if STATE_BACKEND == "memory":
+        backend = MemoryStateBackend()
+    else:
+        # Состояния бинарные (msgpack), ответы Redis не декодируются
+        backend = RedisStateBackend(redis.from_url(REDIS_URL))
+    if STATE_CACHE_TTL > 0:
+        backend = CachedStateBackend(backend, ttl=STATE_CACHE_TTL)
+    return backend
+
+
+backend = create_backend()
+
 
 async def get_dialog_state(user_id: str) -> Optional[Dict[str, Any]]:
-    data = await redis_client.get(f"dialog_state:{user_id}")
-    return json.loads(data) if data else None
+    return await backend.load(user_id)
 
 async def save_dialog_state(user_id: str, state: Dict[str, Any]):
-    await redis_client.setex(f"dialog_state:{user_id}", 7200, json.dumps(state))  # 2 часа
\ No newline at end of file
+    await backend.save(user_id, state)
+
+async def update_dialog_state(
+    user_id: str,
+    expected_version: Optional[int],
+    phase: str,
+    vars_update: Dict[str, Any],
+    reset_vars: bool = False,
+) -> Tuple[Dict[str, Any], bool]:
+    # Атомарный переход состояния без блокировок на время хода. Возвращает (state, conflict).
+    state, conflict = await backend.update(user_id, expected_version, phase, vars_update, reset_vars)
+    if conflict:
+        logger.warning(f"Конкурентное обновление состояния {user_id}: ожидалась v{expected_version}")
+    return state, conflict
+
+def state_stats() -> Dict[str, Any]:
+    return backend.stats()
+
+
+async def ping_state():
+    await backend.ping()
+
+
+async def memory_report(sample: int, dialogs: int, migrate: bool = False) -> Dict[str, Any]:
+    # Обход dialog_state:* через SCAN; MEMORY USAGE (с накладными расходами ключа) — по выборке
+    client = redis.from_url(REDIS_URL)
+    store = RedisStateBackend(client)
+    keys, sampled, formats = 0, [], {"compact": 0, "json": 0}
+    async for key in client.scan_iter(match="dialog_state:*", count=1000):
+        keys += 1
+        if len(sampled) < sample:
+            sampled.append(key)
+    rows: List[Tuple[str, int, int]] = []
+    for start in range(0, len(sampled), 500):
+        batch = sampled[start:start + 500]
+        async with client.pipeline(transaction=False) as pipe:
+            for key in batch:
+                pipe.memory_usage(key, samples=0)
+                pipe.get(key)
+            results = await pipe.execute()
+        for key, usage, data in zip(batch, results[::2], results[1::2]):
+            if data is None:
+                continue
+            compact = is_compact(data)
+            formats["compact" if compact else "json"] += 1
+            if migrate and not is_current(data):
+                await store.migrate(key.decode().split(":", 1)[1], data)
+            rows.append((key.decode(), usage or 0, len(data)))
+    info = await client.info("memory")
+    await client.aclose()
+    avg = sum(usage for _, usage, _ in rows) / len(rows) if rows else 0
+    return {
+        "keys": keys,
+        "sampled": len(rows),
+        "formats": formats,
+        "write_format": STATE_WRITE_FORMAT,
+        "migrated": store.migrated,
+        "avg_key_bytes": round(avg, 1),
+        "avg_value_bytes": round(sum(size for _, _, size in rows) / len(rows), 1) if rows else 0,
+        "largest": [{"key": key, "bytes": usage} for key, usage, _ in sorted(rows, key=lambda r: -r[1])[:5]],
+        "estimated_state_bytes": round(avg * keys),
+        "projected_bytes": {str(dialogs): round(avg * dialogs)},
+        "redis_used_memory": info.get("used_memory"),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Память Redis под состояния диалогов")
+    parser.add_argument("--sample", type=int, default=1000, help="сколько ключей измерять через MEMORY USAGE")
+    parser.add_argument("--dialogs", type=int, default=100000, help="прогноз на столько активных диалогов")
+    parser.add_argument("--migrate", action="store_true", help="переписать состояния выборки в формат STATE_WRITE_FORMAT")
+    args = parser.parse_args()
+    report = asyncio.run(memory_report(args.sample, args.dialogs, args.migrate))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
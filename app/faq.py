@@ -0,0 +1,136 @@
+# app/faq.py
+# Индекс готовых ответов: разделы knowledge/*.md с известными заголовками ("Цены", "Контакты")
+# превращаются в ответы по намерениям. Частые фактические вопросы ("сколько стоит",
+# "какой телефон") отвечаются из индекса без вызова LLM, фаза диалога не меняется.
+#
+# Проверить, что попало в индекс:
+#   python -m app.faq
+import os
+import re
+import sys
+import json
+import logging
+from typing import Dict, NamedTuple, Optional
+
+from .config import KNOWLEDGE_DIR
+from .metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+FAQ_ENABLED = os.getenv("FAQ_ENABLED", "1") == "1"
+# Длинные сообщения обычно содержат ответ на вопрос фазы — их отдаём фазе
+FAQ_MAX_WORDS = int(os.getenv("FAQ_MAX_WORDS", "8"))
+
+# Намерение -> заголовки разделов, из которых берётся ответ, и признаки вопроса
+FAQ_INTENTS = {
+    "prices": {
+        "headings": ("цены", "стоимость", "тарифы", "прайс"),
+        "question": re.compile(r"сколько\s+сто|\bцен[аыуе]?\b|стоимост|прайс|тариф|почем"),
+    },
+    "contacts": {
+        "headings": ("контакты", "связь"),
+        "question": re.compile(r"телефон|контакт|e-?mail|почт[аыу]|как\s+(?:с\s+вами\s+)?связаться"),
+    },
+}
+# Фазы, где пользователь сам сообщает контакты: "мой телефон ..." — не вопрос к нам
+SKIP_INTENTS = {
+    "phase6A": {"contacts"},
+    "phase7": {"contacts"},
+}
+# Отвечаем только на вопросы: знак вопроса или вопросительное начало фразы
+_QUESTION_PATTERN = re.compile(
+    r"\?|^(?:а\s+)?(?:как|какой|какая|какие|каков|сколько|где|почем|дайте|подскажите|скажите|напишите)\b"
+)
+# Телефон или email в сообщении — это ответ клиента, а не вопрос
+_CONTACT_PATTERN = re.compile(r"(?:\+7|8|7)(?:[\s\-()]*\d){10}|[\w.+-]+@[\w-]+\.\w+")
+_HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.+?)\s*#*$")
+
+RESUME_HINT = "Если хотите, вернёмся к моему предыдущему вопросу 🙂"
+
+faq_answers = Counter("faq_answers_total", "Ответы из индекса FAQ без LLM", ["intent"], {"intent": FAQ_INTENTS})
+
+
+class FaqEntry(NamedTuple):
+    intent: str
+    heading: str
+    answer: str
+    source: str
+
+
+faq_index: Dict[str, FaqEntry] = {}
+
+
+def _sections(text: str):
+    # (заголовок, тело) для каждого раздела markdown-документа
+    heading, body = None, []
+    for line in text.splitlines():
+        match = _HEADING_PATTERN.match(line.strip())
+        if match:
+            if heading is not None:
+                yield heading, "\n".join(body).strip()
+            heading, body = match.group(2), []
+        elif heading is not None:
+            body.append(line.rstrip())
+    if heading is not None:
+        yield heading, "\n".join(body).strip()
+
+
+def build_faq(knowledge_dir: str = KNOWLEDGE_DIR) -> Dict[str, FaqEntry]:
+    index: Dict[str, FaqEntry] = {}
+    if not os.path.exists(knowledge_dir):
+        return index
+    for root, dirs, files in os.walk(knowledge_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for filename in sorted(files):
+            if filename.startswith(".") or not filename.endswith((".md", ".txt")):
+                continue
+            filepath = os.path.join(root, filename)
+            with open(filepath, encoding="utf-8") as f:
+                text = f.read()
+            for heading, body in _sections(text):
+                key = heading.lower().replace("ё", "е").strip(" :")
+                for intent, spec in FAQ_INTENTS.items():
+                    # Первый найденный раздел по намерению выигрывает
+                    if key in spec["headings"] and body and intent not in index:
+                        index[intent] = FaqEntry(intent, heading, body, os.path.relpath(filepath, knowledge_dir))
+    return index
+
+
+def reload_faq(knowledge_dir: str = KNOWLEDGE_DIR):
+    # Вызывается при активации новой версии индекса базы знаний
+    global faq_index
+    faq_index = build_faq(knowledge_dir)
+    logger.info(f"Индекс FAQ: {', '.join(sorted(faq_index)) or 'пусто'}")
+
+
+def match_faq(text: str, phase: str) -> Optional[FaqEntry]:
+    # Ответ только при однозначном совпадении: короткий вопрос ровно про одно намерение
+    index = faq_index
+    if not FAQ_ENABLED or not index or len(text.split()) > FAQ_MAX_WORDS:
+        return None
+    lowered = text.lower().replace("ё", "е").strip()
+    if _CONTACT_PATTERN.search(text) or not _QUESTION_PATTERN.search(lowered):
+        return None
+    skip = SKIP_INTENTS.get(phase, set())
+    matched = [
+        intent for intent, spec in FAQ_INTENTS.items()
+        if intent in index and intent not in skip and spec["question"].search(lowered)
+    ]
+    return index[matched[0]] if len(matched) == 1 else None
+
+
+def faq_reply(entry: FaqEntry, phase: str) -> str:
+    faq_answers.inc(intent=entry.intent)
+    reply = f"{entry.heading}:\n{entry.answer}"
+    # В начале воронки возвращаться не к чему
+    return reply if phase == "phase1" else f"{reply}\n\n{RESUME_HINT}"
+
+
+def main() -> int:
+    index = build_faq()
+    print(json.dumps({k: v._asdict() for k, v in index.items()}, ensure_ascii=False, indent=2))
+    return 0 if index else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+# app/ingest.py
+# Потоковая загрузка базы знаний: парсинг в пуле процессов -> чанки генератором ->
+# эмбеддинги батчами с ограничением параллелизма и ретраями -> дозапись в FAISS.
+#
+# Сборка индекса заранее (например, при сборке образа):
+#   python -m app.ingest [--index-dir /app/index] [--force]
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_BATCH_CHARS = int(os.getenv("EMBED_BATCH_CHARS", "60000"))
+EMBED_WORKERS = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_RETRIES = int(os.getenv("EMBED_RETRIES", "5"))
+
+Chunk = Tuple[str, str, dict]  # (chunk_id, text, metadata)
+
+
+def parse_file(filepath: str) -> List[Tuple[str, dict]]:
+    # Выполняется в дочернем процессе, поэтому возвращаем простые кортежи, а не Document
+    from langchain_community.document_loaders import TextLoader, PyPDFLoader
+
+    if filepath.endswith(".pdf"):
+        docs = PyPDFLoader(filepath).load()
+    else:
+        docs = TextLoader(filepath, encoding="utf-8").load()
+    return [(d.page_content, d.metadata) for d in docs]
+
+
+def _parsed_pages(relpath: str, result: Callable[[], List]) -> List:
+    try:
+        pages = result()
+    except Exception as e:
+        logger.error(f"Ошибка {relpath}: {e}")
+        return []
+    logger.info(f"Загружен: {relpath}")
+    return pages
+
+
+def iter_parsed(files: List[Tuple[str, str]], knowledge_dir: str,
+                workers: int = INGEST_WORKERS) -> Iterator[Tuple[str, str, List]]:
+    # files: [(relpath, sha256)]; отдаёт файлы по порядку, держа в памяти не больше окна
+    if workers <= 1 or len(files) <= 1:
+        for relpath, digest in files:
+            filepath = os.path.join(knowledge_dir, relpath)
+            yield relpath, digest, _parsed_pages(relpath, lambda: parse_file(filepath))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window = deque()
+        for relpath, digest in files:
+            future = pool.submit(parse_file, os.path.join(knowledge_dir, relpath))
+            window.append((relpath, digest, future))
+            if len(window) >= workers * 2:
+                relpath, digest, future = window.popleft()
+                yield relpath, digest, _parsed_pages(relpath, future.result)
+        while window:
+            relpath, digest, future = window.popleft()
+            yield relpath, digest, _parsed_pages(relpath, future.result)
+
+
+def iter_chunks(parsed: Iterable[Tuple[str, str, List]], splitter,
+                chunk_ids: Dict[str, List[str]]) -> Iterator[Chunk]:
+    # chunk_ids заполняется по ходу: relpath -> ID его чанков (для манифеста)
+    for relpath, digest, pages in parsed:
+        ids = chunk_ids.setdefault(relpath, [])
+        for text, metadata in pages:
+            for piece in splitter.split_text(text):
+                chunk_id = f"{relpath}#{digest[:12]}:{len(ids)}"
+                ids.append(chunk_id)
+                yield chunk_id, piece, dict(metadata)
+
+
+def iter_batches(chunks: Iterable[Chunk], max_items: int = EMBED_BATCH_SIZE,
+                 max_chars: int = EMBED_BATCH_CHARS) -> Iterator[List[Chunk]]:
+    batch, size = [], 0
+    for chunk in chunks:
+        if batch and (len(batch) >= max_items or size + len(chunk[1]) > max_chars):
+            yield batch
+            batch, size = [], 0
+        batch.append(chunk)
+        size += len(chunk[1])
+    if batch:
+        yield batch
+
+
+def embed_with_retry(embeddings, texts: List[str], retries: int = EMBED_RETRIES) -> List[List[float]]:
+    for attempt in range(retries + 1):
+        try:
+            return embeddings.embed_documents(texts)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = min(30.0, 0.5 * 2 ** attempt) * (0.5 + random.random())
+            logger.warning(f"Ошибка эмбеддингов ({e}), повтор через {delay:.1f} с")
+            time.sleep(delay)
+
+
+def embed_batches(batches: Iterable[List[Chunk]], embeddings,
+                  on_batch: Callable[[List[Chunk], List[List[float]]], None],
+                  workers: int = EMBED_WORKERS):
+    # Не больше workers батчей в полёте: генератор чанков читается по мере освобождения слотов
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        window = deque()
+        for batch in batches:
+            window.append((batch, pool.submit(embed_with_retry, embeddings, [c[1] for c in batch])))
+            if len(window) >= workers:
+                done_batch, future = window.popleft()
+                on_batch(done_batch, future.result())
+        while window:
+            done_batch, future = window.popleft()
+            on_batch(done_batch, future.result())
+
+
+def ingest_files(files: List[Tuple[str, str]], knowledge_dir: str, embeddings, splitter,
+                 store=None, workers: int = INGEST_WORKERS):
+    # Возвращает (store, {relpath: [chunk_id, ...]}); store создаётся при первом батче
+    from langchain_community.vectorstores import FAISS
+
+    chunk_ids: Dict[str, List[str]] = {}
+    total = 0
+
+    def append(batch: List[Chunk], vectors: List[List[float]]):
+        nonlocal store, total
+        text_embeddings = [(c[1], v) for c, v in zip(batch, vectors)]
+        metadatas = [c[2] for c in batch]
+        ids = [c[0] for c in batch]
+        if store is None:
+            store = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+        else:
+            store.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        total += len(batch)
+
+    parsed = iter_parsed(files, knowledge_dir, workers=workers)
+    embed_batches(iter_batches(iter_chunks(parsed, splitter, chunk_ids)), embeddings, append)
+    logger.info(f"Проиндексировано чанков: {total} из {len(files)} файлов")
+    return store, chunk_ids
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Сборка FAISS-индекса базы знаний")
+    parser.add_argument("--index-dir", help="каталог версий индекса (FAISS_INDEX_DIR)")
+    parser.add_argument("--force", action="store_true", help="пересобрать индекс с нуля")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.index_dir:
+        os.environ["FAISS_INDEX_DIR"] = args.index_dir
+
+    from . import rag
+
+    started = time.monotonic()
+    if args.force:
+        os.makedirs(rag.INDEX_DIR, exist_ok=True)
+        store, version = rag.build_index(rag.scan_knowledge())
+    else:
+        store = rag.create_or_load_vectorstore()
+        version = rag.index_version
+    if store is None:
+        logger.error("Индекс не создан: нет документов")
+        return 1
+    logger.info(f"Индекс {version} готов за {time.monotonic() - started:.1f} с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# app/lexical.py
+# Локальный лексический индекс (BM25) по тем же чанкам, что и FAISS.
+# База знаний — короткие FAQ про цены и контакты: для большинства вопросов совпадения
+# по словам хватает, и эмбеддинг запроса через API не нужен.
+import math
+import heapq
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+from .cache import normalize_text
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = {
+    "и", "в", "во", "не", "что", "он", "на", "я", "с", "со", "как", "а", "то", "все", "она",
+    "так", "его", "но", "да", "ты", "к", "у", "же", "вы", "за", "бы", "по", "только", "ее",
+    "мне", "было", "вот", "от", "меня", "еще", "нет", "о", "из", "ему", "когда", "ну", "ли",
+    "если", "уже", "или", "ни", "быть", "был", "до", "вас", "вам", "ведь", "там", "себя",
+    "ей", "может", "они", "тут", "где", "есть", "надо", "для", "мы", "их", "чем", "была",
+    "без", "чего", "под", "будет", "ж", "кто", "этот", "того", "этого", "какой", "какая",
+    "какие", "здесь", "этом", "мой", "тем", "чтобы", "можно", "при", "об", "про", "эти",
+    "нас", "это", "ваш", "ваши", "наш", "пожалуйста", "подскажите", "скажите",
+}
+
+# Окончания для упрощённого стемминга русских слов, от длинных к коротким
+_ENDINGS = sorted({
+    "иями", "ями", "ами", "ией", "иях", "ях", "ах", "ов", "ев", "ей", "ий", "ый", "ой",
+    "ая", "яя", "ое", "ее", "ые", "ие", "ого", "его", "ому", "ему", "ыми", "ими", "ым", "им",
+    "ом", "ем", "ую", "юю", "ться", "тся", "ть", "ет", "ют", "ут", "ат", "ят", "ит", "ешь",
+    "ишь", "ия", "ья", "ье", "ию", "ью", "ии", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+}, key=len, reverse=True)
+MIN_STEM = 3
+
+
+def stem(word: str) -> str:
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    return [stem(w) for w in normalize_text(text).split() if w not in STOPWORDS]
+
+
+class LexicalIndex:
+    # BM25 по списку документов; поиск — чистый Python, для нескольких сотен чанков
+    # это доли миллисекунды
+    def __init__(self, docs: List):
+        self.docs = docs
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.lengths: List[int] = []
+        for i, doc in enumerate(docs):
+            terms = tokenize(doc.page_content)
+            self.lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                self.postings[term].append((i, tf))
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        self.idf = {
+            term: math.log(1 + (len(docs) - len(posting) + 0.5) / (len(posting) + 0.5))
+            for term, posting in self.postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def search(self, text: str, k: int) -> Tuple[List[Tuple[object, float]], float]:
+        # -> ([(документ, score)], покрытие): покрытие — доля значимых слов запроса,
+        # найденных в лучшем документе; по нему решаем, можно ли обойтись без векторов
+        query = list(dict.fromkeys(tokenize(text)))
+        terms = [t for t in query if t in self.postings]
+        if not terms:
+            return [], 0.0
+        scores: Dict[int, float] = defaultdict(float)
+        matched: Dict[int, int] = defaultdict(int)
+        for term in terms:
+            idf = self.idf[term]
+            for i, tf in self.postings[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[i] / (self.avg_length or 1))
+                scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                matched[i] += 1
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        coverage = matched[top[0][0]] / len(query)
+        return [(self.docs[i], score) for i, score in top], coverage
+
+
+def fuse(*rankings: List, k: int, rrf_k: int = 60) -> List:
+    # Reciprocal Rank Fusion: документы из нескольких выдач, одинаковый текст — один документ
+    scores: Dict[str, float] = defaultdict(float)
+    docs: Dict[str, object] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            docs.setdefault(doc.page_content, doc)
+            scores[doc.page_content] += 1 / (rrf_k + rank + 1)
+    best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+    return [docs[content] for content, _ in best]
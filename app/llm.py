@@ -0,0 +1,441 @@
+# app/llm.py
+# Единый шлюз к OpenAI: один клиент на процесс, цепочки собираются один раз,
+# общий лимитер RPM/TPM/параллелизма с приоритетом для фаз ближе к сбору лида.
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+
+from .llm_cache import cached_reply
+from .metrics import Collected, Counter, Histogram, stage_seconds
+from .tokens import count_tokens, get_encoding, truncate_tokens
+from .tracing import annotate, span
+
+logger = logging.getLogger(__name__)
+
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o")
+LLM_RPM = int(os.getenv("LLM_RPM", "500"))
+LLM_TPM = int(os.getenv("LLM_TPM", "30000"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+# Верхняя оценка ответа в токенах для резерва TPM (ответы фаз — до 400 символов)
+LLM_REPLY_TOKENS = int(os.getenv("LLM_REPLY_TOKENS", "300"))
+# Дольше ждать квоту лимитера бессмысленно: отвечаем шаблоном фазы (LLMOverloaded)
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+# Запасная дешёвая модель для режима деградации; пусто — деградация в шаблонные ответы фаз
+LLM_SECONDARY_MODEL = os.getenv("LLM_SECONDARY_MODEL", "")
+LLM_SECONDARY_CONCURRENCY = int(os.getenv("LLM_SECONDARY_CONCURRENCY", "8"))
+# Лимиты OpenAI у каждой модели свои; по умолчанию — как у основной
+LLM_SECONDARY_RPM = int(os.getenv("LLM_SECONDARY_RPM", str(LLM_RPM)))
+LLM_SECONDARY_TPM = int(os.getenv("LLM_SECONDARY_TPM", str(LLM_TPM)))
+# Бюджет входа (шаблон + подставленные переменные) на вызов, токенов
+LLM_INPUT_BUDGET = int(os.getenv("LLM_INPUT_BUDGET", "1500"))
+# Цепочки с большим шаблоном (structured output, инструкции формата)
+INPUT_BUDGETS = {
+    "turn": int(os.getenv("TURN_INPUT_BUDGET", "3000")),
+    "qualify": int(os.getenv("QUALIFY_INPUT_BUDGET", "1200")),
+}
+# Что урезаем при превышении бюджета — по порядку; остальное подставляется как есть
+TRIMMABLE_INPUTS = ("context", "message", "input")
+
+# Меньше — важнее: чем ближе ход к сбору контактов, тем раньше он получает квоту
+PRIORITY = {
+    "qualify": 0,
+    "phase6A": 0,
+    "phase5A": 1,
+    "phase4A": 2,
+    "phase3A": 3,
+    "phase2A": 4,
+    "phase1": 5,
+}
+
+# Клиенты OpenAI создаются при первой сборке цепочки, а не при импорте
+llm = None
+secondary_llm = None
+
+# Поток ответа текущего хода (TelegramReplyStream); если задан, generate() стримит токены
+reply_stream: ContextVar[Optional[Any]] = ContextVar("reply_stream", default=None)
+# Модель текущего хода: "primary" или "secondary" (режим деградации, см. admission)
+model_tier: ContextVar[str] = ContextVar("model_tier", default="primary")
+
+
+class LLMOverloaded(Exception):
+    # Квота лимитера не получена за LLM_QUEUE_TIMEOUT
+    pass
+
+
+class PriorityLimiter:
+    # Token bucket на запросы и токены в минуту плюс ограничение одновременных вызовов.
+    # Ожидающие обслуживаются по приоритету, при равном приоритете — по очереди.
+    def __init__(self, rpm: int, tpm: int, concurrency: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.concurrency = concurrency
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.in_flight = 0
+        self.throttled = 0
+        self._updated = time.monotonic()
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._cond = asyncio.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, tokens: int, count: int = 1) -> Optional[float]:
+        # None — ждём освобождения слотов параллелизма, а не пополнения ведра
+        if self.in_flight + count > self.concurrency:
+            return None
+        missing_requests = max(0.0, count - self.requests) * 60 / self.rpm
+        missing_tokens = max(0.0, tokens - self.tokens) * 60 / self.tpm
+        return max(missing_requests, missing_tokens)
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def max_count(self) -> int:
+        # Больше слотов за раз не выдать никогда: пачки крупнее режутся вызывающим
+        return max(1, min(self.concurrency, self.rpm))
+
+    async def acquire(self, tokens: int, priority: int = 5, count: int = 1):
+        # count слотов (пачка вызовов) выдаются целиком или не выдаются вовсе: поштучный
+        # захват пачками, которые держат слоты до конца, взаимно блокируется
+        if count > self.max_count():
+            raise ValueError(f"пачка {count} больше лимита параллелизма {self.max_count()}")
+        tokens = min(tokens, self.tpm)
+        entry = (priority, next(self._seq))
+        async with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    self._refill()
+                    wait = self._wait_time(tokens, count)
+                    if self._waiters[0] == entry and wait == 0:
+                        heapq.heappop(self._waiters)
+                        self.requests -= count
+                        self.tokens -= tokens
+                        self.in_flight += count
+                        self._cond.notify_all()
+                        return
+                    self.throttled += 1
+                    timeout = wait if self._waiters[0] == entry and wait else None
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                raise
+
+    async def release(self, reserved_tokens: int = 0, used_tokens: Optional[int] = None, count: int = 1):
+        async with self._cond:
+            self.in_flight -= count
+            if used_tokens is not None:
+                # Возвращаем в ведро разницу между резервом и фактическим расходом
+                self.tokens = min(self.tpm, self.tokens + reserved_tokens - used_tokens)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "throttled": self.throttled,
+            "requests_left": round(self.requests, 1),
+            "tokens_left": round(self.tokens),
+        }
+
+
+limiter = PriorityLimiter(LLM_RPM, LLM_TPM, LLM_CONCURRENCY)
+# У запасной модели свои лимиты OpenAI, поэтому и свой лимитер
+secondary_limiter = PriorityLimiter(LLM_SECONDARY_RPM, LLM_SECONDARY_TPM, LLM_SECONDARY_CONCURRENCY)
+# Сглаженная задержка основной модели, секунды — сигнал для режима деградации
+latency_ewma = 0.0
+LATENCY_ALPHA = 0.2
+# Без новых замеров оценка затухает вдвое за столько секунд: в деградации основная модель
+# не вызывается, и без затухания оценка застыла бы выше порога до рестарта
+LATENCY_HALF_LIFE = float(os.getenv("LLM_LATENCY_HALF_LIFE", "30"))
+_latency_at = 0.0
+
+
+def get_chat_model(tier: str = "primary"):
+    global llm, secondary_llm
+    if tier == "secondary":
+        if secondary_llm is None:
+            from langchain_openai import ChatOpenAI
+            secondary_llm = ChatOpenAI(model=LLM_SECONDARY_MODEL, temperature=0, max_retries=1, stream_usage=True)
+        return secondary_llm
+    if llm is None:
+        from langchain_openai import ChatOpenAI
+        llm = ChatOpenAI(model=LLM_MODEL, temperature=0, max_retries=LLM_MAX_RETRIES, stream_usage=True)
+    return llm
+
+
+class Chain:
+    # Шаблон регистрируется при импорте модуля фазы, цепочка собирается при первом обращении
+    # (или заранее в warmup_chains)
+    def __init__(self, name: str, template: str, parser=None, schema=None, partials=None):
+        self.name = name
+        self.template = template
+        self.parser = parser
+        self.schema = schema
+        self.partials = partials or {}
+        self.budget = INPUT_BUDGETS.get(name, LLM_INPUT_BUDGET)
+        self._runnables: Dict[str, Any] = {}
+        self._template_tokens = None
+
+    @property
+    def runnable(self):
+        # Цепочка на модели текущего хода (model_tier)
+        tier = model_tier.get()
+        if tier not in self._runnables:
+            self._runnables[tier] = _compile(self.template, self.parser, self.schema, self.partials, tier)
+        return self._runnables[tier]
+
+    @property
+    def template_tokens(self) -> int:
+        # Постоянная часть промпта: шаблон и вшитые partials (инструкции формата)
+        if self._template_tokens is None:
+            self._template_tokens = count_tokens(self.template) + sum(
+                count_tokens(str(v)) for v in self.partials.values()
+            )
+        return self._template_tokens
+
+    def reset(self):
+        self._runnables = {}
+
+
+chains: Dict[str, Chain] = {}
+
+llm_seconds = Histogram("llm_seconds", "Длительность вызова модели по цепочкам", ["chain"], {"chain": chains})
+llm_tokens = Counter(
+    "llm_tokens_total", "Расход токенов OpenAI по цепочкам", ["chain", "type"],
+    {"chain": chains, "type": {"input", "output"}},
+)
+prompt_tokens = Histogram(
+    "prompt_tokens", "Размер входа вызова модели после бюджета, токенов", ["chain"], {"chain": chains},
+    buckets=(100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000, 8000),
+)
+prompt_trimmed = Counter(
+    "prompt_trimmed_total", "Урезания переменных промпта по бюджету", ["chain", "input"],
+    {"chain": chains, "input": set(TRIMMABLE_INPUTS)},
+)
+Collected(
+    "llm_limiter", "Состояние лимитера LLM", "gauge", ["field"],
+    lambda: [({"field": k}, v) for k, v in limiter.stats().items()],
+)
+def _compile(template: str, parser, schema, partials: Dict[str, Any], tier: str = "primary"):
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.runnables import RunnablePassthrough
+
+    model = get_chat_model(tier)
+    prompt = ChatPromptTemplate.from_template(template)
+    if partials:
+        prompt = prompt.partial(**partials)
+    # Разобранный ответ не несёт usage_metadata: цепочки со schema/parser отдают и сырой
+    # AIMessage ({"raw", "parsed"}), иначе расход токенов и резерв TPM не учитываются
+    if schema is not None:
+        return prompt | model.with_structured_output(schema, include_raw=True)
+    elif parser is not None:
+        return prompt | model | {"raw": RunnablePassthrough(), "parsed": parser}
+    return prompt | model
+
+
+def register_chain(name: str, template: str, parser=None, schema=None, **partials) -> Chain:
+    # Вызывается модулями фаз при импорте; сборка цепочки откладывается до первого вызова.
+    # schema — pydantic-модель для structured output вместо текстового ответа
+    chain = Chain(name, template, parser, schema, partials)
+    chains[name] = chain
+    return chain
+
+
+def set_chat_model(model, tier: str = "primary"):
+    # Подмена модели (бенчмарки, локальные стенды): цепочки пересоберутся при следующем вызове
+    global llm, secondary_llm
+    if tier == "secondary":
+        secondary_llm = model
+    else:
+        llm = model
+    for chain in chains.values():
+        chain.reset()
+
+
+def warmup_chains():
+    # Собирает все цепочки заранее (импорт langchain_openai, клиент OpenAI, кодировка
+    # tiktoken); блокирующая, вызывается из фонового прогрева через asyncio.to_thread
+    get_encoding()
+    for chain in list(chains.values()):
+        chain.runnable
+        chain.template_tokens
+
+
+def trim_inputs(name: str, template: str, template_tokens: int, budget: int,
+                inputs: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    # Урезает TRIMMABLE_INPUTS по порядку, пока template с подставленными inputs не впишется
+    # в budget. -> (входы, токенов во входе); считаются только переменные, которые есть в шаблоне
+    sizes = {k: count_tokens(str(v)) for k, v in inputs.items() if "{" + k + "}" in template}
+    total = template_tokens + sum(sizes.values())
+    if total > budget:
+        inputs = dict(inputs)
+        for key in TRIMMABLE_INPUTS:
+            if total <= budget:
+                break
+            if key not in sizes:
+                continue
+            keep = max(0, sizes[key] - (total - budget))
+            inputs[key] = truncate_tokens(str(inputs[key]), keep)
+            total -= sizes[key] - keep
+            prompt_trimmed.inc(chain=name, input=key)
+        logger.info(f"Промпт {name} урезан до бюджета {budget} токенов")
+    return inputs, total
+
+
+def fit_inputs(chain: Chain, inputs: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    # Вписывает вход в бюджет цепочки
+    inputs, total = trim_inputs(chain.name, chain.template, chain.template_tokens, chain.budget, inputs)
+    prompt_tokens.observe(total, chain=chain.name)
+    return inputs, total
+
+
+def _raw(response):
+    # Ответ модели с usage_metadata: у structured-цепочек — в "raw"
+    return response["raw"] if isinstance(response, dict) and "raw" in response else response
+
+
+def _parsed(response):
+    if isinstance(response, dict) and "raw" in response:
+        if response.get("parsing_error") is not None:
+            raise response["parsing_error"]
+        return response["parsed"]
+    return response
+
+
+def _used_tokens(name: str, response) -> Optional[int]:
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return None
+    llm_tokens.inc(usage.get("input_tokens", 0), chain=name, type="input")
+    llm_tokens.inc(usage.get("output_tokens", 0), chain=name, type="output")
+    return usage.get("total_tokens")
+
+
+def current_latency(now: Optional[float] = None) -> float:
+    # latency_ewma с затуханием по времени с последнего замера
+    if latency_ewma == 0:
+        return 0.0
+    now = time.monotonic() if now is None else now
+    return latency_ewma * 0.5 ** (max(0.0, now - _latency_at) / LATENCY_HALF_LIFE)
+
+
+def _observe_latency(elapsed: float):
+    global latency_ewma, _latency_at
+    now = time.monotonic()
+    current = current_latency(now)
+    latency_ewma = elapsed if current == 0 else current + LATENCY_ALPHA * (elapsed - current)
+    _latency_at = now
+
+
+async def ainvoke(name: str, inputs: Dict[str, Any], priority: Optional[int] = None, stream=None):
+    chain = chains[name]
+    with span("prompt_fit", profile=True):
+        inputs, tokens = fit_inputs(chain, inputs)
+    reserved = tokens + LLM_REPLY_TOKENS
+    primary = model_tier.get() == "primary"
+    lim = limiter if primary else secondary_limiter
+    try:
+        with stage_seconds.time(stage="llm_queue"), span("llm_queue", chain=name):
+            await asyncio.wait_for(
+                lim.acquire(reserved, PRIORITY.get(name, 5) if priority is None else priority), LLM_QUEUE_TIMEOUT
+            )
+    except asyncio.TimeoutError:
+        raise LLMOverloaded(f"очередь к LLM дольше {LLM_QUEUE_TIMEOUT} с ({name})")
+    used = None
+    started = time.perf_counter()
+    try:
+        with span("llm", chain=name, tier=model_tier.get(), prompt_tokens=tokens):
+            if stream is None:
+                response = await chain.runnable.ainvoke(inputs)
+            else:
+                response = None
+                async for chunk in chain.runnable.astream(inputs):
+                    response = chunk if response is None else response + chunk
+                    if chunk.content:
+                        await stream.push(chunk.content)
+            used = _used_tokens(name, _raw(response))
+            annotate(total_tokens=used)
+        return _parsed(response)
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage="llm")
+        llm_seconds.observe(elapsed, chain=name)
+        if primary:
+            _observe_latency(elapsed)
+        await lim.release(reserved, used)
+
+
+async def abatch(name: str, inputs_list, priority: Optional[int] = None):
+    # Пачка вызовов одной цепочки через общий лимитер: режется на куски не больше лимита
+    # параллелизма, слоты куска захватываются разом, с тем же LLM_QUEUE_TIMEOUT, что у ainvoke.
+    # Ошибки возвращаются на своих местах, а не роняют всю пачку.
+    chain = chains[name]
+    priority = PRIORITY.get(name, 5) if priority is None else priority
+    with span("prompt_fit", profile=True):
+        fitted = [fit_inputs(chain, inputs) for inputs in inputs_list]
+    lim = limiter if model_tier.get() == "primary" else secondary_limiter
+    size = lim.max_count()
+    results = []
+    for start in range(0, len(fitted), size):
+        chunk = fitted[start:start + size]
+        reserved = sum(tokens for _, tokens in chunk) + LLM_REPLY_TOKENS * len(chunk)
+        try:
+            with stage_seconds.time(stage="llm_queue"), span("llm_queue", chain=name, batch=len(chunk)):
+                await asyncio.wait_for(lim.acquire(reserved, priority, count=len(chunk)), LLM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise LLMOverloaded(f"очередь к LLM дольше {LLM_QUEUE_TIMEOUT} с ({name}, пачка {len(chunk)})")
+        used = None
+        try:
+            with llm_seconds.time(chain=name), stage_seconds.time(stage="llm"), span("llm", chain=name, batch=len(chunk)):
+                responses = await chain.runnable.abatch([inputs for inputs, _ in chunk], return_exceptions=True)
+            # Расход неизвестен (ошибка, нет usage) — считаем израсходованным весь резерв вызова
+            used = 0
+            for response, (_, tokens) in zip(responses, chunk):
+                usage = None if isinstance(response, Exception) else _used_tokens(name, _raw(response))
+                used += tokens + LLM_REPLY_TOKENS if usage is None else usage
+                try:
+                    results.append(response if isinstance(response, Exception) else _parsed(response))
+                except Exception as e:
+                    results.append(e)
+        finally:
+            await lim.release(reserved, used, count=len(chunk))
+    return results
+
+
+async def generate(name: str, inputs: Dict[str, Any]) -> str:
+    # Текст ответа фазы: кэш ответов -> лимитер -> OpenAI
+    chain = chains[name]
+
+    async def _call() -> str:
+        response = await ainvoke(name, inputs, stream=reply_stream.get())
+        return response.content
+
+    model = LLM_MODEL if model_tier.get() == "primary" else LLM_SECONDARY_MODEL
+    return await cached_reply(name, chain.template, inputs, _call, model=model)
+
+
+def llm_stats() -> Dict[str, Any]:
+    stats = {"model": LLM_MODEL, "chains": len(chains), "latency_ewma": round(current_latency(), 3), **limiter.stats()}
+    if LLM_SECONDARY_MODEL:
+        stats["secondary"] = {"model": LLM_SECONDARY_MODEL, **secondary_limiter.stats()}
+    return stats
@@ -0,0 +1,152 @@
+# app/llm_cache.py
+import os
+import json
+import hashlib
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import redis.asyncio as redis
+
+from .cache import TTLCache, normalize_text
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+# Общий для всех машин Redis-уровень; при недоступности Redis кэш работает только локально
+LLM_CACHE_REDIS = os.getenv("LLM_CACHE_REDIS", "1") == "1"
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "86400"))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "5000"))
+# Ответы длиннее не кэшируем, чтобы держать бюджет памяти Redis предсказуемым
+LLM_CACHE_MAX_REPLY = int(os.getenv("LLM_CACHE_MAX_REPLY", "4000"))
+# Бюджет Redis-уровня, ключей: сверх него вытесняются самые старые записи.
+# Память — не больше LLM_CACHE_REDIS_MAX_KEYS × (LLM_CACHE_MAX_REPLY × 2 байта UTF-8 + ~150 байт)
+LLM_CACHE_REDIS_MAX_KEYS = int(os.getenv("LLM_CACHE_REDIS_MAX_KEYS", "10000"))
+# Ручной сброс всего кэша: достаточно поменять версию
+LLM_CACHE_VERSION = os.getenv("LLM_CACHE_VERSION", "1")
+
+redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+# Индекс ключей Redis-уровня: ключ -> время записи; по нему выдерживается бюджет
+INDEX_KEY = f"llm_cache:index:{LLM_CACHE_VERSION}"
+local_cache = TTLCache(maxsize=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL)
+stats = {"local_hits": 0, "redis_hits": 0, "misses": 0, "errors": 0, "evicted": 0}
+
+# Фазы, для которых хэш шаблона уже сверен с Redis в этом процессе
+_synced_templates: Dict[str, str] = {}
+
+# Запись с учётом бюджета: просроченные по TTL убираются из индекса, сверх бюджета —
+# удаляются самые старые ключи
+_STORE_SCRIPT = """
+local now = tonumber(redis.call('TIME')[1])
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], now, KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - tonumber(ARGV[2]))
+local extra = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[3])
+if extra > 0 then
+  for _, key in ipairs(redis.call('ZRANGE', KEYS[2], 0, extra - 1)) do
+    redis.call('UNLINK', key)
+  end
+  redis.call('ZREMRANGEBYRANK', KEYS[2], 0, extra - 1)
+end
+return extra > 0 and extra or 0
+"""
+_store = redis_client.register_script(_STORE_SCRIPT)
+
+
+def template_hash(template: str) -> str:
+    return hashlib.sha1(template.encode("utf-8")).hexdigest()[:12]
+
+
+def cache_key(phase: str, template: str, inputs: Dict[str, Any], model: str = "") -> str:
+    # В ключ попадают модель и только те переменные, которые реально подставляются в шаблон:
+    # ответы запасной модели (режим деградации) не отдаются обычным ходам
+    relevant = {
+        name: normalize_text(value) if name == "message" else value
+        for name, value in inputs.items()
+        if "{" + name + "}" in template
+    }
+    digest = hashlib.sha1(
+        json.dumps(relevant, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    return f"llm:{LLM_CACHE_VERSION}:{phase}:{template_hash(template)}:{model}:{digest}"
+
+
+async def invalidate(phase: Optional[str] = None):
+    pattern = f"llm:{LLM_CACHE_VERSION}:{phase or '*'}:*"
+    if phase is None:
+        local_cache.clear()
+    else:
+        # Только ключи этой фазы: ответы остальных фаз остаются в кэше
+        prefix = f"llm:{LLM_CACHE_VERSION}:{phase}:"
+        for key in local_cache.keys():
+            if key.startswith(prefix):
+                local_cache.pop(key)
+    if not LLM_CACHE_REDIS:
+        return
+    try:
+        keys = [key async for key in redis_client.scan_iter(match=pattern, count=500)]
+        if keys:
+            await redis_client.unlink(*keys)
+            await redis_client.zrem(INDEX_KEY, *keys)
+        logger.info(f"Кэш LLM сброшен ({pattern}): {len(keys)} ключей")
+    except Exception as e:
+        logger.warning(f"Ошибка сброса кэша LLM: {e}")
+
+
+async def _sync_template(phase: str, template: str):
+    # Если шаблон фазы поменялся с прошлого деплоя — вычищаем её старые ответы из Redis
+    current = template_hash(template)
+    if _synced_templates.get(phase) == current:
+        return
+    _synced_templates[phase] = current
+    if not LLM_CACHE_REDIS:
+        return
+    try:
+        previous = await redis_client.hget("llm_cache:templates", phase)
+        if previous and previous != current:
+            await invalidate(phase)
+        await redis_client.hset("llm_cache:templates", phase, current)
+    except Exception as e:
+        logger.warning(f"Ошибка проверки шаблона {phase}: {e}")
+
+
+async def cached_reply(phase: str, template: str, inputs: Dict[str, Any],
+                       generate: Callable[[], Awaitable[str]], model: str = "") -> str:
+    if not LLM_CACHE_ENABLED:
+        return await generate()
+
+    await _sync_template(phase, template)
+    key = cache_key(phase, template, inputs, model)
+    reply = local_cache.get(key)
+    if reply is not None:
+        stats["local_hits"] += 1
+        return reply
+
+    if LLM_CACHE_REDIS:
+        try:
+            reply = await redis_client.get(key)
+        except Exception as e:
+            stats["errors"] += 1
+            logger.warning(f"Redis-кэш LLM недоступен: {e}")
+        if reply is not None:
+            stats["redis_hits"] += 1
+            local_cache.set(key, reply)
+            return reply
+
+    stats["misses"] += 1
+    reply = await generate()
+    if len(reply) <= LLM_CACHE_MAX_REPLY:
+        local_cache.set(key, reply)
+        if LLM_CACHE_REDIS:
+            try:
+                stats["evicted"] += await _store(
+                    keys=[key, INDEX_KEY], args=[reply, LLM_CACHE_TTL, LLM_CACHE_REDIS_MAX_KEYS]
+                )
+            except Exception as e:
+                stats["errors"] += 1
+                logger.warning(f"Ошибка записи в Redis-кэш LLM: {e}")
+    return reply
+
+
+def cache_stats() -> Dict[str, Any]:
+    return {**stats, "local_size": len(local_cache), "redis_max_keys": LLM_CACHE_REDIS_MAX_KEYS}
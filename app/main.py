@@ -1,16 +1,34 @@
 # app/main.py
 import os
 import re
+import time
+import asyncio
 import logging
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 from telegram import Update
 from telegram.ext import Application, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
 
-from .rag import init_retriever, retriever
-from .dialog_state import get_dialog_state, save_dialog_state
-from .phases import get_phase_handler
-from .crm import send_lead_to_crm
+from .rag import init_retriever, LazyContext, watch_knowledge, KNOWLEDGE_POLL_INTERVAL
+from . import rag, dialog_state
+from .dialog_state import get_dialog_state, update_dialog_state, state_stats, ping_state
+from .phases import get_phase, PHASES
+from .faq import match_faq, faq_reply
+from .tokens import cap_message, get_encoding
+from .crm import send_lead_to_crm, crm_worker
+from .agents import aclassify_and_qualify
+from .llm_cache import cache_stats, stats as llm_cache_counts
+from .metrics import Collected, Counter, fallbacks, stage_seconds, render as render_metrics
+from .llm import LLMOverloaded, llm_stats, model_tier, reply_stream, warmup_chains
+from .turn import combined_turn, COMBINED_TURN
+from .telegram_stream import TelegramReplyStream, STREAM_REPLIES
+from .workers import KeyedWorkerPool, queue_wait
+from .dedupe import update_dedup
+from .tracing import annotate, span, trace, trace_stats
+from .admission import (
+    ADMISSION_ENABLED, FLOOD_REPLY, admission, canned_turn, degraded_mode, overload_reason, shed,
+)
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
@@ -22,12 +40,54 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN is required")
 
-application = Application.builder().token(BOT_TOKEN).build()
+# TELEGRAM_API_URL — другой Bot API сервер (локальный стенд, бенчмарки)
+builder = Application.builder().token(BOT_TOKEN)
+if os.getenv("TELEGRAM_API_URL"):
+    builder = builder.base_url(os.getenv("TELEGRAM_API_URL"))
+application = builder.build()
 
 # Парсинг триггера из сообщения
 TRIGGER_PATTERN = r'【systemTextByAi:\s*({.*?})】'
 
+# Метрики: метки фаз ограничены известными фазами
+PHASE_LABELS = set(PHASES) | {"completed"}
+phase_transitions = Counter(
+    "phase_transitions_total", "Переходы между фазами воронки", ["from", "to"],
+    {"from": PHASE_LABELS, "to": PHASE_LABELS},
+)
+triggers = Counter("crm_triggers_total", "Принятые триггеры NEWLEAD")
+
+
+def _cache_counts():
+    state_cache = getattr(dialog_state.backend, "cache", None)
+    counts = [
+        ({"cache": "llm", "result": "hit"}, llm_cache_counts["local_hits"] + llm_cache_counts["redis_hits"]),
+        ({"cache": "llm", "result": "miss"}, llm_cache_counts["misses"]),
+        ({"cache": "query_embedding", "result": "hit"}, rag.query_cache.hits),
+        ({"cache": "query_embedding", "result": "miss"}, rag.query_cache.misses),
+    ]
+    if state_cache is not None:
+        counts += [({"cache": "dialog_state", "result": "hit"}, state_cache.hits),
+                   ({"cache": "dialog_state", "result": "miss"}, state_cache.misses)]
+    return counts
+
+
+Collected("cache_requests_total", "Обращения к кэшам по результату", "counter", ["cache", "result"], _cache_counts)
+Collected(
+    "crm_leads_total", "Лиды, прошедшие через воркер CRM", "counter", ["result"],
+    lambda: [({"result": "delivered"}, crm_worker.delivered),
+             ({"result": "retried"}, crm_worker.failed_attempts),
+             ({"result": "dead_lettered"}, crm_worker.dead_lettered),
+             ({"result": "recovered"}, crm_worker.recovered)],
+)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Корневой span хода: медленные ходы целиком попадают в TRACE_FILE
+    with trace("turn", user_id=str(update.effective_user.id)):
+        await _handle_message(update, context)
+
+
+async def _handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     text = update.message.text.strip() if update.message and update.message.text else ""
     user_id = str(user.id)
@@ -42,73 +102,203 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             import json
             payload_str = trigger_match.group(1)
-            payload = json.loads(payload_str.replace('%%', '"'))
+            payload = json.loads(payload_str.replace('%%', ''))
             if payload.get("trigger") == "NEWLEAD":
+                triggers.inc()
+                annotate(trigger="NEWLEAD")
+                # Намерение и срочность лида — из квалификации (с бюджетом задержки)
+                with span("qualify"):
+                    lead = await aclassify_and_qualify(payload.get("quest") or text)
                 await send_lead_to_crm(
-                    lead=None,
+                    lead=lead,
                     user_id=user_id,
                     full_name=user.full_name or "",
                     channel="telegram",
                     original_message=text,
-                    override_data=payload
+                    override_data=payload,
+                    message_id=str(update.message.message_id),
                 )
                 # Сброс состояния после отправки
-                await save_dialog_state(user_id, {"phase": "completed"})
+                await update_dialog_state(user_id, None, "completed", {}, reset_vars=True)
         except Exception as e:
             logger.error(f"Ошибка парсинга триггера: {e}")
         return
 
+    # Флуд одного пользователя не должен съедать общую квоту LLM
+    if ADMISSION_ENABLED and not await admission.allow_user(user_id):
+        # Без ответа клиент решит, что бот сломался: раз за интервал просим подождать
+        if await admission.flood_notice(user_id):
+            shed.inc(reason="flood", mode="notified")
+            await update.message.reply_text(FLOOD_REPLY)
+        else:
+            shed.inc(reason="flood", mode="dropped")
+        logger.warning(f"Флуд от {user_id}, сообщение пропущено")
+        return
+
+    started = time.perf_counter()
+    # Вставленные простыни текста не раздувают промпты, кэш и триггер
+    text = cap_message(text)
     # Загрузка состояния диалога
-    state = await get_dialog_state(user_id)
+    with stage_seconds.time(stage="state_load"), span("state_load"):
+        state = await get_dialog_state(user_id)
     if not state:
         state = {"phase": "phase1", "vars": {}}
+    version = state.get("version", 0)
 
     current_phase = state["phase"]
-    if current_phase == "completed":
+    restarted = current_phase == "completed"
+    if restarted:
         # Если диалог завершён — начинаем заново
         state = {"phase": "phase1", "vars": {}}
         current_phase = "phase1"
 
-    # Получение контекста из базы знаний
-    context_str = ""
-    if retriever:
-        try:
-            docs = retriever.invoke(text)
-            context_str = "\n".join([d.page_content for d in docs])
-        except Exception as e:
-            logger.error(f"Ошибка RAG: {e}")
-
     # Обработка текущей фазы
+    stream = None
     try:
-        phase_handler = get_phase_handler(current_phase)
-        if not phase_handler:
-            phase_handler = get_phase_handler("phase1")
-            state["phase"] = "phase1"
+        phase = get_phase(current_phase)
+        if not phase:
+            fallbacks.inc(kind="unknown_phase")
+            current_phase = "phase1"
+            phase = get_phase(current_phase)
 
-        result = await phase_handler(text, context_str, state["vars"])
+        # Частый фактический вопрос ("сколько стоит", "какой телефон") — готовый ответ
+        # из FAQ без LLM; фаза не меняется, следующий ответ клиента идёт в неё же
+        annotate(phase=current_phase)
+        faq = match_faq(text, current_phase)
+        if faq:
+            annotate(faq=faq.intent)
+            with stage_seconds.time(stage="telegram_reply"), span("telegram_reply"):
+                await update.message.reply_text(faq_reply(faq, current_phase))
+            return
+
+        # Перегрузка LLM (ожидание в очереди, глубина очереди лимитера, задержка модели):
+        # вместо долгого ожидания — запасная модель или готовый ответ фазы
+        degraded = None
+        if ADMISSION_ENABLED and phase.llm:
+            age = time.time() - update.message.date.timestamp() if update.message.date else 0.0
+            degraded = overload_reason(max(queue_wait.get(), age))
+        mode = degraded_mode() if degraded else None
+        if degraded:
+            annotate(degraded=degraded, mode=mode)
+
+        # Контекст базы знаний нужен только фазам, которые его читают
+        knowledge = LazyContext(text)
+        context_str = ""
+        if phase.uses_context and mode != "canned":
+            with stage_seconds.time(stage="retrieval"), span("retrieval"):
+                context_str = await knowledge.get()
+
+        # В режиме стриминга ответ фазы дописывается в сообщение по мере генерации
+        stream = TelegramReplyStream(update.message) if STREAM_REPLIES else None
+        if stream:
+            await stream.start()
+        stream_token = reply_stream.set(stream)
+        # Общий на все машины лимит одновременных LLM-ходов
+        slot = None
+        if ADMISSION_ENABLED and phase.llm and mode is None:
+            slot = await admission.acquire_slot()
+            if slot is None:
+                degraded, mode = "inflight", degraded_mode()
+                annotate(degraded=degraded, mode=mode)
+        tier_token = model_tier.set("secondary") if mode == "secondary" else None
+        try:
+            with stage_seconds.time(stage="handler"), span("handler", phase=current_phase, mode=mode or "normal"):
+                if mode == "canned":
+                    result = canned_turn(phase, text, state["vars"], degraded)
+                else:
+                    if mode == "secondary":
+                        shed.inc(reason=degraded, mode="secondary")
+                    if COMBINED_TURN and phase.llm:
+                        # Один structured-вызов: ответ, слоты, квалификация и следующая фаза
+                        result = await combined_turn(current_phase, text, context_str, state["vars"])
+                    else:
+                        result = await phase.handler(text, context_str, state["vars"])
+        except LLMOverloaded as e:
+            logger.warning(f"LLM перегружена ({e}), готовый ответ фазы {current_phase}")
+            result = canned_turn(phase, text, state["vars"], "overloaded")
+        finally:
+            reply_stream.reset(stream_token)
+            if tier_token is not None:
+                model_tier.reset(tier_token)
+            if slot is not None:
+                await admission.release_slot(slot)
         reply = result["reply"]
         next_phase = result["next_phase"]
         updated_vars = result["vars"]
 
-        # Обновление состояния
-        state["phase"] = next_phase
-        state["vars"].update(updated_vars)
-        await save_dialog_state(user_id, state)
+        # Атомарное обновление состояния: параллельный ход того же пользователя не затрёт vars
+        with stage_seconds.time(stage="state_save"), span("state_save"):
+            await update_dialog_state(user_id, version, next_phase, updated_vars, reset_vars=restarted)
+        phase_transitions.inc(**{"from": current_phase, "to": next_phase})
 
-        await update.message.reply_text(reply)
+        with stage_seconds.time(stage="telegram_reply"), span("telegram_reply"):
+            if stream:
+                await stream.finish(reply)
+            else:
+                await update.message.reply_text(reply)
 
     except Exception as e:
         logger.error(f"Ошибка обработки фазы: {e}")
-        await update.message.reply_text("Спасибо за обращение! Менеджер свяжется с вами.")
+        fallbacks.inc(kind="handler_error")
+        fallback = "Спасибо за обращение! Менеджер свяжется с вами."
+        if stream and stream.sent:
+            await stream.finish(fallback)
+        else:
+            await update.message.reply_text(fallback)
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage="total")
 
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+# Webhook только ставит обновление в очередь; обработка — в пуле воркеров с порядком по user_id
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "1.0"))
+update_pool = KeyedWorkerPool(
+    application.process_update,
+    workers=int(os.getenv("WEBHOOK_WORKERS", "16")),
+    max_pending=int(os.getenv("WEBHOOK_MAX_PENDING", "500")),
+)
+Collected(
+    "update_duplicates_total", "Повторные доставки обновлений Telegram, отброшенные по update_id",
+    "counter", [], lambda: [({}, update_dedup.duplicates)],
+)
+Collected(
+    "webhook_queue", "Состояние очереди обработки обновлений", "gauge", ["field"],
+    lambda: [({"field": k}, v) for k, v in update_pool.stats().items()],
+)
+
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", "1.0"))
+app.state.warmup_seconds = None
+
+async def warmup():
+    # Загрузка индекса и сборка цепочек LLM в фоне: webhook принимается сразу,
+    # а до конца прогрева фазы отвечают без контекста базы знаний
+    started = time.perf_counter()
+    # Обе задачи блокирующие (импорты, FAISS, пулы процессов) — выполняем вне event loop
+    results = await asyncio.gather(
+        asyncio.to_thread(init_retriever), asyncio.to_thread(warmup_chains), return_exceptions=True
+    )
+    for name, result in zip(("индекс", "цепочки LLM"), results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка прогрева ({name}): {result}")
+    app.state.warmup_seconds = round(time.perf_counter() - started, 3)
+    logger.info(f"Прогрев завершён за {app.state.warmup_seconds} с")
+    if KNOWLEDGE_POLL_INTERVAL > 0:
+        # Следим за knowledge/ и подменяем индекс без рестарта
+        app.state.index_watcher = asyncio.create_task(watch_knowledge())
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("Запуск FirstContact AI (NeuroPragmat)...")
-    init_retriever()
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 and dialog_state.STATE_BACKEND == "memory":
+        logger.warning("Несколько воркеров с STATE_BACKEND=memory: состояние диалогов не общее, нужен Redis")
+    # Кодировку tiktoken — до приёма сообщений: cap_message в обработчике её не ждёт
+    # и до загрузки режет сообщения по символам
+    await asyncio.to_thread(get_encoding)
+    app.state.warmup = asyncio.create_task(warmup())
     await application.initialize()
     await application.start()
+    update_pool.start()
+    crm_worker.start()
 
     webhook_url = os.getenv("WEBHOOK_URL")
     if webhook_url:
@@ -120,6 +310,12 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    for name in ("warmup", "index_watcher"):
+        task = getattr(app.state, name, None)
+        if task:
+            task.cancel()
+    await update_pool.stop()
+    await crm_worker.stop()
     await application.stop()
     await application.shutdown()
 
@@ -127,17 +323,56 @@ async def shutdown_event():
 async def telegram_webhook(request: Request):
     try:
         update = Update.de_json(await request.json(), application.bot)
-        await application.process_update(update)
+        if not await update_dedup.claim(update.update_id):
+            # Повторная доставка: обновление уже принято этим или другим процессом
+            return Response(status_code=200)
+        key = str(update.effective_user.id) if update.effective_user else str(update.update_id)
+        if not await update_pool.submit(key, update, timeout=WEBHOOK_ENQUEUE_TIMEOUT):
+            # Пул перегружен: Telegram повторит доставку позже
+            await update_dedup.release(update.update_id)
+            return Response(status_code=503)
         return Response(status_code=200)
     except Exception as e:
         logger.error(f"Ошибка обработки webhook: {e}")
         return Response(status_code=500)
 
+@app.get("/metrics")
+async def metrics():
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/ready")
+async def ready():
+    # Готовность: прогрев завершён и хранилище состояний отвечает.
+    # Без retriever бот работает (ответы без контекста), но это видно в ответе
+    checks = {"warmup": app.state.warmup_seconds is not None, "state_store": True}
+    try:
+        await asyncio.wait_for(ping_state(), READY_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Хранилище состояний недоступно: {e}")
+        checks["state_store"] = False
+    ok = all(checks.values())
+    return JSONResponse(status_code=200 if ok else 503, content={
+        "ready": ok,
+        **checks,
+        "retriever_loaded": rag.retriever is not None,
+        "index_version": rag.index_version,
+        "warmup_seconds": app.state.warmup_seconds,
+    })
+
 @app.get("/")
 async def health():
     return {
         "status": "ok",
         "agent": "FirstContact AI",
         "agency": "NeuroPragmat",
-        "retriever_loaded": retriever is not None
+        "retriever_loaded": rag.retriever is not None,
+        "index_version": rag.index_version,
+        "llm": llm_stats(),
+        "llm_cache": cache_stats(),
+        "queue": update_pool.stats(),
+        "update_dedup": update_dedup.stats(),
+        "admission": admission.stats(),
+        "tracing": trace_stats(),
+        "dialog_state": state_stats(),
+        "crm_outbox": await crm_worker.stats()
     }
\ No newline at end of file
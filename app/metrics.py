@@ -0,0 +1,163 @@
+# app/metrics.py
+# Метрики в текстовом формате Prometheus (GET /metrics) без внешних зависимостей.
+# Значения меток проверяются по заранее известным множествам, всё остальное
+# сворачивается в "other" — кардинальность не растёт от пользовательского ввода.
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Container, Dict, Iterable, List, Optional, Tuple
+
+PREFIX = "firstcontact_"
+OTHER = "other"
+# Секунды: от обращений к Redis до длинных ответов модели
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Стадии обработки сообщения
+STAGES = {
+    "state_load", "retrieval", "handler", "llm_queue", "llm", "telegram_reply",
+    "state_save", "crm_delivery", "qualify", "total",
+}
+FALLBACKS = {"handler_error", "unknown_phase", "combined_turn", "qualify", "qualify_timeout"}
+
+registry: List["Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 allowed: Optional[Dict[str, Container]] = None):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        # label -> допустимые значения (множество, dict или любой контейнер с "in")
+        self.allowed = allowed or {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        key = []
+        for label in self.labels:
+            value = str(labels.get(label, ""))
+            allowed = self.allowed.get(label)
+            if allowed is not None and value not in allowed:
+                value = OTHER
+            key.append(value)
+        return tuple(key)
+
+    def _labels(self, key: Tuple[str, ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), allowed=None):
+        super().__init__(name, help, labels, allowed)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return super().render() + [f"{self.name}{self._labels(k)} {_number(v)}" for k, v in values]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), allowed=None,
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels, allowed)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # key -> [счётчики по корзинам..., сумма, количество]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        lines = super().render()
+        for key, data in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._labels(key, (('le', _number(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_number(data[-2])}")
+            lines.append(f"{self.name}_count{self._labels(key)} {data[-1]}")
+        return lines
+
+
+class Collected(Metric):
+    # Значения снимаются в момент запроса /metrics из уже существующей статистики
+    # (очереди, лимитер, кэши). collect() -> [(метки, значение), ...]
+    def __init__(self, name: str, help: str, kind: str, labels: Iterable[str],
+                 collect: Callable[[], Iterable[Tuple[Dict[str, Any], float]]]):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        return super().render() + [
+            f"{self.name}{self._labels(self._key(labels))} {_number(value)}"
+            for labels, value in self.collect()
+        ]
+
+
+stage_seconds = Histogram(
+    "stage_seconds", "Длительность стадий обработки сообщения", ["stage"], {"stage": STAGES}
+)
+fallbacks = Counter(
+    "fallbacks_total", "Срабатывания запасных путей", ["kind"], {"kind": FALLBACKS}
+)
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            # Сломанный сборщик не должен ронять весь /metrics
+            lines.append(f"# {metric.name} недоступна: {_escape(str(e))}")
+    return "\n".join(lines) + "\n"
@@ -1,20 +1,32 @@
 # app/phases/__init__.py
-from .phase1 import handle_phase1
-from .phase2a import handle_phase2a
-from .phase3a import handle_phase3a
-from .phase4a import handle_phase4a
-from .phase5a import handle_phase5a
-from .phase6a import handle_phase6a
-from .phase7 import handle_phase7
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+from .graph import compiled
+
+
+class Phase(NamedTuple):
+    handler: Callable[..., Awaitable[Dict[str, Any]]]
+    # Читает ли фаза контекст базы знаний; если нет — retrieval не выполняется
+    uses_context: bool = False
+    # Эвристики слотов и переходов фазы (message, vars) -> (next_phase, vars)
+    route: Optional[Callable[[str, Dict], Tuple[str, Dict]]] = None
+    # Готовый ответ фазы для режима деградации, когда LLM перегружена
+    canned: str = ""
+    # Отвечает ли фаза через LLM; False — шаблон из графа (graph.py), без сети
+    llm: bool = False
+
+
+# Фазы собираются из проверенного графа (graph.py) один раз при импорте
+PHASES: Dict[str, Phase] = {
+    name: Phase(phase.handle, uses_context=phase.context, route=phase.route, canned=phase.template, llm=phase.llm)
+    for name, phase in compiled.items()
+}
+
+
+def get_phase(phase: str) -> Optional[Phase]:
+    return PHASES.get(phase)
+
 
 def get_phase_handler(phase: str):
-    handlers = {
-        "phase1": handle_phase1,
-        "phase2A": handle_phase2a,
-        "phase3A": handle_phase3a,
-        "phase4A": handle_phase4a,
-        "phase5A": handle_phase5a,
-        "phase6A": handle_phase6a,
-        "phase7": handle_phase7,
-    }
-    return handlers.get(phase)
\ No newline at end of file
+    spec = PHASES.get(phase)
+    return spec.handler if spec else None
@@ -0,0 +1,329 @@
+# app/phases/graph.py
+# Воронка как декларативный граф: у каждой фазы — способ ответа (LLM-цепочка фазы или шаблон,
+# который рендерится локально), правила перехода по ключевым словам, заполняемые слоты и
+# извлечение данных из сообщения. Граф проверяется при импорте (битый переход — ошибка старта),
+# ключевые слова фазы компилируются в одно регулярное выражение.
+#
+# Проверить граф и маршрутизацию без LLM и Redis:
+#   python -m app.phases.graph
+#   python -m app.phases.graph --phase phase4A "У нас интернет-магазин, мы ИП"
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ..dialog_state import PHASE_CODES, SLOT_CODES, VAR_CODES
+from ..llm import chains, generate
+from .phase1 import CANNED_REPLY as PHASE1_CANNED
+from .phase2a import CANNED_REPLY as PHASE2A_CANNED
+from .phase3a import CANNED_REPLY as PHASE3A_CANNED
+from .phase4a import CANNED_REPLY as PHASE4A_CANNED
+from .phase5a import CANNED_REPLY as PHASE5A_CANNED
+from .phase6a import CANNED_REPLY as PHASE6A_CANNED, extract_name, extract_phone
+from .phase7 import render_phase7
+
+ENTRY = "phase1"
+FINAL = "completed"
+# Фазы, которые отвечают шаблоном вместо LLM (через запятую), например "phase4A,phase5A"
+TEMPLATED_PHASES = {p for p in os.getenv("TEMPLATED_PHASES", "").split(",") if p}
+
+# Правила проверяются по порядку: срабатывает первое, чьё ключевое слово есть в сообщении
+# (в нижнем регистре). keywords — начала слов ("компани" — "компания", "компании"),
+# words — слова целиком ("ип", но не "типа"). default — если ни одно не сработало.
+# template — ответ без LLM: для reply="template" и в режиме деградации (admission).
+# context — LLM-шаблон фазы читает {context} (база знаний); сверяется с цепочкой при импорте.
+# Фазы объявляются в порядке воронки (FUNNEL).
+GRAPH: Dict[str, Dict[str, Any]] = {
+    "phase1": {
+        "reply": "llm",
+        "template": PHASE1_CANNED,
+        "rules": [
+            {"words": ["да"], "keywords": ["хочу", "расскажи", "интересно", "нужно", "требуется"], "next": "phase2A"},
+            # Даже при "нет" — даём информацию
+            {"words": ["нет"], "keywords": ["не хочу", "не интересно", "неинтересно"], "next": "phase2A"},
+        ],
+        "default": {"next": "phase1"},
+    },
+    "phase2A": {
+        "reply": "llm",
+        "template": PHASE2A_CANNED,
+        "rules": [
+            # Сразу созвониться — собираем имя и телефон
+            {"keywords": ["звон", "позвон", "перезвон", "созвон", "телефон", "связь"], "next": "phase6A"},
+        ],
+        "default": {"next": "phase3A"},
+    },
+    "phase3A": {
+        "reply": "llm",
+        "template": PHASE3A_CANNED,
+        "rules": [
+            {"keywords": ["лид", "лидогенер"], "set": {"goal": "лидогенерация"}, "next": "phase4A"},
+            {"keywords": ["поддерж", "вопрос"], "set": {"goal": "поддержка клиентов"}, "next": "phase4A"},
+            {"keywords": ["заказ", "обработ"], "set": {"goal": "обработка заказов"}, "next": "phase4A"},
+        ],
+        "default": {"set": {"goal": "уточнить позже"}, "next": "phase4A"},
+    },
+    "phase4A": {
+        "reply": "llm",
+        "template": PHASE4A_CANNED,
+        "inputs": ["goal"],
+        "rules": [
+            {"keywords": ["b2b", "юр", "компани"], "set": {"business_type": "B2B"}, "next": "phase5A"},
+            {"keywords": ["b2c", "физ", "частн"], "set": {"business_type": "B2C"}, "next": "phase5A"},
+            {"keywords": ["фриланс", "самозанят"], "set": {"business_type": "фриланс"}, "next": "phase5A"},
+            {"words": ["ип"], "set": {"business_type": "ИП"}, "next": "phase5A"},
+        ],
+        "default": {"set": {"business_type": "уточнить позже"}, "next": "phase5A"},
+    },
+    "phase5A": {
+        "reply": "llm",
+        "template": PHASE5A_CANNED,
+        "inputs": ["goal", "business_type"],
+        "rules": [
+            {"keywords": ["amo", "амо"], "set": {"crm": "AmoCRM"}, "next": "phase6A"},
+            {"keywords": ["bitrix", "битрикс"], "set": {"crm": "Bitrix24"}, "next": "phase6A"},
+            {"words": ["нет"], "keywords": ["не используем"], "set": {"crm": "нет"}, "next": "phase6A"},
+            {"keywords": ["друг"], "set": {"crm": "другая"}, "next": "phase6A"},
+        ],
+        "default": {"set": {"crm": "уточнить позже"}, "next": "phase6A"},
+    },
+    "phase6A": {
+        "reply": "llm",
+        "template": PHASE6A_CANNED,
+        "extract": ["name", "phone"],
+        "default": {"next": "phase6A"},
+        # Имя и телефон могли прийти в разных сообщениях
+        "when_filled": {"slots": ["name", "phone"], "next": "phase7"},
+    },
+    "phase7": {
+        "reply": "template",
+        "render": "lead_trigger",
+        "default": {"next": FINAL},
+    },
+}
+
+# Извлечение переменной по сообщению и уже известным vars
+EXTRACTORS: Dict[str, Callable[[str, Dict], str]] = {
+    "name": lambda message, vars: extract_name(message, known=vars.get("name", "")),
+    "phone": lambda message, vars: extract_phone(message),
+}
+RENDERERS: Dict[str, Callable[[str, Dict], str]] = {"lead_trigger": render_phase7}
+
+
+class _Vars(dict):
+    def __missing__(self, key):
+        return ""
+
+
+def outcomes(node: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Все исходы фазы: правила, default и when_filled
+    return [*node.get("rules", []), node.get("default") or {}, node.get("when_filled") or {}]
+
+
+def successors(graph: Dict[str, Dict[str, Any]], name: str) -> List[str]:
+    return list(dict.fromkeys(o["next"] for o in outcomes(graph[name]) if "next" in o))
+
+
+def required_slots(graph: Dict[str, Dict[str, Any]]) -> Dict[str, List[str]]:
+    # Без чего в фазу переходить нельзя: её inputs и слоты when_filled, ведущего в неё
+    required = {name: list(node.get("inputs", [])) for name, node in graph.items()}
+    for node in graph.values():
+        filled = node.get("when_filled")
+        if filled and filled["next"] in required:
+            required[filled["next"]] += [s for s in filled["slots"] if s not in required[filled["next"]]]
+    return {name: slots for name, slots in required.items() if slots}
+
+
+def slot_values(graph: Dict[str, Dict[str, Any]]) -> Dict[str, List[str]]:
+    # Значения слотов, которые ставят правила (default вроде "уточнить позже" — не ответ клиента)
+    values: Dict[str, List[str]] = {}
+    for node in graph.values():
+        for rule in node.get("rules", []):
+            for slot, value in rule.get("set", {}).items():
+                if value not in values.setdefault(slot, []):
+                    values[slot].append(value)
+    return values
+
+
+def validate_graph(graph: Dict[str, Dict[str, Any]]) -> List[str]:
+    errors = []
+    if ENTRY not in graph:
+        errors.append(f"нет входной фазы {ENTRY}")
+    for name, node in graph.items():
+        where = f"{name}:"
+        if name not in PHASE_CODES:
+            errors.append(f"{where} нет кода в dialog_state.PHASE_CODES")
+        reply = node.get("reply")
+        if reply == "llm":
+            if name not in chains:
+                errors.append(f"{where} не зарегистрирована LLM-цепочка {name}")
+            if not node.get("template"):
+                errors.append(f"{where} нужен template для режима деградации")
+            # Без флага retrieval не выполняется, и {context} молча получит пустую строку
+            if name in chains and ("{context}" in chains[name].template) != bool(node.get("context")):
+                errors.append(f"{where} context должен совпадать с наличием {{context}} в шаблоне цепочки")
+        elif reply == "template":
+            if not node.get("template") and node.get("render") not in RENDERERS:
+                errors.append(f"{where} нужен template или render из {sorted(RENDERERS)}")
+        else:
+            errors.append(f"{where} reply должен быть llm или template, а не {reply!r}")
+        if name in TEMPLATED_PHASES and not (node.get("template") or node.get("render")):
+            errors.append(f"{where} в TEMPLATED_PHASES, но шаблона нет")
+        for field in ("inputs", "extract"):
+            for var in node.get(field, []):
+                known = EXTRACTORS if field == "extract" else VAR_CODES
+                if var not in known:
+                    errors.append(f"{where} {field}: неизвестная переменная {var}")
+        results = [*node.get("rules", []), node.get("default")]
+        if node.get("when_filled"):
+            results.append(node["when_filled"])
+        for i, rule in enumerate(node.get("rules", [])):
+            keywords = [*rule.get("keywords", []), *rule.get("words", [])]
+            if not keywords or any(not k or k != k.lower() for k in keywords):
+                errors.append(f"{where} правило {i}: ключевые слова — непустые, в нижнем регистре")
+        for outcome in results:
+            if not outcome or "next" not in outcome:
+                errors.append(f"{where} у default и правил обязателен next")
+                continue
+            if outcome["next"] not in graph and outcome["next"] != FINAL:
+                errors.append(f"{where} переход в несуществующую фазу {outcome['next']}")
+            for slot, value in outcome.get("set", {}).items():
+                if slot in SLOT_CODES and value not in SLOT_CODES[slot]:
+                    errors.append(f"{where} {slot}={value!r} нет в dialog_state.SLOT_CODES")
+                elif slot not in VAR_CODES:
+                    errors.append(f"{where} неизвестный слот {slot}")
+    for name in TEMPLATED_PHASES - set(graph):
+        errors.append(f"TEMPLATED_PHASES: нет фазы {name}")
+
+    # Все фазы достижимы от входа, и из воронки есть выход
+    reachable, stack = set(), [ENTRY]
+    while stack:
+        name = stack.pop()
+        if name in reachable or name not in graph:
+            continue
+        reachable.add(name)
+        stack += successors(graph, name)
+    errors += [f"{name}: недостижима от {ENTRY}" for name in graph if name not in reachable]
+    if not any(o.get("next") == FINAL for node in graph.values() for o in outcomes(node)):
+        errors.append(f"ни одна фаза не ведёт в {FINAL}")
+    return errors
+
+
+def _keyword_pattern(rules: List[Dict[str, Any]]) -> Optional["re.Pattern"]:
+    # Одно выражение на фазу: (?=(?P<r0>...)|(?P<r1>...)) в каждой позиции сообщает правило
+    # с наименьшим номером, совпавшее здесь, — минимум по позициям даёт первое правило по порядку.
+    # Совпадение — только с начала слова, words — ещё и до его конца
+    if not rules:
+        return None
+    groups = "|".join(
+        "(?P<r%d>%s)" % (i, "|".join(
+            [rf"(?<!\w){re.escape(k)}" for k in rule.get("keywords", [])]
+            + [rf"(?<!\w){re.escape(w)}(?!\w)" for w in rule.get("words", [])]
+        ))
+        for i, rule in enumerate(rules)
+    )
+    return re.compile(f"(?=(?:{groups}))")
+
+
+class CompiledPhase:
+    def __init__(self, name: str, node: Dict[str, Any]):
+        self.name = name
+        self.llm = node["reply"] == "llm" and name not in TEMPLATED_PHASES
+        self.template = node.get("template", "")
+        # Контекст базы знаний нужен только LLM-ответу
+        self.context = self.llm and bool(node.get("context"))
+        self.renderer = RENDERERS.get(node.get("render"))
+        self.inputs = node.get("inputs", [])
+        self.extract = [(var, EXTRACTORS[var]) for var in node.get("extract", [])]
+        self.rules = node.get("rules", [])
+        self.default = node["default"]
+        self.when_filled = node.get("when_filled")
+        self.pattern = _keyword_pattern(self.rules)
+
+    def match(self, text: str) -> Optional[int]:
+        best = None
+        for found in self.pattern.finditer(text):
+            index = int(found.lastgroup[1:])
+            if best is None or index < best:
+                best = index
+                if best == 0:
+                    break
+        return best
+
+    def route(self, message: str, vars: Dict) -> Tuple[str, Dict]:
+        # Слоты и следующая фаза по сообщению; (next_phase, новые значения vars)
+        updated = {}
+        for var, extract in self.extract:
+            value = extract(message, vars)
+            if value:
+                updated[var] = value
+        index = self.match(message.lower()) if self.pattern else None
+        outcome = self.rules[index] if index is not None else self.default
+        updated.update(outcome.get("set", {}))
+        next_phase = outcome["next"]
+        if self.when_filled:
+            known = {**vars, **updated}
+            if all(known.get(slot) for slot in self.when_filled["slots"]):
+                next_phase = self.when_filled["next"]
+        return next_phase, updated
+
+    def render(self, message: str, vars: Dict) -> str:
+        if self.renderer is not None:
+            return self.renderer(message, vars)
+        return self.template.format_map(_Vars(vars))
+
+    async def handle(self, message: str, context: str, vars: Dict) -> Dict[str, Any]:
+        next_phase, updated_vars = self.route(message, vars)
+        if self.llm:
+            inputs = {"message": message, "context": context, **{k: vars.get(k, "") for k in self.inputs}}
+            reply = await generate(self.name, inputs)
+        else:
+            # Ответ шаблоном: без LLM и сети, доли миллисекунды
+            reply = self.render(message, {**vars, **updated_vars})
+        return {"reply": reply, "next_phase": next_phase, "vars": updated_vars}
+
+
+def compile_graph(graph: Dict[str, Dict[str, Any]] = GRAPH) -> Dict[str, CompiledPhase]:
+    errors = validate_graph(graph)
+    if errors:
+        raise ValueError("Граф фаз некорректен:\n" + "\n".join(errors))
+    return {name: CompiledPhase(name, node) for name, node in graph.items()}
+
+
+compiled = compile_graph()
+# Производные графа для комбинированного хода (turn.py)
+FUNNEL = list(GRAPH)
+NEXT_PHASES = {name: successors(GRAPH, name) for name in GRAPH}
+REQUIRED_SLOTS = required_slots(GRAPH)
+SLOT_VALUES = slot_values(GRAPH)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Проверка графа фаз и маршрутизации без LLM")
+    parser.add_argument("message", nargs="?", help="сообщение клиента")
+    parser.add_argument("--phase", default=ENTRY)
+    parser.add_argument("--vars", default="{}", help="известные переменные, JSON")
+    args = parser.parse_args()
+    if args.message is None:
+        print(json.dumps({
+            name: {"llm": phase.llm, "rules": len(phase.rules), "pattern": phase.pattern.pattern if phase.pattern else None}
+            for name, phase in compiled.items()
+        }, ensure_ascii=False, indent=2))
+        return 0
+    phase = compiled[args.phase]
+    vars = json.loads(args.vars)
+    started = time.perf_counter()
+    next_phase, updated_vars = phase.route(args.message, vars)
+    elapsed = time.perf_counter() - started
+    result = {"next_phase": next_phase, "vars": updated_vars, "route_us": round(elapsed * 1e6, 1)}
+    if not phase.llm:
+        result["reply"] = phase.render(args.message, {**vars, **updated_vars})
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,7 @@
 # app/phases/phase1.py
-from typing import Dict, Any
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+from ..llm import register_chain
 
-llm = ChatOpenAI(model="gpt-4o", temperature=0)
-
-
-async def handle_phase1(message: str, context: str, vars: Dict) -> Dict[str, Any]:
-    prompt_text = """
+PROMPT_TEXT = """
 Ты — Анастасия, ИИ-ассистент агентства NeuroPragmat.
 Первое сообщение клиента: "{message}"
 
@@ -18,20 +12,8 @@ async def handle_phase1(message: str, context: str, vars: Dict) -> Dict[str, Any
 
 Ответ должен быть дружелюбным, профессиональным, до 400 символов.
 """
-    prompt = ChatPromptTemplate.from_template(prompt_text)
-    chain = prompt | llm
-    response = await chain.ainvoke({"message": message, "context": context})
 
-    text = message.lower()
-    if any(w in text for w in ["да", "хочу", "расскажи", "интересно", "нужно", "требуется"]):
-        next_phase = "phase2A"
-    elif any(w in text for w in ["нет", "не хочу", "не интересно"]):
-        next_phase = "phase2A"  # даже при "нет" — даём информацию
-    else:
-        next_phase = "phase1"
+register_chain("phase1", PROMPT_TEXT)
 
-    return {
-        "reply": response.content,
-        "next_phase": next_phase,
-        "vars": {}
-    }
\ No newline at end of file
+# Ответ без LLM в режиме деградации (admission)
+CANNED_REPLY = "Здравствуйте! Я Анастасия, ИИ-ассистент NeuroPragmat. Мы создаём ИИ-ассистентов, которые 24/7 квалифицируют лиды и передают их в AmoCRM. Хотите узнать подробнее?"
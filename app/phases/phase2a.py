@@ -1,13 +1,7 @@
 # app/phases/phase2a.py
-from typing import Dict, Any
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+from ..llm import register_chain
 
-llm = ChatOpenAI(model="gpt-4o", temperature=0)
-
-
-async def handle_phase2a(message: str, context: str, vars: Dict) -> Dict[str, Any]:
-    prompt_text = """
+PROMPT_TEXT = """
 Клиент заинтересован в ИИ-автоматизации.
 Сообщение клиента: "{message}"
 
@@ -17,18 +11,8 @@ async def handle_phase2a(message: str, context: str, vars: Dict) -> Dict[str, An
 
 Ответ: до 400 символов, на 'Вы', профессионально.
 """
-    prompt = ChatPromptTemplate.from_template(prompt_text)
-    chain = prompt | llm
-    response = await chain.ainvoke({"message": message, "context": context})
 
-    text = message.lower()
-    if any(w in text for w in ["звон", "созвон", "телефон", "связь"]):
-        next_phase = "phase3B"
-    else:
-        next_phase = "phase3A"
+register_chain("phase2A", PROMPT_TEXT)
 
-    return {
-        "reply": response.content,
-        "next_phase": next_phase,
-        "vars": {}
-    }
\ No newline at end of file
+# Ответ без LLM в режиме деградации (admission)
+CANNED_REPLY = "Наш ИИ-ассистент принимает первые обращения, анализирует запрос на основе вашей базы знаний и передаёт квалифицированного лида менеджеру в AmoCRM. Готовы ответить на 2 вопроса или сразу созвонимся с экспертом?"
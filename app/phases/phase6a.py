@@ -1,10 +1,27 @@
 # app/phases/phase6a.py
 import re
-from typing import Dict, Any
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+from ..llm import register_chain
 
-llm = ChatOpenAI(model="gpt-4o", temperature=0)
+PROMPT_TEXT = """
+Теперь запроси имя и телефон для связи.
+Сообщение: "{message}"
+
+Ответ: вежливо, до 300 символов.
+"""
+
+register_chain("phase6A", PROMPT_TEXT)
+
+# Ответ без LLM в режиме деградации (admission)
+CANNED_REPLY = "Отлично! Оставьте, пожалуйста, имя и телефон — менеджер свяжется с вами."
+
+PHONE_PATTERN = re.compile(r'(?:\+7|8|7)(?:[\s\-()]*\d){10}')
+NAME_PATTERN = re.compile(r'зовут\s+([^\s,.!?;:]+)', re.IGNORECASE)
+# Первые слова ответов, которые не бывают именем
+NOT_NAMES = {
+    "да", "нет", "ок", "окей", "ага", "хорошо", "конечно", "ладно", "давайте", "спасибо",
+    "привет", "здравствуйте", "добрый", "я", "мы", "мой", "моё", "мое", "мне", "меня", "вот",
+    "это", "ну", "а", "так", "телефон", "номер", "звоните", "пишите", "можно",
+}
 
 
 def normalize_phone(phone: str) -> str:
@@ -17,40 +34,24 @@ def normalize_phone(phone: str) -> str:
     return phone  # возвращаем как есть, если не распознали
 
 
-async def handle_phase6a(message: str, context: str, vars: Dict) -> Dict[str, Any]:
-    prompt_text = """
-Теперь запроси имя и телефон для связи.
-Сообщение: "{message}"
+def extract_phone(message: str) -> str:
+    phone_match = PHONE_PATTERN.search(message)
+    return normalize_phone(phone_match.group(0)) if phone_match else ""
 
-Ответ: вежливо, до 300 символов.
-"""
-    prompt = ChatPromptTemplate.from_template(prompt_text)
-    chain = prompt | llm
-    response = await chain.ainvoke({"message": message, "context": context})
-
-    # Извлечение имени (просто первое слово после "меня зовут")
-    name = ""
-    if "зовут" in message.lower():
-        parts = message.split("зовут", 1)
-        if len(parts) > 1:
-            name = parts[1].strip().split()[0]
-    elif len(message.split()) > 1:
-        name = message.split()[0]
-
-    # Извлечение телефона
-    phone_match = re.search(r'(?:\+7|8|7)(?:[\s\-()]*\d){10}', message)
-    phone = normalize_phone(phone_match.group(0)) if phone_match else ""
-
-    updated_vars = {}
-    if name:
-        updated_vars["name"] = name
-    if phone:
-        updated_vars["phone"] = phone
-
-    next_phase = "phase7" if name and phone else "phase6A"
-
-    return {
-        "reply": response.content,
-        "next_phase": next_phase,
-        "vars": updated_vars
-    }
\ No newline at end of file
+
+def _name_like(word: str) -> bool:
+    # Только буквы (двойные имена — через дефис): не кусок телефона и не "Да"
+    return word.replace("-", "").isalpha() and word.lower() not in NOT_NAMES
+
+
+def extract_name(message: str, known: str = "") -> str:
+    # Слово после "меня зовут"; иначе, пока имя неизвестно (known пусто), — первое слово
+    # сообщения из нескольких слов. Уже известное имя перезаписывает только явное "меня зовут"
+    match = NAME_PATTERN.search(message)
+    if match and _name_like(match.group(1)):
+        return match.group(1)
+    words = message.split()
+    if known or len(words) < 2:
+        return ""
+    word = words[0].strip(",.!?;:")
+    return word if _name_like(word) else ""
@@ -1,9 +1,22 @@
 # app/phases/phase7.py
-from typing import Dict, Any
+from typing import Dict
+import os
 import re
+import json
 
+from ..tokens import truncate_tokens
 
-async def handle_phase7(message: str, context: str, vars: Dict) -> Dict[str, Any]:
+# Вопрос клиента в триггере — для менеджера; длинное сообщение не должно раздувать ответ
+QUEST_MAX_TOKENS = int(os.getenv("QUEST_MAX_TOKENS", "120"))
+
+
+def _quoted(value: str) -> str:
+    # JSON-строка: кавычки и переводы строк в данных клиента не ломают разбор триггера
+    return json.dumps(value, ensure_ascii=False)
+
+
+def render_phase7(message: str, vars: Dict) -> str:
+    # Шаблонный ответ без LLM: подтверждение и триггер NEWLEAD для ретранслятора
     name = vars.get("name", "Клиент")
     phone = vars.get("phone", "")
     goal = vars.get("goal", "")
@@ -14,18 +27,18 @@ async def handle_phase7(message: str, context: str, vars: Dict) -> Dict[str, Any
     summarize = f"Клиент заинтересован в автоматизации {goal} для {business_type}. Использует CRM: {crm}."
 
     # Собираем вопросы (все, что задавал клиент — упрощённо: всё сообщение)
-    quest = message
+    quest = truncate_tokens(message, QUEST_MAX_TOKENS)
 
     # Формируем триггер
     trigger = (
         f'【systemTextByAi: {{"trigger": "NEWLEAD", '
-        f'"name": %%"{name}"%%, '
-        f'"phone": %%"{phone}"%%, '
-        f'"summarize": %%"{summarize}"%%, '
-        f'"quest": %%"{quest}"%%, '
-        f'"business_type": %%"{business_type}"%%, '
-        f'"goal": %%"{goal}"%%, '
-        f'"crm": %%"{crm}"%%}}】'
+        f'"name": %%{_quoted(name)}%%, '
+        f'"phone": %%{_quoted(phone)}%%, '
+        f'"summarize": %%{_quoted(summarize)}%%, '
+        f'"quest": %%{_quoted(quest)}%%, '
+        f'"business_type": %%{_quoted(business_type)}%%, '
+        f'"goal": %%{_quoted(goal)}%%, '
+        f'"crm": %%{_quoted(crm)}%%}}】'
     )
 
     reply = (
@@ -34,8 +47,4 @@ async def handle_phase7(message: str, context: str, vars: Dict) -> Dict[str, Any
         f"Хорошего дня!"
     )
 
-    return {
-        "reply": reply + "\n\n" + trigger,
-        "next_phase": "completed",
-        "vars": vars
-    }
\ No newline at end of file
+    return reply + "\n\n" + trigger
\ No newline at end of file
@@ -1,68 +1,463 @@
 # app/rag.py
 import os
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import hashlib
 import logging
-from typing import List
-from langchain_community.document_loaders import TextLoader, PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from .ann import INDEX_TYPE, build_ann, flat_vectors, index_spec, tune
+from .cache import TTLCache, normalize_text
+from .config import KNOWLEDGE_DIR
+from .ingest import ingest_files
+from .faq import reload_faq
+from .lexical import LexicalIndex, fuse
+from .metrics import Counter
+from .tokens import count_tokens, truncate_tokens
+from .tracing import annotate, detached_task, span
 
 logger = logging.getLogger(__name__)
-embeddings = OpenAIEmbeddings()
+# langchain/OpenAI/FAISS импортируются при первом использовании (в фоновом прогреве),
+# а не при импорте модуля — приложение поднимается и принимает webhook сразу.
+# embeddings можно подменить до прогрева (бенчмарки)
+embeddings = None
+
+# Версии индекса: INDEX_DIR/<version>/ + указатель INDEX_DIR/CURRENT
+INDEX_DIR = os.getenv("FAISS_INDEX_DIR", "/tmp/faiss_index")
+INDEX_KEEP_VERSIONS = int(os.getenv("FAISS_KEEP_VERSIONS", "2"))
+# Период проверки knowledge/ на изменения, секунд (0 — не следить)
+KNOWLEDGE_POLL_INTERVAL = float(os.getenv("KNOWLEDGE_POLL_INTERVAL", "60"))
+RETRIEVER_K = int(os.getenv("RETRIEVER_K", "3"))
+# Отсечка нерелевантных чанков: максимальное L2-расстояние до запроса (0 — без отсечки)
+RETRIEVER_SCORE_THRESHOLD = float(os.getenv("RETRIEVER_SCORE_THRESHOLD", "0"))
+# Поисковый индекс типа FAISS_INDEX_TYPE (см. ann.py) рядом с точным index.faiss
+ANN_FILE = "index.ann.faiss"
+# Несколько воркеров/машин с общим INDEX_DIR: собирает один процесс (файловая блокировка),
+# остальные подхватывают опубликованную версию. FAISS_MMAP=1 отображает файл индекса в память
+# read-only; общие страницы в faiss 1.8 — только у IVF/PQ (инвертированные списки), flat- и
+# HNSW-векторы читаются в каждый процесс. Docstore (index.pkl) и BM25 (LexicalIndex) тоже
+# копируются в каждый воркер: память растёт с WEB_CONCURRENCY почти линейно
+INDEX_MMAP = os.getenv("FAISS_MMAP", "1") == "1"
+# Индекс собран заранее (при сборке образа): процессы приложения только читают его
+INDEX_READONLY = os.getenv("FAISS_INDEX_READONLY", "0") == "1"
+# Одновременных запросов к API эмбеддингов (Fly ограничивает нас 25 соединениями)
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+# hybrid — уверенное лексическое совпадение отвечает сразу, иначе BM25 + FAISS (RRF);
+# vector — только FAISS; lexical — только BM25
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# Уверенное совпадение: лучший чанк содержит такую долю значимых слов запроса
+LEXICAL_MIN_COVERAGE = float(os.getenv("LEXICAL_MIN_COVERAGE", "0.75"))
+LEXICAL_MIN_SCORE = float(os.getenv("LEXICAL_MIN_SCORE", "0.5"))
+# Бюджет контекста базы знаний в промпте, токенов: чанки берутся по рангу, пока влезают
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "600"))
+
+retrievals = Counter(
+    "retrievals_total", "Поиски по базе знаний по пути ответа", ["path"],
+    {"path": {"lexical", "hybrid", "vector", "empty"}},
+)
+
+# Кэш эмбеддингов запросов: "да", "цена", приветствия повторяются постоянно
+query_cache = TTLCache(
+    maxsize=int(os.getenv("QUERY_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("QUERY_CACHE_TTL", "86400")),
+)
+
+SUPPORTED_EXTENSIONS = (".txt", ".md", ".pdf")
+splitter = None
+
+
+def get_embeddings():
+    global embeddings
+    if embeddings is None:
+        from langchain_openai import OpenAIEmbeddings
+        embeddings = OpenAIEmbeddings()
+    return embeddings
+
+
+def get_splitter():
+    global splitter
+    if splitter is None:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+        splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
+    return splitter
 
-def load_documents() -> List:
-    knowledge_dir = os.path.join(os.path.dirname(__file__), "..", "knowledge")
-    docs = []
-    if not os.path.exists(knowledge_dir):
-        logger.warning(f"Папка knowledge не найдена: {knowledge_dir}")
-        return docs
 
-    for filename in os.listdir(knowledge_dir):
-        if filename.startswith("."):
-            continue
-        filepath = os.path.join(knowledge_dir, filename)
+def scan_knowledge() -> Dict[str, str]:
+    # Относительный путь файла -> sha256 содержимого
+    hashes = {}
+    if not os.path.exists(KNOWLEDGE_DIR):
+        logger.warning(f"Папка knowledge не найдена: {KNOWLEDGE_DIR}")
+        return hashes
+
+    for root, dirs, files in os.walk(KNOWLEDGE_DIR):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for filename in files:
+            if filename.startswith(".") or not filename.endswith(SUPPORTED_EXTENSIONS):
+                continue
+            filepath = os.path.join(root, filename)
+            with open(filepath, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            hashes[os.path.relpath(filepath, KNOWLEDGE_DIR)] = digest
+    return hashes
+
+
+def _read_current_version() -> Optional[str]:
+    try:
+        with open(os.path.join(INDEX_DIR, "CURRENT"), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _load_version(version: str, mmap: bool = False, search: bool = False):
+    # mmap=True — только для чтения (поиск); сборщику нужна изменяемая копия точного индекса.
+    # search=True — для поиска берётся ANN-индекс версии, если он собран
+    path = os.path.join(INDEX_DIR, version)
+    with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    from langchain_community.vectorstores import FAISS
+
+    ann = search and manifest.get("index", {}).get("type", "flat") != "flat"
+    if mmap or ann:
         try:
-            if filename.endswith((".txt", ".md")):
-                loader = TextLoader(filepath, encoding="utf-8")
-                docs.extend(loader.load())
-                logger.info(f"Загружен: {filename}")
-            elif filename.endswith(".pdf"):
-                loader = PyPDFLoader(filepath)
-                docs.extend(loader.load())
-                logger.info(f"Загружен PDF: {filename}")
+            return _load_index(FAISS, path, ANN_FILE if ann else "index.faiss", mmap), manifest
         except Exception as e:
-            logger.error(f"Ошибка {filename}: {e}")
-    return docs
+            logger.warning(f"Загрузка индекса {version} (mmap={mmap}, ann={ann}) не удалась ({e}), читаем целиком")
+    store = FAISS.load_local(path, get_embeddings(), allow_dangerous_deserialization=True)
+    return store, manifest
 
-def create_or_load_vectorstore():
-    faiss_path = "/tmp/faiss_index"
-    if os.path.exists(faiss_path):
+
+def _load_index(FAISS, path: str, filename: str, mmap: bool):
+    # То же, что FAISS.load_local, но с выбором файла индекса; при mmap файл отображается
+    # в память read-only (см. INDEX_MMAP: общими получаются не все типы индекса).
+    # docstore распаковывается в каждом процессе
+    import pickle
+    import faiss
+
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    index = tune(faiss.read_index(os.path.join(path, filename), flags))
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(get_embeddings(), index, docstore, index_to_docstore_id)
+
+
+def _build_ann(store, path: str) -> Dict:
+    # Поисковый индекс из векторов точного: порядок позиций (и index_to_docstore_id) тот же
+    spec = {"type": "flat", "requested": INDEX_TYPE}
+    if INDEX_TYPE == "flat" or not store.index.ntotal:
+        return spec
+    spec = index_spec(store.index.ntotal, store.index.d)
+    if spec["type"] == "flat":
+        logger.info(f"Чанков {store.index.ntotal} мало для {INDEX_TYPE}, поиск остаётся точным")
+        return spec
+    import faiss
+
+    started = time.monotonic()
+    faiss.write_index(build_ann(flat_vectors(store.index), spec), os.path.join(path, ANN_FILE))
+    logger.info(f"ANN-индекс {spec} собран за {time.monotonic() - started:.1f} с")
+    return spec
+
+
+def _manifest_hashes(manifest: Dict) -> Dict[str, str]:
+    return {p: e["sha256"] for p, e in manifest["files"].items()}
+
+
+def _requested_type(manifest: Dict) -> str:
+    # Версии до ANN-индексов — flat
+    return manifest.get("index", {}).get("requested", "flat")
+
+
+def _publish_version(store, files: Dict[str, Dict]) -> str:
+    version = time.strftime("v%Y%m%dT%H%M%S") + f"-{uuid.uuid4().hex[:6]}"
+    final_path = os.path.join(INDEX_DIR, version)
+    tmp_path = final_path + ".tmp"
+    store.save_local(tmp_path)
+    spec = _build_ann(store, tmp_path)
+    with open(os.path.join(tmp_path, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": version, "files": files, "index": spec}, f, ensure_ascii=False)
+    os.rename(tmp_path, final_path)
+
+    # Указатель на активную версию меняется атомарно через os.replace
+    pointer_tmp = os.path.join(INDEX_DIR, f"CURRENT.{uuid.uuid4().hex}")
+    with open(pointer_tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(pointer_tmp, os.path.join(INDEX_DIR, "CURRENT"))
+
+    _cleanup_versions(keep=version)
+    return version
+
+
+def _cleanup_versions(keep: str):
+    versions = sorted(
+        d for d in os.listdir(INDEX_DIR)
+        if d.startswith("v") and os.path.isdir(os.path.join(INDEX_DIR, d))
+    )
+    stale = [v for v in versions if v != keep][:-(INDEX_KEEP_VERSIONS - 1) or None]
+    for version in stale:
+        shutil.rmtree(os.path.join(INDEX_DIR, version), ignore_errors=True)
+
+
+def build_index(hashes: Dict[str, str], base_version: Optional[str] = None):
+    # Переэмбеддим только добавленные и изменённые файлы, чанки удалённых вычищаем по ID
+    store, old_files = None, {}
+    if base_version:
         try:
-            return FAISS.load_local(faiss_path, embeddings, allow_dangerous_deserialization=True)
+            store, manifest = _load_version(base_version)
+            old_files = manifest["files"]
         except Exception as e:
-            logger.warning(f"Ошибка загрузки индекса: {e}")
+            logger.warning(f"Ошибка загрузки индекса {base_version}: {e}")
 
-    logger.info("Создаём FAISS-индекс...")
-    docs = load_documents()
-    if not docs:
-        logger.warning("Нет документов")
-        return None
+    stale_ids = [
+        chunk_id
+        for relpath, entry in old_files.items()
+        if hashes.get(relpath) != entry["sha256"]
+        for chunk_id in entry["chunks"]
+    ]
+    files = {p: e for p, e in old_files.items() if hashes.get(p) == e["sha256"]}
+    to_embed = [p for p in hashes if p not in files]
+
+    if store is not None and stale_ids:
+        store.delete(stale_ids)
+    if to_embed:
+        store, chunk_ids = ingest_files(
+            [(p, hashes[p]) for p in to_embed], KNOWLEDGE_DIR, get_embeddings(), get_splitter(), store=store
+        )
+        for relpath in to_embed:
+            files[relpath] = {"sha256": hashes[relpath], "chunks": chunk_ids.get(relpath, [])}
+
+    logger.info(
+        f"Индекс: +{len(to_embed)} файлов к эмбеддингу, "
+        f"{len(stale_ids)} устаревших чанков удалено"
+    )
+    if store is None:
+        return None, None
+    version = _publish_version(store, files)
+    logger.info(f"Индекс сохранён: {version}")
+    return store, version
+
+
+@contextmanager
+def _index_lock():
+    # Блокировка сборки между потоками и между процессами (воркеры uvicorn на одной машине)
+    import fcntl
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-    chunks = splitter.split_documents(docs)
-    vectorstore = FAISS.from_documents(chunks, embeddings)
-    vectorstore.save_local(faiss_path)
-    logger.info(f"Индекс сохранён в {faiss_path}")
+    with _build_lock, open(os.path.join(INDEX_DIR, ".build.lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _activate_current(hashes: Optional[Dict[str, str]]) -> bool:
+    # Подхватывает опубликованную версию (в том числе собранную другим процессом).
+    # True — активна версия, собранная из hashes индексом FAISS_INDEX_TYPE (None — любая)
+    version = _read_current_version()
+    if not version:
+        return False
+    if version == index_version:
+        return hashes is None or (hashes == _active_hashes and _active_index_type == INDEX_TYPE)
+    try:
+        store, manifest = _load_version(version, mmap=INDEX_MMAP, search=True)
+    except Exception as e:
+        logger.warning(f"Ошибка загрузки индекса {version}: {e}")
+        return False
+    if hashes is not None and (_manifest_hashes(manifest) != hashes or _requested_type(manifest) != INDEX_TYPE):
+        return False
+    _set_active(store, version)
+    return True
+
+
+def sync_index() -> bool:
+    # Приводит активный индекс к содержимому knowledge/; True — если активная версия сменилась
+    before = index_version
+    if INDEX_READONLY:
+        with _build_lock:
+            _activate_current(None)
+        return index_version != before
+
+    hashes = scan_knowledge()
+    with _build_lock:
+        if _activate_current(hashes) or not hashes:
+            return index_version != before
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    with _index_lock():
+        # Пока ждали блокировку, другой процесс мог уже собрать нужную версию
+        if not _activate_current(hashes):
+            logger.info("Обновляем FAISS-индекс...")
+            # Другой тип индекса при тех же файлах — новая версия без переэмбеддинга
+            store, version = build_index(hashes, base_version=_read_current_version())
+            # Для поиска версия перечитывается с диска: ANN-индекс и mmap вместо точной копии
+            if store is not None and not _activate_current(hashes):
+                _set_active(store, version)
+    return index_version != before
+
+
+def create_or_load_vectorstore():
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    sync_index()
+    if vectorstore is None:
+        logger.warning("Нет документов" if not INDEX_READONLY else f"Нет готового индекса в {INDEX_DIR}")
     return vectorstore
 
+
+vectorstore = None
 retriever = None
+lexical_index: Optional[LexicalIndex] = None
+index_version: Optional[str] = None
+_active_hashes: Dict[str, str] = {}
+_active_index_type = "flat"
+_build_lock = threading.Lock()
+
+
+def _search_kwargs() -> Dict:
+    return {"score_threshold": RETRIEVER_SCORE_THRESHOLD} if RETRIEVER_SCORE_THRESHOLD > 0 else {}
+
+
+def _set_active(store, version: str):
+    global vectorstore, retriever, lexical_index, index_version, _active_hashes, _active_index_type
+    with open(os.path.join(INDEX_DIR, version, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    # BM25 строится по тем же чанкам, что лежат в FAISS (docstore), при каждой подмене версии
+    lexical = LexicalIndex(list(store.docstore._dict.values()))
+    # Читатели берут ссылки на индексы один раз, поэтому подмена атомарна
+    _active_hashes = {p: e["sha256"] for p, e in manifest["files"].items()}
+    _active_index_type = _requested_type(manifest)
+    retriever = store.as_retriever(search_kwargs={"k": RETRIEVER_K, **_search_kwargs()})
+    lexical_index = lexical
+    vectorstore = store
+    index_version = version
+
 
 def init_retriever():
-    global retriever
-    vectorstore = create_or_load_vectorstore()
-    if vectorstore:
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
-        logger.info("✅ Retriever инициализирован")
+    # FAQ не зависит от эмбеддингов: готов, даже если индекс не собрался
+    reload_faq(KNOWLEDGE_DIR)
+    store = create_or_load_vectorstore()
+    if store:
+        logger.info(f"✅ Retriever инициализирован ({index_version})")
     else:
-        retriever = None
-        logger.warning("⚠️ Retriever не создан")
\ No newline at end of file
+        logger.warning("⚠️ Retriever не создан")
+
+
+def refresh_index() -> bool:
+    # Пересобирает индекс, если knowledge/ изменилась, или подхватывает версию,
+    # опубликованную другим процессом, и подменяет активный retriever
+    if not sync_index():
+        return False
+    reload_faq(KNOWLEDGE_DIR)
+    logger.info(f"🔄 Индекс обновлён без рестарта: {index_version}")
+    return True
+
+
+async def watch_knowledge():
+    while True:
+        await asyncio.sleep(KNOWLEDGE_POLL_INTERVAL)
+        try:
+            await asyncio.to_thread(refresh_index)
+        except Exception as e:
+            logger.error(f"Ошибка обновления индекса: {e}")
+
+
+_embed_semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+# Запросы эмбеддингов в полёте: одинаковые сообщения ждут один и тот же вызов API
+_pending_embeddings: Dict[str, asyncio.Task] = {}
+
+
+async def _embed(key: str) -> List[float]:
+    try:
+        async with _embed_semaphore:
+            vector = await get_embeddings().aembed_query(key)
+        query_cache.set(key, vector)
+        return vector
+    finally:
+        _pending_embeddings.pop(key, None)
+
+
+async def embed_query(text: str) -> List[float]:
+    key = normalize_text(text) or text
+    vector = query_cache.get(key)
+    if vector is not None:
+        return vector
+    task = _pending_embeddings.get(key)
+    if task is None:
+        # Вызов общий для одинаковых сообщений разных ходов — вне трассы первого из них
+        task = detached_task(_embed(key))
+        _pending_embeddings[key] = task
+    return await asyncio.shield(task)
+
+
+async def aretrieve(text: str, k: int = RETRIEVER_K) -> List:
+    store, lexical = vectorstore, lexical_index
+    if store is None:
+        retrievals.inc(path="empty")
+        return []
+
+    hits = []
+    if RETRIEVAL_MODE != "vector" and lexical is not None:
+        # BM25 по нескольким сотням чанков — доли миллисекунды, прямо в event loop
+        with span("lexical", profile=True):
+            hits, coverage = lexical.search(text, k)
+        confident = hits and coverage >= LEXICAL_MIN_COVERAGE and hits[0][1] >= LEXICAL_MIN_SCORE
+        if confident or RETRIEVAL_MODE == "lexical":
+            retrievals.inc(path="lexical")
+            annotate(path="lexical")
+            return [doc for doc, _ in hits]
+
+    with span("embed"):
+        vector = await embed_query(text)
+    # Поиск FAISS — CPU-работа, уводим её с event loop
+    with span("faiss"):
+        docs = await asyncio.to_thread(store.similarity_search_by_vector, vector, k, **_search_kwargs())
+    if not hits:
+        retrievals.inc(path="vector")
+        annotate(path="vector")
+        return docs
+    retrievals.inc(path="hybrid")
+    annotate(path="hybrid")
+    return fuse([doc for doc, _ in hits], docs, k=k)
+
+
+def fit_context(chunks: List[str], budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    # Чанки уже отсортированы по релевантности: берём по порядку, пока влезают в бюджет;
+    # первый чанк, если он один больше бюджета, обрезается
+    selected, used = [], 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk)
+        if used + tokens > budget:
+            if not selected:
+                selected.append(truncate_tokens(chunk, budget))
+            break
+        selected.append(chunk)
+        used += tokens
+    return "\n".join(selected)
+
+
+async def get_context(text: str) -> str:
+    try:
+        docs = await aretrieve(text)
+    except Exception as e:
+        logger.error(f"Ошибка RAG: {e}")
+        return ""
+    with span("context_fit", profile=True):
+        return fit_context([d.page_content for d in docs])
+
+
+class LazyContext:
+    # Контекст базы знаний для одного сообщения: retrieval запускается только при первом чтении
+    def __init__(self, text: str):
+        self.text = text
+        self._task = None
+
+    @property
+    def requested(self) -> bool:
+        return self._task is not None
+
+    async def get(self) -> str:
+        if self._task is None:
+            self._task = asyncio.ensure_future(get_context(self.text))
+        return await self._task
@@ -0,0 +1,65 @@
+# app/telegram_stream.py
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+
+from telegram import Message
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+# Telegram не любит частые правки одного сообщения: не чаще раза в секунду
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Первое сообщение отправляем, когда набралось хотя бы столько символов
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "20"))
+
+
+class TelegramReplyStream:
+    # Ответ, который по мере генерации дописывается в одно сообщение Telegram
+    def __init__(self, message: Message):
+        self.message = message
+        self.sent: Optional[Message] = None
+        self.text = ""
+        self._shown = ""
+        self._next_edit = 0.0
+
+    async def start(self):
+        try:
+            await self.message.reply_chat_action(ChatAction.TYPING)
+        except Exception as e:
+            logger.warning(f"Ошибка отправки typing: {e}")
+
+    async def push(self, token: str):
+        self.text += token
+        if len(self.text.strip()) < STREAM_MIN_CHARS or time.monotonic() < self._next_edit:
+            return
+        await self._flush(self.text)
+
+    async def _flush(self, text: str, final: bool = False):
+        if not text.strip() or text == self._shown:
+            return
+        try:
+            if self.sent is None:
+                self.sent = await self.message.reply_text(text)
+            else:
+                await self.sent.edit_text(text)
+            self._shown = text
+            self._next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        except RetryAfter as e:
+            if not final:
+                self._next_edit = time.monotonic() + float(e.retry_after)
+                return
+            # Финальный текст обязан дойти: ждём, сколько просит Telegram, и повторяем
+            await asyncio.sleep(float(e.retry_after))
+            await self._flush(text, final=True)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+
+    async def finish(self, text: str):
+        self.text = text
+        await self._flush(text, final=True)
@@ -0,0 +1,67 @@
+# app/tokens.py
+# Локальный подсчёт токенов (tiktoken) для бюджета промптов и резерва TPM.
+# Кодировка грузится при старте до приёма сообщений (первая загрузка может скачивать
+# BPE-файлы, в образе они уже лежат в TIKTOKEN_CACHE_DIR); без tiktoken — оценка по символам.
+import os
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_MODEL = os.getenv("LLM_MODEL", "gpt-4o")
+# Сообщение клиента длиннее этого обрезается до попадания в шаблоны, кэш и триггер
+MESSAGE_MAX_TOKENS = int(os.getenv("MESSAGE_MAX_TOKENS", "400"))
+# Грубая оценка без токенизатора: ~3 символа на токен для русского текста
+CHARS_PER_TOKEN = 3
+ELLIPSIS = "…"
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def get_encoding(blocking: bool = True):
+    # None — tiktoken недоступен (нет пакета или файла кодировки), считаем по символам.
+    # blocking=False — только уже загруженная кодировка (вызов из event loop): загрузка
+    # может качать файлы под _encoding_lock, пока её нет — тоже считаем по символам
+    global _encoding
+    if _encoding is None:
+        if not blocking:
+            return None
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+                    try:
+                        _encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+                    except KeyError:
+                        _encoding = tiktoken.get_encoding("o200k_base")
+                except Exception as e:
+                    logger.warning(f"tiktoken недоступен ({e}), токены оцениваются по символам")
+                    _encoding = False
+    return _encoding or None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, limit: int, blocking: bool = True) -> str:
+    if limit <= 0:
+        return ""
+    encoding = get_encoding(blocking)
+    if encoding is None:
+        max_chars = limit * CHARS_PER_TOKEN
+        return text if len(text) <= max_chars else text[:max_chars].rstrip() + ELLIPSIS
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= limit:
+        return text
+    return encoding.decode(tokens[:limit]).rstrip() + ELLIPSIS
+
+
+def cap_message(text: str, limit: Optional[int] = None) -> str:
+    # Вызывается в обработчике сообщения, в event loop: блокирующую загрузку не ждём
+    return truncate_tokens(text, MESSAGE_MAX_TOKENS if limit is None else limit, blocking=False)
@@ -0,0 +1,311 @@
+# app/tracing.py
+# Трассировка медленных ходов: span'ы (вложенные, монотонное время) собираются в памяти на
+# время хода, и только ход дольше TRACE_SLOW_SECONDS дописывается строкой в JSONL.
+# Запись — в фоновом потоке, не чаще TRACE_MAX_PER_MINUTE, файл ротируется по размеру:
+# при перегрузке медленный почти каждый ход, и трассировка не должна её усиливать.
+# Часть ходов (TRACE_PROFILE_RATE) дополнительно профилируется cProfile — только
+# синхронные CPU-стадии (span(..., profile=True)), где профиль не смешан с другими задачами.
+# Без активного хода span() — общий nullcontext, накладные расходы — одно чтение ContextVar.
+#
+# Сводка по стадиям самых медленных ходов:
+#   python -m app.tracing traces/slow.jsonl --top 10
+import os
+import sys
+import json
+import asyncio
+import contextvars
+import time
+import uuid
+import random
+import logging
+import argparse
+import glob
+import queue
+import cProfile
+import pstats
+import threading
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+# Ходы дольше порога (секунды) пишутся в TRACE_FILE
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "5"))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces/slow.jsonl")
+# Доля ходов с cProfile; профиль сохраняется, только если ход оказался медленным
+TRACE_PROFILE_RATE = float(os.getenv("TRACE_PROFILE_RATE", "0"))
+PROFILE_TOP = 15
+# Сколько медленных ходов записать за минуту; остальные только считаются (dropped)
+TRACE_MAX_PER_MINUTE = int(os.getenv("TRACE_MAX_PER_MINUTE", "30"))
+# Размер TRACE_FILE, после которого он переименовывается в .1 (предыдущий .1 удаляется)
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(50 * 2 ** 20)))
+# Не больше стольких .prof рядом с TRACE_FILE; сверх — только сводка в JSONL
+TRACE_MAX_PROFILES = int(os.getenv("TRACE_MAX_PROFILES", "200"))
+# Очередь к потоку записи; переполнена — трасса отбрасывается
+TRACE_QUEUE_SIZE = 100
+
+_NOOP = nullcontext()
+
+
+class Span:
+    __slots__ = ("id", "parent", "name", "start", "end", "attrs")
+
+    def __init__(self, id: int, parent: Optional[int], name: str, attrs: Dict[str, Any]):
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.start = time.monotonic()
+        self.end = None
+        self.attrs = attrs
+
+
+class Trace:
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.id = uuid.uuid4().hex[:16]
+        self.spans: List[Span] = []
+        self.profiled = random.random() < TRACE_PROFILE_RATE
+        self.profiles: List[tuple] = []  # (span id, cProfile.Profile)
+        self.profiling = False
+        self.root = self.open(name, None, attrs)
+
+    def open(self, name: str, parent: Optional[Span], attrs: Dict[str, Any]) -> Span:
+        span = Span(len(self.spans), parent.id if parent else None, name, attrs)
+        self.spans.append(span)
+        return span
+
+    def to_dict(self) -> Dict[str, Any]:
+        origin = self.root.start
+        return {
+            "trace_id": self.id,
+            "name": self.root.name,
+            "ts": time.time() - (time.monotonic() - origin),
+            "duration_ms": _ms(self.root.end - origin),
+            "attrs": self.root.attrs,
+            "spans": [
+                {
+                    "id": span.id,
+                    "parent": span.parent,
+                    "name": span.name,
+                    "start_ms": _ms(span.start - origin),
+                    # Незакрытый span (задача ещё идёт после ответа) — без длительности
+                    "duration_ms": _ms(span.end - span.start) if span.end is not None else None,
+                    **({"attrs": span.attrs} if span.attrs else {}),
+                }
+                for span in self.spans[1:]
+            ],
+            "profiles": [_profile_summary(span_id, profile) for span_id, profile in self.profiles],
+        }
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_span: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+stats = {"traces": 0, "written": 0, "dropped": 0, "errors": 0}
+_window = [0.0, 0]  # начало текущей минуты, записей в ней
+_queue: "queue.Queue[Trace]" = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+_writer: Optional[threading.Thread] = None
+_writer_lock = threading.Lock()
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+def _profile_summary(span_id: int, profile: cProfile.Profile) -> Dict[str, Any]:
+    # Топ функций по накопленному времени; полный профиль — в .prof рядом с TRACE_FILE
+    entries = sorted(pstats.Stats(profile).stats.items(), key=lambda item: -item[1][3])[:PROFILE_TOP]
+    return {
+        "span": span_id,
+        "top": [
+            {"func": f"{os.path.basename(file)}:{line}:{func}", "calls": calls, "cum_ms": _ms(cumtime)}
+            for (file, line, func), (_, calls, _, cumtime, _) in entries
+        ],
+    }
+
+
+@contextmanager
+def _open_span(trace: Trace, name: str, profile: bool, attrs: Dict[str, Any]):
+    span = trace.open(name, _span.get(), attrs)
+    token = _span.set(span)
+    profiler = None
+    if profile and trace.profiled and not trace.profiling:
+        # Один профилировщик на поток: вложенные profile-span'ы входят во внешний
+        profiler = cProfile.Profile()
+        trace.profiling = True
+        profiler.enable()
+    try:
+        yield span
+    except BaseException as e:
+        span.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            trace.profiling = False
+            trace.profiles.append((span.id, profiler))
+        span.end = time.monotonic()
+        _span.reset(token)
+
+
+def span(name: str, profile: bool = False, **attrs):
+    # Вложенный span текущего хода; вне хода (или при TRACE_ENABLED=0) — ничего не делает
+    current = _trace.get()
+    if current is None:
+        return _NOOP
+    return _open_span(current, name, profile, attrs)
+
+
+def detached_task(coro) -> "asyncio.Future":
+    # Фоновая задача, общая для нескольких ходов (пачка квалификации, общий эмбеддинг):
+    # запускается в пустом контексте, иначе её span'ы попадут в трассу первого вызвавшего
+    # и останутся незакрытыми, когда эта трасса уже записана
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+
+def annotate(**attrs):
+    # Дописать атрибуты в текущий span (фаза, путь retrieval, токены)
+    current = _span.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+
+@contextmanager
+def trace(name: str, **attrs):
+    # Корневой span хода; медленный ход по выходе дописывается в TRACE_FILE
+    if not TRACE_ENABLED:
+        yield None
+        return
+    current = Trace(name, attrs)
+    trace_token = _trace.set(current)
+    span_token = _span.set(current.root)
+    try:
+        yield current
+    except BaseException as e:
+        current.root.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        current.root.end = time.monotonic()
+        _span.reset(span_token)
+        _trace.reset(trace_token)
+        stats["traces"] += 1
+        if current.root.end - current.root.start >= TRACE_SLOW_SECONDS:
+            _submit(current)
+
+
+def _admit() -> bool:
+    # Ограничение частоты записи: окно в минуту
+    now = time.monotonic()
+    if now - _window[0] >= 60:
+        _window[0], _window[1] = now, 0
+    if _window[1] >= TRACE_MAX_PER_MINUTE:
+        return False
+    _window[1] += 1
+    return True
+
+
+def _submit(current: Trace):
+    # Из event loop — только постановка в очередь; сериализация, pstats и файлы — в потоке
+    global _writer
+    if not _admit():
+        stats["dropped"] += 1
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, name="trace-writer", daemon=True)
+            _writer.start()
+    try:
+        _queue.put_nowait(current)
+    except queue.Full:
+        stats["dropped"] += 1
+
+
+def _write_loop():
+    while True:
+        _write(_queue.get())
+
+
+def _rotate():
+    try:
+        if os.path.getsize(TRACE_FILE) >= TRACE_MAX_BYTES:
+            os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+    except FileNotFoundError:
+        pass
+
+
+def _write(current: Trace):
+    try:
+        directory = os.path.dirname(TRACE_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        prefix = os.path.splitext(TRACE_FILE)[0]
+        if current.profiles and len(glob.glob(f"{glob.escape(prefix)}.*.prof")) < TRACE_MAX_PROFILES:
+            for span_id, profile in current.profiles:
+                profile.dump_stats(f"{prefix}.{current.id}.{span_id}.prof")
+        line = json.dumps(current.to_dict(), ensure_ascii=False, default=str) + "\n"
+        _rotate()
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line)
+        stats["written"] += 1
+    except Exception as e:
+        stats["errors"] += 1
+        logger.warning(f"Не удалось записать трассу {current.id}: {e}")
+
+
+def trace_stats() -> Dict[str, Any]:
+    return {"enabled": TRACE_ENABLED, "slow_seconds": TRACE_SLOW_SECONDS, "file": TRACE_FILE,
+            "queued": _queue.qsize(), **stats}
+
+
+def summarize(records: List[Dict[str, Any]], top: int) -> Dict[str, Any]:
+    # Стадии: сколько раз встретились, сколько заняли и какую долю хода в среднем
+    records = sorted(records, key=lambda r: -r["duration_ms"])[:top]
+    stages: Dict[str, List[float]] = {}
+    shares: Dict[str, float] = {}
+    for record in records:
+        for item in record["spans"]:
+            if item["duration_ms"] is None:
+                continue
+            stages.setdefault(item["name"], []).append(item["duration_ms"])
+            shares[item["name"]] = shares.get(item["name"], 0.0) + item["duration_ms"] / max(record["duration_ms"], 1e-3)
+
+    def slowest_leaf(record):
+        parents = {item["parent"] for item in record["spans"]}
+        leaves = [item for item in record["spans"] if item["id"] not in parents and item["duration_ms"] is not None]
+        return max(leaves, key=lambda item: item["duration_ms"])["name"] if leaves else None
+
+    return {
+        "traces": len(records),
+        "stages": {
+            name: {
+                "count": len(values),
+                "mean_ms": round(sum(values) / len(values), 2),
+                "max_ms": max(values),
+                "mean_share": round(shares[name] / len(records), 3),
+            }
+            for name, values in sorted(stages.items(), key=lambda kv: -sum(kv[1]))
+        },
+        "slowest": [
+            {"trace_id": r["trace_id"], "duration_ms": r["duration_ms"], "attrs": r["attrs"],
+             "bottleneck": slowest_leaf(r)}
+            for r in records
+        ],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Сводка по медленным ходам из JSONL-трасс")
+    parser.add_argument("path", nargs="?", default=TRACE_FILE)
+    parser.add_argument("--top", type=int, default=20, help="сколько самых медленных ходов разбирать")
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        print(f"Нет файла трасс {args.path}", file=sys.stderr)
+        return 1
+    with open(args.path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    print(json.dumps(summarize(records, args.top), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+# app/turn.py
+# Комбинированный ход: один structured-output запрос возвращает ответ клиенту, слоты,
+# квалификацию лида и предложение следующей фазы. Эвристики фаз (route_*) остаются
+# быстрым валидатором и запасным вариантом.
+import os
+import re
+import logging
+from typing import Any, Dict
+
+from pydantic import BaseModel, Field
+
+from .agents import LeadInfo
+from .llm import PRIORITY, LLMOverloaded, register_chain, ainvoke, chains, trim_inputs
+from .metrics import fallbacks
+from .phases import get_phase
+# Порядок воронки, допустимые переходы, обязательные слоты и их значения — из графа фаз
+from .phases.graph import FUNNEL, NEXT_PHASES, REQUIRED_SLOTS, SLOT_VALUES
+from .phases.phase6a import extract_phone
+from .tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+COMBINED_TURN = os.getenv("COMBINED_TURN", "0") == "1"
+
+
+class TurnResult(BaseModel):
+    reply: str = Field(description="ответ клиенту по задаче текущего шага")
+    goal: str = Field(default="", description="цель автоматизации, если клиент её назвал")
+    business_type: str = Field(default="", description="тип бизнеса, если клиент его назвал")
+    crm: str = Field(default="", description="какая CRM используется, если клиент сказал")
+    name: str = Field(default="", description="имя клиента, если он представился")
+    phone: str = Field(default="", description="телефон клиента, если он его написал")
+    lead: LeadInfo = Field(default_factory=LeadInfo, description="квалификация лида")
+    next_phase: str = Field(description="следующий шаг воронки")
+
+
+TURN_PROMPT = """{instructions}
+
+Уже известно о клиенте: {known}
+Шаги воронки по порядку: {funnel}. Текущий шаг: {phase}.
+
+Заполни поля:
+- reply — ответ клиенту строго по задаче выше;
+- goal ({goals}), business_type ({business_types}), crm ({crms}), name, phone —
+  только если клиент явно сообщил это в своём сообщении, иначе пустая строка;
+- lead — намерение (заказать_услугу, узнать_цену, связаться_с_менеджером, задать_вопрос),
+  резюме в одно предложение и is_hot, если клиент проявил интерес;
+- next_phase — {phase}, если клиент не ответил на вопрос шага, иначе следующий шаг воронки.
+"""
+
+register_chain(
+    "turn",
+    TURN_PROMPT,
+    schema=TurnResult,
+    funnel=", ".join(FUNNEL),
+    goals=", ".join(SLOT_VALUES["goal"]),
+    business_types=", ".join(SLOT_VALUES["business_type"]),
+    crms=", ".join(SLOT_VALUES["crm"]),
+)
+
+
+class _Vars(dict):
+    def __missing__(self, key):
+        return ""
+
+
+def _validated_slots(result: TurnResult, heuristic: Dict[str, Any], message: str) -> Dict[str, Any]:
+    slots = {}
+    for slot, allowed in SLOT_VALUES.items():
+        value = getattr(result, slot).strip().lower()
+        match = next((a for a in allowed if a.lower() == value), None)
+        if match:
+            slots[slot] = match
+        elif slot in heuristic:
+            slots[slot] = heuristic[slot]
+
+    # Имя и телефон принимаем, только если они действительно есть в сообщении
+    name = result.name.strip()
+    if name and name.lower() in message.lower():
+        slots["name"] = name
+    elif heuristic.get("name"):
+        slots["name"] = heuristic["name"]
+
+    phone = extract_phone(message)
+    llm_phone = extract_phone(result.phone)
+    # Без кода страны: в сообщении номер мог быть записан через 8
+    if not phone and llm_phone and llm_phone[2:] in re.sub(r"\D", "", message):
+        phone = llm_phone
+    if phone:
+        slots["phone"] = phone
+    return slots
+
+
+def _validated_next(phase: str, proposed: str, heuristic: str, known: Dict[str, Any]) -> str:
+    # Модель выбирает только среди переходов фазы в графе
+    if proposed != phase and proposed not in NEXT_PHASES.get(phase, []):
+        return heuristic
+    if any(not known.get(slot) for slot in REQUIRED_SLOTS.get(proposed, [])):
+        return heuristic
+    return proposed
+
+
+async def combined_turn(phase_name: str, message: str, context: str, vars: Dict) -> Dict[str, Any]:
+    phase = get_phase(phase_name)
+    heuristic_next, heuristic_vars = phase.route(message, vars)
+
+    known = ", ".join(f"{k}={v}" for k, v in vars.items() if k in SLOT_VALUES or k in ("name", "phone")) or "ничего"
+    # Сообщение и контекст попадают в промпт внутри instructions, где fit_inputs цепочки turn
+    # их уже не видит: урезаем их заранее под бюджет turn за вычетом остального промпта
+    turn, phase_chain = chains["turn"], chains[phase_name]
+    inputs, _ = trim_inputs(
+        "turn", phase_chain.template, phase_chain.template_tokens,
+        turn.budget - turn.template_tokens - count_tokens(known) - count_tokens(phase_name),
+        {**vars, "message": message, "context": context},
+    )
+    instructions = phase_chain.template.format_map(_Vars(inputs))
+    try:
+        result: TurnResult = await ainvoke("turn", {
+            "instructions": instructions,
+            "known": known,
+            "phase": phase_name,
+        }, priority=PRIORITY.get(phase_name, 5))
+    except LLMOverloaded:
+        # Очередь к LLM переполнена — второй вызов через обычную фазу ждал бы так же
+        raise
+    except Exception as e:
+        # Структурированный ответ не получился — обычный путь фазы
+        fallbacks.inc(kind="combined_turn")
+        logger.warning(f"Комбинированный ход не удался ({e}), обычная фаза {phase_name}")
+        return await phase.handler(message, context, vars)
+
+    slots = _validated_slots(result, heuristic_vars, message)
+    next_phase = _validated_next(phase_name, result.next_phase, heuristic_next, {**vars, **slots})
+    lead = result.lead
+    slots.update({"intent": lead.intent, "summary": lead.summary, "is_hot": lead.is_hot})
+
+    return {
+        "reply": result.reply,
+        "next_phase": next_phase,
+        "vars": slots
+    }
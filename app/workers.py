@@ -0,0 +1,110 @@
+# app/workers.py
+import time
+import asyncio
+import logging
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Сколько текущая задача пролежала в очереди пула, секунды (для дедлайна ожидания)
+queue_wait: ContextVar[float] = ContextVar("queue_wait", default=0.0)
+
+
+class KeyedWorkerPool:
+    # Ограниченный пул asyncio-воркеров: задачи одного ключа (user_id) выполняются строго
+    # по порядку, разные ключи — параллельно. Очередь ограничена max_pending.
+    def __init__(self, handler: Callable[[Any], Awaitable[None]], workers: int = 16, max_pending: int = 500):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_wait = 0.0
+        self._queues: Dict[str, Deque[Tuple[Any, float]]] = {}
+        self._ready: "asyncio.Queue[str]" = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max_pending)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 4.0):
+        # Даём дообработать очередь, затем останавливаем воркеры
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Остановка пула: не обработано {self.pending} обновлений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, key: str, item: Any, timeout: float = 1.0) -> bool:
+        # Backpressure: если очередь полна дольше timeout — отказываем, вызывающий вернёт 503
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            logger.warning(f"Пул воркеров переполнен: {self.pending}/{self.max_pending}")
+            return False
+
+        self.pending += 1
+        self._idle.clear()
+        queue = self._queues.get(key)
+        if queue is None:
+            self._queues[key] = deque([(item, time.monotonic())])
+            self._ready.put_nowait(key)
+        else:
+            queue.append((item, time.monotonic()))
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            # Элемент остаётся в очереди до конца обработки, чтобы новые сообщения
+            # этого пользователя встали за ним, а не ушли другому воркеру
+            while queue:
+                item, enqueued_at = queue[0]
+                waited = time.monotonic() - enqueued_at
+                self.max_wait = max(self.max_wait, waited)
+                queue_wait.set(waited)
+                self.busy += 1
+                try:
+                    await self.handler(item)
+                    self.processed += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Ошибка обработки обновления: {e}")
+                finally:
+                    self.busy -= 1
+                    queue.popleft()
+                    self.pending -= 1
+                    self._slots.release()
+            del self._queues[key]
+            if self.pending == 0:
+                self._idle.set()
+
+    def stats(self) -> Dict[str, Any]:
+        oldest = min((q[0][1] for q in self._queues.values() if q), default=None)
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "users_queued": len(self._queues),
+            "oldest_wait": round(time.monotonic() - oldest, 3) if oldest else 0.0,
+            "max_wait": round(self.max_wait, 3),
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,169 @@
+# benchmarks/ann.py
+# Бенчмарк типов FAISS-индекса (app/ann.py) на синтетических корпусах: recall@k относительно
+# точного flat-индекса, задержка одиночного запроса (как в проде — по одному на ход),
+# время сборки и прирост резидентной памяти процесса.
+#
+#   python -m benchmarks.ann --sizes 10000,100000 --types flat,ivf,hnsw,pq
+#   python -m benchmarks.ann --sizes 1000000 --types ivf,pq --nprobe 4,8,16 --out ann.json
+#
+# Векторы кластеризованы по "темам" и нормированы, как эмбеддинги текстов; запросы — зашумлённые
+# чанки корпуса. Независимые случайные векторы (FakeEmbeddings) — худший случай для ANN:
+# --topics 0 генерирует именно их.
+import gc
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+from typing import Dict, List
+
+import numpy as np
+
+from app import ann
+
+from .load import _git_commit, summarize
+
+
+def rss_bytes() -> int:
+    # Текущая резидентная память; без /proc (macOS) — пиковая
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def make_corpus(size: int, dim: int, topics: int, noise: float, rng) -> np.ndarray:
+    corpus = np.empty((size, dim), dtype="float32")
+    centers = rng.standard_normal((topics, dim)).astype("float32") if topics else None
+    for start in range(0, size, 100_000):
+        stop = min(size, start + 100_000)
+        block = rng.standard_normal((stop - start, dim)).astype("float32")
+        if centers is not None:
+            block = centers[rng.integers(0, topics, stop - start)] + noise * block
+        corpus[start:stop] = normalize(block)
+    return corpus
+
+
+def make_queries(corpus: np.ndarray, count: int, noise: float, rng) -> np.ndarray:
+    picked = corpus[rng.integers(0, len(corpus), count)]
+    return normalize(picked + noise * rng.standard_normal(picked.shape).astype("float32"))
+
+
+def measure(index, queries: np.ndarray, truth: np.ndarray, k: int) -> Dict:
+    latencies: List[float] = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - started)
+        hits += len(set(ids[0]) & set(expected))
+    return {"recall_at_k": round(hits / truth.size, 4), "latency": summarize(latencies)}
+
+
+def run(args) -> Dict:
+    import faiss
+
+    faiss.omp_set_num_threads(args.threads)
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for size in args.sizes:
+        corpus = make_corpus(size, args.dim, args.topics, args.noise, rng)
+        queries = make_queries(corpus, args.queries, args.query_noise, rng)
+        exact = faiss.IndexFlatL2(args.dim)
+        exact.add(corpus)
+        _, truth = exact.search(queries, args.k)
+        del exact
+        gc.collect()
+
+        for index_type in args.types:
+            spec = ann.index_spec(size, args.dim, index_type)
+            before = rss_bytes()
+            started = time.perf_counter()
+            index = ann.build_ann(corpus, spec)
+            build_s = time.perf_counter() - started
+            gc.collect()
+            memory = max(0, rss_bytes() - before)
+            # Параметры поиска меняются без пересборки: перебираем их на одном индексе
+            if spec["type"] == "hnsw":
+                sweep = [("ef_search", value) for value in args.ef_search]
+            elif spec["type"] in ("ivf", "pq"):
+                sweep = [("nprobe", value) for value in args.nprobe]
+            else:
+                sweep = [(None, None)]
+            for param, value in sweep:
+                if param == "ef_search":
+                    ann.HNSW_EF_SEARCH = value
+                elif param == "nprobe":
+                    ann.INDEX_NPROBE = value
+                ann.tune(index)
+                row = {
+                    "size": size,
+                    "type": spec["type"],
+                    "spec": spec,
+                    **({param: value} if param else {}),
+                    "build_s": round(build_s, 3),
+                    "rss_mb": round(memory / 2 ** 20, 1),
+                    "bytes_per_chunk": round(memory / size, 1),
+                    **measure(index, queries, truth, args.k),
+                }
+                results.append(row)
+                print(
+                    f"{size:>9} {spec['type']:<5} {param or '':<9} {value or '':>5} "
+                    f"recall@{args.k}={row['recall_at_k']:<7} p50={row['latency'].get('p50_ms')}ms "
+                    f"p99={row['latency'].get('p99_ms')}ms rss={row['rss_mb']}MB build={row['build_s']}s",
+                    file=sys.stderr,
+                )
+            del index
+            gc.collect()
+        del corpus
+        gc.collect()
+    return {
+        "commit": _git_commit(),
+        "config": {k: v for k, v in vars(args).items() if k != "out"},
+        "results": results,
+    }
+
+
+def _ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Recall/задержка/память типов FAISS-индекса")
+    parser.add_argument("--sizes", type=_ints, default=[10_000, 100_000], help="размеры корпуса через запятую")
+    parser.add_argument("--types", type=lambda v: v.split(","), default=list(ann.INDEX_TYPES))
+    parser.add_argument("--dim", type=int, default=256, help="размерность (text-embedding-3-small — 1536)")
+    parser.add_argument("--k", type=int, default=3, help="RETRIEVER_K")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--topics", type=int, default=1000, help="кластеров в корпусе, 0 — без структуры")
+    parser.add_argument("--noise", type=float, default=0.6, help="разброс чанков вокруг темы")
+    parser.add_argument("--query-noise", type=float, default=0.3, help="отличие запроса от чанка")
+    parser.add_argument("--nprobe", type=_ints, default=[ann.INDEX_NPROBE])
+    parser.add_argument("--ef-search", type=_ints, default=[ann.HNSW_EF_SEARCH])
+    parser.add_argument("--threads", type=int, default=1, help="потоков FAISS (машина Fly — 1 shared CPU)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="куда записать JSON с результатами")
+    args = parser.parse_args(argv)
+    unknown = set(args.types) - set(ann.INDEX_TYPES)
+    if unknown:
+        parser.error(f"неизвестные типы индекса: {', '.join(sorted(unknown))}")
+
+    result = run(args)
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
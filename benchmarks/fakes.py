@@ -0,0 +1,188 @@
+# benchmarks/fakes.py
+# Локальные заглушки для бенчмарков: модель, эмбеддинги, Telegram Bot API и CRM
+import math
+import time
+import random
+import re
+import asyncio
+import hashlib
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs
+
+from fastapi import FastAPI, Request
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+
+# Замеры по стадиям: имя стадии -> список длительностей, секунды. Заглушки пишут измеренное
+# время вызова, а не выбранную задержку: под нагрузкой event loop добавляет к ней своё
+STAGES: Dict[str, List[float]] = defaultdict(list)
+
+FAKE_REPLY = (
+    "Здравствуйте! Мы создаём ИИ-ассистентов, которые 24/7 квалифицируют лиды "
+    "и передают их в AmoCRM. Рассказать подробнее?"
+)
+
+
+class Latency:
+    # Логнормальное распределение задержки, заданное медианой и p99
+    def __init__(self, p50: float, p99: float):
+        self.p50 = p50
+        self.sigma = math.log(p99 / p50) / 2.326 if p50 > 0 and p99 > p50 else 0.0
+
+    def sample(self) -> float:
+        if self.p50 <= 0:
+            return 0.0
+        return self.p50 * math.exp(self.sigma * random.gauss(0, 1))
+
+
+class FakeChatModel(BaseChatModel):
+    latency: Any = None
+    reply: str = FAKE_REPLY
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-bench"
+
+    def _result(self) -> ChatResult:
+        tokens = len(self.reply) // 3
+        message = AIMessage(
+            content=self.reply,
+            usage_metadata={"input_tokens": 200, "output_tokens": tokens, "total_tokens": 200 + tokens},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        started = time.perf_counter()
+        time.sleep(self.latency.sample())
+        STAGES["llm"].append(time.perf_counter() - started)
+        return self._result()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        started = time.perf_counter()
+        await asyncio.sleep(self.latency.sample())
+        STAGES["llm"].append(time.perf_counter() - started)
+        return self._result()
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        # Первый токен — через треть задержки, остальное равномерно
+        started = time.perf_counter()
+        delay = self.latency.sample()
+        words = self.reply.split(" ")
+        await asyncio.sleep(delay / 3)
+        for word in words:
+            await asyncio.sleep(delay * 2 / 3 / len(words))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+        STAGES["llm"].append(time.perf_counter() - started)
+
+    def with_structured_output(self, schema, include_raw: bool = False, **kwargs):
+        def _wrap(result: ChatResult):
+            parsed = schema.model_validate({"reply": self.reply, "next_phase": ""})
+            if include_raw:
+                return {"raw": result.generations[0].message, "parsed": parsed, "parsing_error": None}
+            return parsed
+
+        async def _structured(_input):
+            return _wrap(await self._agenerate([]))
+
+        return RunnableLambda(lambda _input: _wrap(self._result()), afunc=_structured)
+
+
+class FakeEmbeddings(Embeddings):
+    # Детерминированные псевдослучайные векторы с настраиваемой задержкой
+    def __init__(self, size: int = 256, latency: Optional[Latency] = None):
+        self.size = size
+        self.latency = latency or Latency(0, 0)
+
+    def _vector(self, text: str) -> List[float]:
+        rng = random.Random(hashlib.sha1(text.encode("utf-8")).digest())
+        return [rng.gauss(0, 1) for _ in range(self.size)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        started = time.perf_counter()
+        time.sleep(self.latency.sample())
+        STAGES["embedding"].append(time.perf_counter() - started)
+        return self._vector(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        started = time.perf_counter()
+        await asyncio.sleep(self.latency.sample())
+        STAGES["embedding"].append(time.perf_counter() - started)
+        return self._vector(text)
+
+
+class StubServer:
+    # Заглушка Telegram Bot API и CRM-вебхука; работает в отдельном потоке со своим loop,
+    # чтобы не нагружать event loop приложения
+    def __init__(self, port: int, loop: asyncio.AbstractEventLoop):
+        self.port = port
+        self.loop = loop
+        self.replies: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self.leads: List[Dict[str, Any]] = []
+        # user_id -> момент прихода лида в CRM (perf_counter)
+        self.lead_arrivals: Dict[int, float] = {}
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._message_id = 0
+        self._server = None
+        self.app = self._build_app()
+
+    def _build_app(self) -> FastAPI:
+        stub = FastAPI()
+
+        @stub.post("/bot{token}/{method}")
+        async def bot_api(token: str, method: str, request: Request):
+            self.calls[method] += 1
+            form = {k: v[0] for k, v in parse_qs((await request.body()).decode("utf-8")).items()}
+            if method == "getMe":
+                return {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+            if method in ("sendMessage", "editMessageText"):
+                chat_id = int(form.get("chat_id", 0))
+                self._message_id += 1
+                reply = (time.perf_counter(), method, form.get("text", ""))
+                self.loop.call_soon_threadsafe(self._deliver, chat_id, reply)
+                return {"ok": True, "result": {
+                    "message_id": int(form.get("message_id", self._message_id)),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": form.get("text", ""),
+                }}
+            return {"ok": True, "result": True}
+
+        @stub.post("/crm")
+        async def crm(request: Request):
+            body = await request.json()
+            arrived_at = time.perf_counter()
+            # При CRM_BATCH_SIZE > 1 приходит список лидов
+            for lead in body if isinstance(body, list) else [body]:
+                self.leads.append(lead)
+                source = re.search(r"\((\d+)\)", lead.get("custom_fields", {}).get("source", ""))
+                if source:
+                    self.lead_arrivals[int(source.group(1))] = arrived_at
+            return {"status": "ok"}
+
+        return stub
+
+    def _deliver(self, chat_id: int, reply: tuple):
+        # Очереди создаются и пополняются только в loop бенчмарка
+        self.replies[chat_id].put_nowait(reply)
+
+    def start(self):
+        import uvicorn
+
+        config = uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="warning")
+        self._server = uvicorn.Server(config)
+        thread = threading.Thread(target=self._server.run, daemon=True)
+        thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+
+    def stop(self):
+        if self._server:
+            self._server.should_exit = True
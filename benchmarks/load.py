@@ -0,0 +1,299 @@
+# benchmarks/load.py
+# Нагрузочный бенчмарк: виртуальные пользователи проходят воронку phase1 -> phase7 через
+# /webhook, а модель, эмбеддинги, Redis, Telegram Bot API и CRM заменены локальными заглушками.
+#
+#   python -m benchmarks.load --users 50 --llm-p50 1.0 --llm-p99 4.0 --out bench.json
+#   python -m benchmarks.load --users 50 --compare bench.json
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import itertools
+import subprocess
+import tempfile
+from collections import defaultdict
+from typing import Dict, List
+
+from .fakes import STAGES, FakeChatModel, FakeEmbeddings, Latency, StubServer
+
+BOT_TOKEN = "123456:bench"
+
+# (фаза, в которой пользователь пишет, текст сообщения)
+SCRIPT = [
+    ("phase1", "Привет! Расскажите, что вы делаете?"),
+    ("phase2A", "Давайте ответим на вопросы"),
+    ("phase3A", "Нужна лидогенерация"),
+    ("phase4A", "У нас B2B компания"),
+    ("phase5A", "Используем AmoCRM"),
+    ("phase6A", "Меня зовут Иван, телефон +7 952 123-45-67"),
+    ("phase7", "Спасибо!"),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "p99_ms": pct(0.99),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+def configure_env(args, port: int, index_dir: str):
+    base = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "sk-bench"),
+        "TELEGRAM_API_URL": f"{base}/bot",
+        "ALBATO_WEBHOOK_URL": f"{base}/crm",
+        "FAISS_INDEX_DIR": index_dir,
+        "KNOWLEDGE_POLL_INTERVAL": "0",
+        "STREAM_REPLIES": "0",
+        "COMBINED_TURN": "0",
+        "LLM_CACHE_ENABLED": "1" if args.llm_cache else "0",
+        "LLM_CACHE_REDIS": "1" if args.redis else "0",
+        "STATE_BACKEND": "redis" if args.redis else "memory",
+        "CRM_OUTBOX": "redis" if args.redis else "memory",
+        "CRM_BACKOFF_BASE": "0.1",
+        "LLM_RPM": str(args.llm_rpm),
+        "LLM_TPM": str(args.llm_tpm),
+        "LLM_CONCURRENCY": str(args.llm_concurrency),
+        "WEBHOOK_WORKERS": str(args.workers),
+        "ADMISSION_ENABLED": "1" if args.admission else "0",
+    })
+    os.environ.pop("WEBHOOK_URL", None)
+    if args.redis:
+        os.environ["REDIS_URL"] = args.redis
+
+
+def update_payload(update_id: int, user_id: int, text: str) -> Dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+        },
+    }
+
+
+def timed(stage: str, func):
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            STAGES[stage].append(time.perf_counter() - started)
+    return wrapper
+
+
+async def monitor_loop_lag(samples: List[float], stop: asyncio.Event, interval: float = 0.01):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - started - interval))
+
+
+async def run(args) -> Dict:
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    port = free_port()
+    configure_env(args, port, tempfile.mkdtemp(prefix="bench_index_"))
+    stub = StubServer(port, loop)
+    stub.start()
+
+    started = time.perf_counter()
+    from app import main, llm, rag, dialog_state
+    import_s = time.perf_counter() - started
+    logging.getLogger().setLevel(logging.WARNING)
+
+    llm.set_chat_model(FakeChatModel(latency=Latency(args.llm_p50, args.llm_p99)))
+    rag.embeddings = FakeEmbeddings(latency=Latency(args.embed_p50, args.embed_p99))
+    backend = dialog_state.backend
+    backend.load = timed("state_load", backend.load)
+    backend.update = timed("state_update", backend.update)
+
+    # startup_s — до приёма webhook, ready_s — до окончания фонового прогрева (/ready = 200)
+    boot_started = time.perf_counter()
+    await main.startup_event()
+    startup_s = time.perf_counter() - boot_started
+
+    turn_latency: Dict[str, List[float]] = defaultdict(list)
+    lead_sent_at: Dict[int, float] = {}
+    counters = defaultdict(int)
+    update_ids = itertools.count(1)
+    lag: List[float] = []
+    stop_lag = asyncio.Event()
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        ready_s = None
+        while time.perf_counter() - boot_started < args.timeout:
+            if (await client.get("/ready")).status_code == 200:
+                ready_s = time.perf_counter() - boot_started
+                break
+            await asyncio.sleep(0.05)
+
+        async def post(user_id: int, text: str):
+            started = time.perf_counter()
+            payload = update_payload(next(update_ids), user_id, text)
+            resp = await client.post("/webhook", json=payload)
+            STAGES["webhook_ack"].append(time.perf_counter() - started)
+            if resp.status_code != 200:
+                counters["rejected"] += 1
+            elif random.random() < args.redeliver:
+                # Повторная доставка того же update_id, как делает Telegram при медленном webhook
+                counters["redelivered"] += 1
+                await client.post("/webhook", json=payload)
+            return started, resp.status_code == 200
+
+        async def user(user_id: int, delay: float):
+            await asyncio.sleep(delay)
+            replies = stub.replies[user_id]
+            last_text = ""
+            for phase, text in SCRIPT:
+                sent_at, accepted = await post(user_id, text)
+                if not accepted:
+                    return
+                try:
+                    arrived_at, _method, last_text = await asyncio.wait_for(replies.get(), args.timeout)
+                except asyncio.TimeoutError:
+                    counters["timeouts"] += 1
+                    return
+                turn_latency[phase].append(arrived_at - sent_at)
+                counters["turns"] += 1
+                await asyncio.sleep(args.think)
+            # Триггер NEWLEAD из ответа phase7 возвращается боту, как это делает ретранслятор
+            if "systemTextByAi" in last_text:
+                lead_sent_at[user_id], _ = await post(user_id, last_text)
+
+        lag_task = asyncio.create_task(monitor_loop_lag(lag, stop_lag))
+        started = time.perf_counter()
+        ramp = args.ramp / max(1, args.users)
+        await asyncio.gather(*(user(10_000 + i, i * ramp) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+        # Ждём, пока outbox доставит лиды в заглушку CRM
+        deadline = time.perf_counter() + args.timeout
+        while len(stub.leads) < len(lead_sent_at) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        stop_lag.set()
+        await lag_task
+
+    # Ответы сверх одного на ход — дубли от повторных доставок
+    await asyncio.sleep(0.5)
+    duplicate_replies = sum(queue.qsize() for queue in stub.replies.values())
+
+    for user_id, arrived_at in stub.lead_arrivals.items():
+        if user_id in lead_sent_at:
+            STAGES["crm_delivery"].append(arrived_at - lead_sent_at[user_id])
+
+    pool_stats = main.update_pool.stats()
+    await main.shutdown_event()
+    stub.stop()
+
+    all_turns = [v for samples in turn_latency.values() for v in samples]
+    return {
+        "commit": _git_commit(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "duration_s": round(elapsed, 3),
+        "import_s": round(import_s, 3),
+        "startup_s": round(startup_s, 3),
+        "ready_s": round(ready_s, 3) if ready_s is not None else None,
+        "turns": counters["turns"],
+        "throughput_turns_per_s": round(counters["turns"] / elapsed, 2) if elapsed else 0.0,
+        "timeouts": counters["timeouts"],
+        "rejected": counters["rejected"],
+        "redelivered": counters["redelivered"],
+        "duplicate_replies": duplicate_replies,
+        "leads_delivered": len(stub.leads),
+        "latency": {"overall": summarize(all_turns),
+                    "by_phase": {phase: summarize(turn_latency[phase]) for phase, _ in SCRIPT}},
+        "stages": {stage: summarize(samples) for stage, samples in sorted(STAGES.items())},
+        "event_loop_lag": summarize(lag),
+        "queue": pool_stats,
+        "telegram_calls": dict(stub.calls),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return ""
+
+
+def compare(current: Dict, baseline: Dict):
+    print(f"{'метрика':<32}{'было':>12}{'стало':>12}{'Δ%':>8}")
+    rows = [("overall", current["latency"]["overall"], baseline["latency"]["overall"])]
+    rows += [(phase, stats, baseline["latency"]["by_phase"].get(phase, {}))
+             for phase, stats in current["latency"]["by_phase"].items()]
+    for name, now, before in rows:
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if key in now and before.get(key):
+                delta = (now[key] - before[key]) / before[key] * 100
+                print(f"{name + ' ' + key:<32}{before[key]:>12}{now[key]:>12}{delta:>+8.1f}")
+    for key in ("throughput_turns_per_s", "import_s", "startup_s", "ready_s"):
+        print(f"{key:<32}{str(baseline.get(key)):>12}{str(current.get(key)):>12}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк воронки FirstContact AI")
+    parser.add_argument("--users", type=int, default=20, help="одновременных диалогов")
+    parser.add_argument("--ramp", type=float, default=1.0, help="разгон пользователей, секунд")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза пользователя между сообщениями")
+    parser.add_argument("--timeout", type=float, default=60.0, help="ожидание ответа на ход")
+    parser.add_argument("--llm-p50", type=float, default=1.0)
+    parser.add_argument("--llm-p99", type=float, default=4.0)
+    parser.add_argument("--embed-p50", type=float, default=0.15)
+    parser.add_argument("--embed-p99", type=float, default=0.6)
+    parser.add_argument("--llm-rpm", type=int, default=100000)
+    parser.add_argument("--llm-tpm", type=int, default=100000000)
+    parser.add_argument("--llm-concurrency", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=16, help="воркеры обработки webhook")
+    parser.add_argument("--redeliver", type=float, default=0.0, help="доля обновлений, доставляемых повторно")
+    parser.add_argument("--admission", action="store_true", help="включить контроль допуска и деградацию")
+    parser.add_argument("--llm-cache", action="store_true", help="включить кэш ответов LLM")
+    parser.add_argument("--redis", help="REDIS_URL настоящего Redis вместо in-memory")
+    parser.add_argument("--out", help="куда записать JSON с результатами")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(result, json.load(f))
+    return 0 if result["timeouts"] == 0 and result["duplicate_replies"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import time
+import asyncio
+
+from app import admission, llm
+from app.llm import PriorityLimiter
+
+
+def _degraded(monkeypatch, latency, age):
+    monkeypatch.setattr(admission, "limiter", PriorityLimiter(rpm=1000, tpm=1_000_000, concurrency=8))
+    monkeypatch.setattr(llm, "latency_ewma", latency)
+    monkeypatch.setattr(llm, "_latency_at", time.monotonic() - age)
+
+
+def test_slow_model_degrades(monkeypatch):
+    _degraded(monkeypatch, admission.DEGRADE_LATENCY * 2, age=0)
+    assert admission.overload_reason(0) == "latency"
+
+
+def test_degraded_mode_ends_without_primary_calls(monkeypatch):
+    # В деградации основная модель не вызывается — оценка должна затухнуть сама
+    _degraded(monkeypatch, admission.DEGRADE_LATENCY * 2, age=2 * llm.LATENCY_HALF_LIFE)
+    assert admission.overload_reason(0) is None
+
+
+def test_recovered_latency_stays_below_threshold(monkeypatch):
+    _degraded(monkeypatch, admission.DEGRADE_LATENCY * 2, age=2 * llm.LATENCY_HALF_LIFE)
+    llm._observe_latency(1.0)
+    assert llm.current_latency() < admission.DEGRADE_LATENCY
+    assert admission.overload_reason(0) is None
+
+
+def test_slow_sample_after_decay_degrades_again(monkeypatch):
+    _degraded(monkeypatch, admission.DEGRADE_LATENCY * 2, age=2 * llm.LATENCY_HALF_LIFE)
+    for _ in range(10):
+        llm._observe_latency(admission.DEGRADE_LATENCY * 3)
+    assert admission.overload_reason(0) == "latency"
+
+
+class ScriptClient:
+    # register_script: каждый скрипт записывает свои вызовы; захват слота всегда успешен
+    def __init__(self):
+        self.calls = {}
+
+    def register_script(self, script):
+        calls = self.calls.setdefault(script, [])
+
+        async def run(keys, args):
+            calls.append(args)
+            return 1
+
+        return run
+
+    async def zrem(self, key, member):
+        return 1
+
+
+def test_slot_lease_renewed_until_release(monkeypatch):
+    monkeypatch.setattr(admission, "SLOT_TTL", 0.06)
+
+    async def run():
+        client = ScriptClient()
+        limiter = admission.RedisAdmission(client)
+        slot = await limiter.acquire_slot()
+        # Ход дольше SLOT_TTL: аренда продлевается
+        await asyncio.sleep(0.1)
+        renewed = len(client.calls[admission._RENEW_SCRIPT])
+        await limiter.release_slot(slot)
+        await asyncio.sleep(0.05)
+        return slot, renewed, len(client.calls[admission._RENEW_SCRIPT]), limiter.stats()
+
+    slot, renewed, after_release, stats = asyncio.run(run())
+    assert slot
+    assert renewed >= 2
+    assert after_release == renewed
+    assert stats["held"] == 0
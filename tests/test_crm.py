@@ -0,0 +1,41 @@
+import asyncio
+
+from app import crm
+
+
+class CaptureOutbox:
+    def __init__(self):
+        self.items = []
+
+    async def push(self, item):
+        self.items.append(item)
+
+
+def _send(monkeypatch, *message_ids):
+    outbox = CaptureOutbox()
+    monkeypatch.setattr(crm, "outbox", outbox)
+    monkeypatch.setattr(crm, "ALBATO_WEBHOOK_URL", "http://crm.test/hook")
+
+    async def run():
+        for message_id in message_ids:
+            await crm.send_lead_to_crm(None, "42", "Анна", "telegram", "Перезвоните мне",
+                                       {"name": "Анна", "phone": "+79990000000"}, message_id=message_id)
+
+    asyncio.run(run())
+    return [item["id"] for item in outbox.items]
+
+
+def test_same_lead_resubmitted_is_new(monkeypatch):
+    # Тот же клиент с теми же данными через час — новый лид, а не дубль
+    first, second = _send(monkeypatch, "100", "101")
+    assert first != second
+
+
+def test_same_message_keeps_key(monkeypatch):
+    first, second = _send(monkeypatch, "100", "100")
+    assert first == second
+
+
+def test_without_message_id_every_lead_is_new(monkeypatch):
+    first, second = _send(monkeypatch, "", "")
+    assert first != second
@@ -0,0 +1,147 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app import llm
+from app.llm import Chain, LLMOverloaded, PriorityLimiter
+
+
+class EchoRunnable:
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.peak = 0
+
+    async def abatch(self, inputs, return_exceptions=False):
+        self.peak = max(self.peak, self.limiter.in_flight)
+        await asyncio.sleep(0.01)
+        return [item["input"] for item in inputs]
+
+
+def _setup(monkeypatch, concurrency):
+    lim = PriorityLimiter(rpm=1000, tpm=1_000_000, concurrency=concurrency)
+    chain = Chain("test_batch", "{input}")
+    runnable = EchoRunnable(lim)
+    chain._runnables["primary"] = runnable
+    monkeypatch.setattr(llm, "limiter", lim)
+    monkeypatch.setitem(llm.chains, "test_batch", chain)
+    return lim, runnable
+
+
+def test_batch_larger_than_concurrency(monkeypatch):
+    async def run():
+        lim, runnable = _setup(monkeypatch, concurrency=3)
+        results = await asyncio.wait_for(llm.abatch("test_batch", [{"input": i} for i in range(10)]), 5)
+        return lim, runnable, results
+
+    lim, runnable, results = asyncio.run(run())
+    assert results == list(range(10))
+    assert runnable.peak <= 3
+    assert lim.in_flight == 0
+
+
+def test_concurrent_batches_over_limit(monkeypatch):
+    async def run():
+        lim, runnable = _setup(monkeypatch, concurrency=8)
+        batches = [llm.abatch("test_batch", [{"input": i} for i in range(size)]) for size in (6, 5, 8)]
+        results = await asyncio.wait_for(asyncio.gather(*batches), 5)
+        return lim, runnable, results
+
+    lim, runnable, results = asyncio.run(run())
+    assert [len(r) for r in results] == [6, 5, 8]
+    assert runnable.peak <= 8
+    assert lim.in_flight == 0
+
+
+def test_batch_acquire_is_all_or_nothing():
+    async def run():
+        lim = PriorityLimiter(rpm=1000, tpm=1_000_000, concurrency=4)
+        await lim.acquire(10)
+        await lim.acquire(10)
+        batch = asyncio.ensure_future(lim.acquire(30, count=3))
+        await asyncio.sleep(0.01)
+        # Двух свободных слотов пачке из трёх мало — она ничего не забирает
+        assert not batch.done() and lim.in_flight == 2
+        await lim.release(10)
+        await asyncio.wait_for(batch, 1)
+        assert lim.in_flight == 4
+        with pytest.raises(ValueError):
+            await lim.acquire(10, count=5)
+
+    asyncio.run(run())
+
+
+def test_batch_queue_timeout(monkeypatch):
+    async def run():
+        lim, _ = _setup(monkeypatch, concurrency=2)
+        monkeypatch.setattr(llm, "LLM_QUEUE_TIMEOUT", 0.05)
+        await lim.acquire(10)
+        with pytest.raises(LLMOverloaded):
+            await llm.abatch("test_batch", [{"input": 1}, {"input": 2}])
+        # Ожидание снято, слоты пачки не утекли
+        assert lim.in_flight == 1 and lim.queued == 0
+
+    asyncio.run(run())
+
+
+class StructuredRunnable:
+    # Как with_structured_output(include_raw=True): разобранный ответ плюс сырой AIMessage
+    def __init__(self, used=120, error=None):
+        self.used = used
+        self.error = error
+
+    def _response(self, inputs):
+        raw = SimpleNamespace(usage_metadata={"input_tokens": self.used - 20, "output_tokens": 20,
+                                              "total_tokens": self.used})
+        return {"raw": raw, "parsed": None if self.error else {"reply": inputs["input"]}, "parsing_error": self.error}
+
+    async def ainvoke(self, inputs):
+        return self._response(inputs)
+
+    async def abatch(self, inputs, return_exceptions=False):
+        return [self._response(item) for item in inputs]
+
+
+def _setup_structured(monkeypatch, runnable):
+    lim = PriorityLimiter(rpm=1000, tpm=6000, concurrency=8)
+    chain = Chain("test_structured", "{input}")
+    chain._runnables["primary"] = runnable
+    monkeypatch.setattr(llm, "limiter", lim)
+    monkeypatch.setitem(llm.chains, "test_structured", chain)
+    return lim
+
+
+def test_structured_usage_corrects_reservation(monkeypatch):
+    async def run():
+        lim = _setup_structured(monkeypatch, StructuredRunnable(used=120))
+        result = await llm.ainvoke("test_structured", {"input": "привет"})
+        return lim, result
+
+    lim, result = asyncio.run(run())
+    assert result == {"reply": "привет"}
+    # Резерв (промпт + LLM_REPLY_TOKENS) заменён фактическим расходом
+    assert abs(lim.tokens - (6000 - 120)) < 5
+    assert lim.in_flight == 0
+
+
+def test_structured_parsing_error_raises(monkeypatch):
+    async def run():
+        lim = _setup_structured(monkeypatch, StructuredRunnable(error=ValueError("не JSON")))
+        with pytest.raises(ValueError):
+            await llm.ainvoke("test_structured", {"input": "привет"})
+        return lim
+
+    lim = asyncio.run(run())
+    assert abs(lim.tokens - (6000 - 120)) < 5
+    assert lim.in_flight == 0
+
+
+def test_structured_batch_usage(monkeypatch):
+    async def run():
+        lim = _setup_structured(monkeypatch, StructuredRunnable(used=100))
+        results = await llm.abatch("test_structured", [{"input": str(i)} for i in range(3)])
+        return lim, results
+
+    lim, results = asyncio.run(run())
+    assert results == [{"reply": str(i)} for i in range(3)]
+    assert abs(lim.tokens - (6000 - 300)) < 5
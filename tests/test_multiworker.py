@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import asyncio
+import multiprocessing
+
+from app import rag
+from app.dedupe import UpdateDeduplicator
+
+
+class FakeRedis:
+    # SET NX и DELETE поверх словаря: общий "Redis" для нескольких процессов приложения
+    def __init__(self):
+        self.data = {}
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def delete(self, key):
+        return int(self.data.pop(key, None) is not None)
+
+
+def test_update_claimed_by_one_worker():
+    async def run():
+        client = FakeRedis()
+        first, second = UpdateDeduplicator(client), UpdateDeduplicator(client)
+        claims = [await first.claim(42), await second.claim(42)]
+        await first.release(42)
+        claims.append(await second.claim(42))
+        return first, second, claims
+
+    first, second, claims = asyncio.run(run())
+    assert claims == [True, False, True]
+    assert second.duplicates == 1
+    assert first.duplicates == 0
+
+
+def test_local_repeat_skips_redis():
+    async def run():
+        client = FakeRedis()
+        dedup = UpdateDeduplicator(client)
+        await dedup.claim(7)
+        client.data.clear()
+        return await dedup.claim(7)
+
+    assert asyncio.run(run()) is False
+
+
+class FakeDocstore:
+    _dict = {}
+
+
+class FakeStore:
+    docstore = FakeDocstore()
+
+    def save_local(self, path):
+        os.makedirs(path)
+
+    def as_retriever(self, search_kwargs=None):
+        return None
+
+
+def _builds_log():
+    return os.path.join(os.path.dirname(rag.INDEX_DIR), "builds.log")
+
+
+def _fake_build(hashes, base_version=None):
+    with open(_builds_log(), "a") as f:
+        f.write(f"{os.getpid()}\n")
+    # Сборка долгая: второй воркер успевает упереться в блокировку
+    time.sleep(0.3)
+    files = {path: {"sha256": digest, "chunks": []} for path, digest in hashes.items()}
+    store = FakeStore()
+    return store, rag._publish_version(store, files)
+
+
+def _fake_load(version, mmap=False, search=False):
+    with open(os.path.join(rag.INDEX_DIR, version, "manifest.json"), encoding="utf-8") as f:
+        return FakeStore(), json.load(f)
+
+
+def _worker(barrier, results):
+    barrier.wait()
+    rag.sync_index()
+    results.put(rag.index_version)
+
+
+def test_concurrent_sync_builds_once(monkeypatch, tmp_path):
+    knowledge = tmp_path / "knowledge"
+    knowledge.mkdir()
+    (knowledge / "prices.md").write_text("# Цены\nот 10 000 ₽", encoding="utf-8")
+    index_dir = tmp_path / "index"
+    index_dir.mkdir()
+    monkeypatch.setattr(rag, "KNOWLEDGE_DIR", str(knowledge))
+    monkeypatch.setattr(rag, "INDEX_DIR", str(index_dir))
+    monkeypatch.setattr(rag, "INDEX_TYPE", "flat")
+    monkeypatch.setattr(rag, "build_index", _fake_build)
+    monkeypatch.setattr(rag, "_load_version", _fake_load)
+
+    # Два воркера uvicorn — два процесса с общим INDEX_DIR
+    ctx = multiprocessing.get_context("fork")
+    barrier, results = ctx.Barrier(2), ctx.Queue()
+    workers = [ctx.Process(target=_worker, args=(barrier, results)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    versions = [results.get(timeout=10) for _ in workers]
+    for worker in workers:
+        worker.join(10)
+
+    with open(_builds_log()) as f:
+        builds = f.read().split()
+    current = (index_dir / "CURRENT").read_text(encoding="utf-8")
+    assert len(builds) == 1
+    assert versions == [current, current]
+    assert [d for d in os.listdir(index_dir) if d.startswith("v")] == [current]
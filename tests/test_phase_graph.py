@@ -0,0 +1,76 @@
+import copy
+
+from app.llm import chains
+from app.phases.graph import GRAPH, CompiledPhase, compiled, validate_graph
+
+
+def _graph():
+    return copy.deepcopy(GRAPH)
+
+
+def test_graph_is_valid():
+    assert validate_graph(GRAPH) == []
+
+
+def test_bad_target():
+    graph = _graph()
+    graph["phase2A"]["rules"][0]["next"] = "phase3B"
+    assert any("phase3B" in error for error in validate_graph(graph))
+
+
+def test_unreachable_phase():
+    graph = _graph()
+    graph["phase2A"]["rules"] = []
+    graph["phase2A"]["default"] = {"next": "phase6A"}
+    errors = validate_graph(graph)
+    assert any(error.startswith("phase3A") and "недостижима" in error for error in errors)
+
+
+def test_bad_slot_value():
+    graph = _graph()
+    graph["phase4A"]["rules"][0]["set"] = {"business_type": "B2G"}
+    assert any("B2G" in error for error in validate_graph(graph))
+
+
+def test_context_flag_matches_template(monkeypatch):
+    graph = _graph()
+    graph["phase1"]["context"] = True
+    assert any(error.startswith("phase1") and "context" in error for error in validate_graph(graph))
+    # Шаблон читает {context}, а флага нет — retrieval бы не выполнялся
+    monkeypatch.setattr(chains["phase1"], "template", chains["phase1"].template + "\n{context}")
+    assert any(error.startswith("phase1") and "context" in error for error in validate_graph(_graph()))
+    graph = _graph()
+    graph["phase1"]["context"] = True
+    assert validate_graph(graph) == []
+    assert CompiledPhase("phase1", graph["phase1"]).context
+
+
+def test_rule_order_wins_over_position():
+    # "ип" стоит в сообщении раньше, но правило B2B объявлено первым
+    phase = compiled["phase4A"]
+    assert phase.route("ИП, работаем с компаниями", {}) == ("phase5A", {"business_type": "B2B"})
+
+
+def test_keywords_match_word_starts():
+    phase = compiled["phase4A"]
+    assert phase.route("типа интернет-магазин", {}) == ("phase5A", {"business_type": "уточнить позже"})
+    assert phase.route("мы ИП", {}) == ("phase5A", {"business_type": "ИП"})
+
+
+def test_default():
+    phase = CompiledPhase("phase3A", GRAPH["phase3A"])
+    assert phase.route("пока не знаю", {}) == ("phase4A", {"goal": "уточнить позже"})
+
+
+def test_when_filled_across_messages():
+    phase = compiled["phase6A"]
+    assert phase.route("Иван", {}) == ("phase6A", {})
+    assert phase.route("Меня зовут Иван", {}) == ("phase6A", {"name": "Иван"})
+    assert phase.route("+7 900 123 45 67", {"name": "Иван"}) == ("phase7", {"phone": "+79001234567"})
+
+
+def test_known_name_is_not_overwritten():
+    phase = compiled["phase6A"]
+    assert phase.route("Да, конечно", {}) == ("phase6A", {})
+    assert phase.route("Пишите сюда: +7 900 123 45 67", {"name": "Иван"})[1] == {"phone": "+79001234567"}
+    assert phase.route("Иван, 89001234567", {}) == ("phase7", {"name": "Иван", "phone": "+79001234567"})
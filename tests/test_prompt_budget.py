@@ -0,0 +1,37 @@
+from app.llm import trim_inputs
+from app.tokens import count_tokens
+
+TEMPLATE = "Контекст: {context}\nСообщение: {message}\nЦель: {goal}"
+
+
+def _fit(budget, **inputs):
+    return trim_inputs("turn", TEMPLATE, count_tokens(TEMPLATE), budget, inputs)
+
+
+def test_within_budget_untouched():
+    inputs = {"context": "цены от 10 000", "message": "сколько стоит?", "goal": "лидогенерация"}
+    fitted, total = _fit(1000, **inputs)
+    assert fitted == inputs
+    assert total <= 1000
+
+
+def test_context_trimmed_before_message():
+    message = "сколько стоит бот для салона?"
+    fitted, total = _fit(200, context="прайс " * 1000, message=message, goal="лидогенерация")
+    assert total <= 200
+    assert fitted["message"] == message
+    assert fitted["goal"] == "лидогенерация"
+    assert count_tokens(fitted["context"]) < count_tokens("прайс " * 1000)
+
+
+def test_message_trimmed_when_context_is_not_enough():
+    fitted, total = _fit(100, context="прайс " * 1000, message="очень длинно " * 1000, goal="")
+    assert total <= 100
+    assert fitted["context"] == ""
+    assert len(fitted["message"]) < len("очень длинно " * 1000)
+
+
+def test_inputs_outside_template_ignored():
+    fitted, total = _fit(50, context="", message="да", instructions="x " * 1000)
+    assert fitted["instructions"] == "x " * 1000
+    assert total <= 50